@@ -1,4 +1,6 @@
+from collections import deque
 from datetime import datetime
+from itertools import izip
 import Queue
 import serial
 import sys
@@ -10,7 +12,10 @@ from concord_commands import RX_COMMANDS, \
     build_dynamic_data_refresh, build_keypress, \
     build_cmd_alarm_trouble
 
-from concord_helpers import ascii_hex_to_byte, total_secs
+from concord_helpers import ascii_hex_to_byte, total_secs, LatencyStats
+from concord_tokens import decode_text_tokens
+from concord_coalesce import ZoneStatusCoalescer
+from concord_log import lazy, lazy_logger
 
 CONCORD_MAX_ZONE = 6
 
@@ -36,6 +41,35 @@ MAX_RESENDS = 3
 
 STOP = 'STOP'
 
+# Log lines which can repeat for as long as the panel is confused;
+# clients can set repeat windows for them, see concord_log.
+REPEATED_LOG_TEMPLATES = (
+    "Spurious ACK",
+    "Spurious NAK",
+    "Unknown command for message %r",
+    )
+
+# Batch handlers get their messages once no batched message has
+# arrived for this long, in seconds, if the terminating command does
+# not show up first.
+BATCH_WINDOW_SECS = 2.0
+
+# Read at most this many messages from the serial port before
+# dispatching what has been read so far.
+MAX_RX_BURST = 8
+
+# Messages whose handlers should run ahead of routine traffic,
+# recognised by their command code bytes.
+PRIORITY_COMMANDS = frozenset([
+        (0x22, 0x02), # ALARM
+        ])
+ARM_LEVEL_COMMAND = (0x22, 0x01)
+
+TOUCHPAD_COMMAND = (0x22, 0x09)
+# Text tokens 0x00 to 0x09 are the digits; a touchpad display that
+# changes only in these is just the clock ticking over.
+MAX_DIGIT_TOKEN = 0x09
+
 class CommException(Exception):
     pass
 
@@ -55,7 +89,7 @@ class SerialInterface(object):
         *timeout_secs* in fractional seconds; e.g. 0.25 = 250 milliseconds
         """
         self.control_char_cb = control_char_cb
-        self.logger = logger
+        self.logger = lazy_logger(logger)
         # Ugly debugging hack
         if dev_name == 'fake':
             return
@@ -84,7 +118,8 @@ class SerialInterface(object):
             if byte_read == '':
                 # Timeout
                 return None
-            self.logger.debug_verbose("Wait for message start, byte_read=%r" % byte_read)
+            if self.logger.verbose_enabled:
+                self.logger.debug_verbose("Wait for message start, byte_read=%r", byte_read)
             if byte_read in CTRL_CHARS:
                 self.control_char_cb(byte_read)
             # Discard the unrecognized character
@@ -180,7 +215,7 @@ class SerialInterface(object):
         message-start linefeed character.
         """
         framed_msg = MSG_START + encode_message_to_ascii(msg) 
-        self.logger.debug_verbose("write_message: %r" % framed_msg)
+        self.logger.debug_verbose("write_message: %r", framed_msg)
         self.serdev.write(framed_msg)
 
     def write(self, data):
@@ -221,6 +256,12 @@ def encode_message_to_ascii(bin_msg):
         s += '%02x' % b
     return s
 
+def command_str(command):
+    """ Hex form of an RX_COMMANDS key, for logging. """
+    if isinstance(command, tuple):
+        return "0x%02x/0x%02x" % command
+    return "0x%02x" % command
+
 def decode_message_from_ascii(ascii_msg):
     n = len(ascii_msg)
     if n % 2 != 0:
@@ -231,12 +272,44 @@ def decode_message_from_ascii(ascii_msg):
     return b
 
 
+class MessageBatch(object):
+    """
+    Collects decoded messages for a batch handler; see
+    AlarmPanelInterface.register_batch_handler().
+    """
+    def __init__(self, command_ids, handler_fn, terminator_id, window_secs):
+        self.command_ids = frozenset(command_ids)
+        self.handler_fn = handler_fn
+        self.terminator_id = terminator_id
+        self.window_secs = window_secs
+        self.messages = [ ]
+        self.last_add_time = None
+
+    def add(self, decoded_command):
+        self.messages.append(decoded_command)
+        self.last_add_time = time.time()
+
+    def is_expired(self, now):
+        return len(self.messages) > 0 and \
+            now - self.last_add_time > self.window_secs
+
+    def take(self):
+        msgs = self.messages
+        self.messages = [ ]
+        self.last_add_time = None
+        return msgs
+
+
 class AlarmPanelInterface(object):
-    def __init__(self, dev_name, timeout_secs, logger):
+    def __init__(self, dev_name, timeout_secs, logger, priority_arm_level=True):
+        """
+        If *priority_arm_level* is True, ARM_LEVEL messages are
+        handled in the priority lane along with ALARM messages.
+        """
+        self.logger = lazy_logger(logger)
         self.serial_interface = SerialInterface(dev_name, timeout_secs, \
-                                                    self.ctrl_char_cb, logger)
+                                                    self.ctrl_char_cb, self.logger)
         self.timeout_secs = timeout_secs
-        self.logger = logger
 
         # Messages on the transmit queue are in binary format with a
         # valid checksum.
@@ -247,13 +320,41 @@ class AlarmPanelInterface(object):
         # this queue, it will 'receive' them.
         self.fake_rx_queue = Queue.Queue()
 
+        # Messages received but not yet handled, as (arrival time,
+        # binary message) pairs.  Everything on the priority queue is
+        # handled before anything on the routine queue.
+        self.rx_priority = deque()
+        self.rx_routine = deque()
+        self.priority_commands = set(PRIORITY_COMMANDS)
+        if priority_arm_level:
+            self.priority_commands.add(ARM_LEVEL_COMMAND)
+        # Time from message arrival until its handlers are called.
+        self.dispatch_latency = { 'priority': LatencyStats(),
+                                  'routine': LatencyStats() }
+
+        # Partition number -> data bytes of the last TOUCHPAD message
+        # for that partition.
+        self.last_touchpad = { }
+        self.touchpad_clock_only_count = 0
+
+        # Optional coalescing of ZONE_STATUS messages; see
+        # enable_zone_coalescing().  The settings asked for are put
+        # into effect by the message loop.
+        self.zone_coalescer = None
+        self.zone_coalescing = (0, 0, 0) # (window secs, flap count, flap secs)
+        self.zone_coalescing_wanted = self.zone_coalescing
+
         self.reset_pending_tx()
 
         self.message_handlers = { } # Command ID -> list of message handlers for that ID.
         for command_code, (command_id, command_name, parser_fn) \
                 in RX_COMMANDS.iteritems():
             self.message_handlers[command_id] = [ ]
-        
+        self.batches = [ ]
+        self.batches_by_id = { } # Command ID -> list of batches collecting that ID.
+        self.batches_flushed_by = { } # Command ID -> list of batches delivered before it.
+        self.periodic_handlers = [ ] # [handler, interval secs, next call time]
+
 
     def register_message_handler(self, command_id, handler_fn):
         """ 
@@ -267,8 +368,120 @@ class AlarmPanelInterface(object):
             raise KeyError("No such command ID %r" % command_id)
         self.message_handlers[command_id].append(handler_fn)
 
+    def register_batch_handler(self, command_ids, handler_fn,
+                               terminator_id='EQPT_LIST_DONE',
+                               window_secs=BATCH_WINDOW_SECS, flush_ids=()):
+        """
+        *handler_fn* will be passed a list of the parsed message dicts
+        for the command IDs in *command_ids*, in the order they were
+        received.  The list is delivered when a message with
+        *terminator_id* arrives (it is included as the last item), or
+        when no more messages for the batch have arrived within
+        *window_secs* seconds.
+
+        A message for one of *flush_ids* delivers any messages
+        collected so far before its own handlers are called, so a
+        batched message can't overwrite news that arrived after it.
+
+        This suits bursts like the reply to an equipment list request,
+        which can be handled in one pass rather than one message at a
+        time.  The same thread rules as register_message_handler()
+        apply.
+        """
+        command_ids = set(command_ids)
+        if terminator_id is not None:
+            command_ids.add(terminator_id)
+        for command_id in command_ids | set(flush_ids):
+            if command_id not in self.message_handlers:
+                raise KeyError("No such command ID %r" % command_id)
+        batch = MessageBatch(command_ids, handler_fn, terminator_id, window_secs)
+        self.batches.append(batch)
+        for command_id in command_ids:
+            self.batches_by_id.setdefault(command_id, [ ]).append(batch)
+        for command_id in flush_ids:
+            self.batches_flushed_by.setdefault(command_id, [ ]).append(batch)
+
+    def deliver_batch(self, batch):
+        msgs = batch.take()
+        self.logger.debug("Delivering batch of %d messages to %r",
+                              len(msgs), batch.handler_fn)
+        try:
+            batch.handler_fn(msgs)
+        except Exception, ex:
+            self.logger.error("Problem handling batch of %d messages: %r", len(msgs), ex)
+            self.logger.error(traceback.format_exc())
+
+    def deliver_expired_batches(self):
+        now = time.time()
+        for batch in self.batches:
+            if batch.is_expired(now):
+                self.deliver_batch(batch)
+
+    def register_periodic_handler(self, handler_fn, interval_secs=1.0):
+        """
+        *handler_fn* will be called with no arguments from the
+        message loop, about every *interval_secs* seconds.  It runs
+        in the message loop thread, so should not take long.
+        """
+        self.periodic_handlers.append([handler_fn, interval_secs, time.time() + interval_secs])
+
+    def run_periodic_handlers(self):
+        now = time.time()
+        for entry in self.periodic_handlers:
+            handler_fn, interval_secs, next_at = entry
+            if now < next_at:
+                continue
+            entry[2] = now + interval_secs
+            try:
+                handler_fn()
+            except Exception, ex:
+                self.logger.error("Problem in periodic handler %r: %r", handler_fn, ex)
+                self.logger.error(traceback.format_exc())
+
+    def enable_zone_coalescing(self, window_secs, flap_count, flap_secs):
+        """
+        Pass ZONE_STATUS messages through a ZoneStatusCoalescer
+        before handing them to handlers; see concord_coalesce for the
+        meaning of the arguments.  A *window_secs* of 0 turns
+        coalescing off.
+
+        May be called from any thread, e.g. whenever the settings
+        are saved.  The message loop makes the change: new settings
+        apply to the zones already being tracked, and turning
+        coalescing off first delivers the messages held back and the
+        latest state of any flapping zones.
+        """
+        if window_secs <= 0:
+            window_secs, flap_count, flap_secs = 0, 0, 0
+        self.zone_coalescing_wanted = (window_secs, flap_count, flap_secs)
+
+    def update_zone_coalescing(self):
+        wanted = self.zone_coalescing_wanted
+        if wanted == self.zone_coalescing:
+            return
+        window_secs, flap_count, flap_secs = wanted
+        coalescer = self.zone_coalescer
+        if window_secs <= 0:
+            self.zone_coalescer = None
+            for decoded_command in coalescer.release(time.time()):
+                self.deliver_message('ZONE_STATUS', decoded_command)
+        elif coalescer is None:
+            self.zone_coalescer = ZoneStatusCoalescer(window_secs, flap_count, flap_secs)
+        else:
+            coalescer.window_secs = window_secs
+            coalescer.flap_count = flap_count
+            coalescer.flap_secs = flap_secs
+        self.zone_coalescing = wanted
+
+    def deliver_expired_zone_status(self):
+        self.update_zone_coalescing()
+        if self.zone_coalescer is None:
+            return
+        for decoded_command in self.zone_coalescer.expire(time.time()):
+            self.deliver_message('ZONE_STATUS', decoded_command)
+
     def ctrl_char_cb(self, cc):
-        self.logger.debug_verbose("Ctrl char %r" % cc)
+        self.logger.debug_verbose("Ctrl char %r", cc)
         if cc == ACK:
             if self.tx_pending is None:
                 self.logger.debug("Spurious ACK")
@@ -282,7 +495,7 @@ class AlarmPanelInterface(object):
                 self.logger.debug("Possible NAK")
                 self.maybe_resend_message("NAK")
         else:
-            self.logger.info("Unknown control char 0x%02x" % cc)
+            self.logger.info("Unknown control char 0x%02x", cc)
 
     def tx_timeout_exceded(self):
         assert self.tx_pending is not None
@@ -303,19 +516,19 @@ class AlarmPanelInterface(object):
         self.tx_pending = msg
         if retry:
             self.tx_num_attempts += 1
-            self.logger.warn("Resending message, attempt %d: %r" % \
-                                  (self.tx_num_attempts, encode_message_to_ascii(msg)))
+            self.logger.warn("Resending message, attempt %d: %r",
+                                  self.tx_num_attempts, encode_message_to_ascii(msg))
         else:
             self.tx_num_attempts = 1
-            self.logger.debug("Sending message (retry=%d) %r" % \
-                     (self.tx_num_attempts, encode_message_to_ascii(msg)))
+            self.logger.debug("Sending message (retry=%d) %r",
+                     self.tx_num_attempts, lazy(encode_message_to_ascii, msg))
         self.tx_time = datetime.now()
         self.serial_interface.write_message(msg)
 
     def maybe_resend_message(self, reason):
         if self.tx_num_attempts >= MAX_RESENDS:
-            self.logger.error("Unable to send message (%s), too many attempts (%d): %r" % \
-                                  (reason, MAX_RESENDS, encode_message_to_ascii(self.tx_pending)))
+            self.logger.error("Unable to send message (%s), too many attempts (%d): %r",
+                                  reason, MAX_RESENDS, encode_message_to_ascii(self.tx_pending))
             self.reset_pending_tx()
         else:
             self.send_message(self.tx_pending, retry=True)
@@ -351,6 +564,7 @@ class AlarmPanelInterface(object):
         
         loop_start_at = datetime.now()
         loop_last_print_at = datetime.now()
+        self.update_zone_coalescing()
 
         while True:
             # Two parts to loop body: 1) look for and handle any
@@ -366,47 +580,41 @@ class AlarmPanelInterface(object):
             # 
             # Handle any synthetic messages and loop them back to us.
             #
-            if not self.fake_rx_queue.empty():
+            while not self.fake_rx_queue.empty():
                 no_inputs = False
                 msg = self.fake_rx_queue.get()
                 self.logger.debug("Received synthetic message")
                 # Don't need to confirm checksum as we computed it
                 # ourselves!
-                self.handle_message(msg)
+                self.enqueue_msg_for_dispatch(msg)
 
             # 
-            # Handle incoming messages.
+            # Read incoming messages.  Read everything that is
+            # already waiting (up to a limit) before handling any of
+            # it, so that an alarm doesn't wait behind routine
+            # messages that arrived just before it.
             #
             # Two part test: the first part will fail right away if
             # there no characters, regardless of the timeout, so we
             # minimize time waiting on messages that won't arrive.
-            if self.serial_interface.message_chars_maybe_available() \
+            num_read = 0
+            while num_read < MAX_RX_BURST \
+                    and self.serial_interface.message_chars_maybe_available() \
                     and self.serial_interface.wait_for_message_start() == MSG_START:
                 no_inputs = False
+                num_read += 1
+                msg = self.read_message()
+                if msg is not None:
+                    self.enqueue_msg_for_dispatch(msg)
 
-                msg_ok = True
-                try:
-                    msg = self.serial_interface.read_next_message()
-                except CommException, ex:
-                    self.send_nak()
-                    self.logger.error(repr(ex))
-                    continue
-
-                msg_time = datetime.now()
-
-                if len(msg) < 3:
-                    # Message too short, need at least length byte,
-                    # command byte, and checksum byte.
-                    self.send_nak()
-                    self.logger.error("Message too short: %r" % encode_message_to_ascii(msg))
-
-                if validate_message_checksum(msg):
-                    self.send_ack()
-                    self.handle_message(msg)
-                else:
-                    # Bad checksum
-                    self.send_nak()
-                    self.logger.error("Bad checksum for message %r" % encode_message_to_ascii(msg))
+            #
+            # Handle received messages: all the priority ones, then
+            # one routine one before going back to look for more
+            # input.
+            #
+            self.dispatch_pending_messages()
+            if len(self.rx_routine) > 0:
+                no_inputs = False
 
             # TODO: check here if there is pending input and handle it
             # by looping again, before worrying about sending out any
@@ -429,10 +637,15 @@ class AlarmPanelInterface(object):
                     # messages have been sent.  Because we close it,
                     # we can't rerun message_loop(); we have to create
                     # a new AlarmPanelInterface instance.
+                    self.dispatch_pending_messages(routine_limit=None)
                     self.serial_interface.close()
                     return
                 self.send_message(msg)
 
+            self.deliver_expired_batches()
+            self.deliver_expired_zone_status()
+            self.run_periodic_handlers()
+
             # If there was nothing to do on this pass through the
             # loop, take a nap...
             if no_inputs and no_outputs:
@@ -440,12 +653,105 @@ class AlarmPanelInterface(object):
 
             secs_since_print = total_secs(datetime.now() - loop_last_print_at)
             if secs_since_print > 20:
-                self.logger.debug_verbose("Looping %d" % \
-                                              total_secs(datetime.now() - loop_start_at))
+                self.logger.debug_verbose("Looping %d",
+                                              lazy(total_secs, datetime.now() - loop_start_at))
                 loop_last_print_at = datetime.now()
 
 
-    def handle_message(self, msg):
+    def read_message(self):
+        """
+        Read the rest of a message after the message-start character,
+        and ACK or NAK it.  Returns the binary message, or None if
+        the message was bad.
+        """
+        try:
+            msg = self.serial_interface.read_next_message()
+        except CommException, ex:
+            self.send_nak()
+            self.logger.error(repr(ex))
+            return None
+
+        if len(msg) < 3:
+            # Message too short, need at least length byte,
+            # command byte, and checksum byte.
+            self.send_nak()
+            self.logger.error("Message too short: %r", encode_message_to_ascii(msg))
+            return None
+
+        if not validate_message_checksum(msg):
+            # Bad checksum
+            self.send_nak()
+            self.logger.error("Bad checksum for message %r", encode_message_to_ascii(msg))
+            return None
+
+        self.send_ack()
+        return msg
+
+    def is_priority_message(self, msg):
+        return len(msg) > 3 and (msg[1], msg[2]) in self.priority_commands
+
+    def enqueue_msg_for_dispatch(self, msg):
+        entry = (time.time(), msg)
+        if self.is_priority_message(msg):
+            self.rx_priority.append(entry)
+        else:
+            self.rx_routine.append(entry)
+
+    def dispatch_pending_messages(self, routine_limit=1):
+        """
+        Handle every message on the priority queue, then up to
+        *routine_limit* routine messages (all of them if None).
+        """
+        while len(self.rx_priority) > 0:
+            received_at, msg = self.rx_priority.popleft()
+            self.dispatch_latency['priority'].add(time.time() - received_at)
+            self.handle_message(msg, received_at)
+        n = 0
+        while len(self.rx_routine) > 0 and (routine_limit is None or n < routine_limit):
+            received_at, msg = self.rx_routine.popleft()
+            self.dispatch_latency['routine'].add(time.time() - received_at)
+            self.handle_message(msg, received_at)
+            n += 1
+
+    def is_touchpad_clock_only(self, msg):
+        """
+        Returns True if TOUCHPAD *msg* is the same as the previous one
+        for its partition except for digits in the display text,
+        i.e. it is just the panel's once-a-minute clock update.
+        """
+        part_num = msg[3]
+        data = msg[4:-1] # area, message type, text tokens
+        prev = self.last_touchpad.get(part_num)
+        self.last_touchpad[part_num] = data
+        if prev is None or len(prev) != len(data) or prev[:2] != data[:2]:
+            return False
+        for a, b in izip(prev, data):
+            if a != b and (a > MAX_DIGIT_TOKEN or b > MAX_DIGIT_TOKEN):
+                return False
+        return True
+
+    def handle_touchpad_clock(self, msg, received_at):
+        """
+        Minimal handling for a clock-only TOUCHPAD message: handlers
+        get just the partition number and new display text, marked
+        with 'clock_only'.
+        """
+        self.touchpad_clock_only_count += 1
+        decoded_command = { 'command_id': 'TOUCHPAD',
+                            'partition_number': msg[3],
+                            'display_text': decode_text_tokens(msg[6:-1]),
+                            'clock_only': True,
+                            'received_at': received_at or time.time(),
+                            'frame': msg }
+        try:
+            for handler in self.message_handlers['TOUCHPAD']:
+                handler(decoded_command)
+        except Exception, ex:
+            self.logger.error("Problem handling command %r\n%r",
+                                  ex, encode_message_to_ascii(msg))
+            self.logger.error(traceback.format_exc())
+
+    def handle_message(self, msg, received_at=None):
         # Assume we have a good message here.  Command code will
         # either be one or two bytes at offset 1.
         cmd1 = msg[1]
@@ -455,38 +761,72 @@ class AlarmPanelInterface(object):
 
         # self.log("Handle message %r" % encode_message_to_ascii(msg))
 
+        if (cmd1, cmd2) == TOUCHPAD_COMMAND and len(msg) > 6 \
+                and self.is_touchpad_clock_only(msg):
+            self.handle_touchpad_clock(msg, received_at)
+            return
+
         if cmd1 in RX_COMMANDS:
             command = cmd1
-            cmd_str = "0x%02x" % command
         elif (cmd1, cmd2) in RX_COMMANDS:
             command = (cmd1, cmd2)
-            cmd_str = "0x%02x/0x%02x" % (command[0], command[1])
         else:
-            self.logger.error("Unknown command for message %r" % encode_message_to_ascii(msg))
+            self.logger.error("Unknown command for message %r", encode_message_to_ascii(msg))
             return
 
         command_id, command_name, command_parser = RX_COMMANDS[command]
         if command_parser is None:
-            self.logger.debug_verbose("No parser for command %s %s" % (command_name, command_id))
+            self.logger.debug_verbose("No parser for command %s %s", command_name, command_id)
             return
 
-        self.logger.debug_verbose("Handling command %s %s, %s" % \
-                                      (cmd_str, command_id, command_parser.__name__))
+        self.logger.debug_verbose("Handling command %s %s, %s",
+                                      lazy(command_str, command), command_id,
+                                      command_parser.__name__)
         
         try:
             decoded_command = command_parser(msg)
             decoded_command['command_id'] = command_id
-            self.logger.debug_verbose(repr(decoded_command))
-            if len(self.message_handlers[command_id]) == 0:
-                self.logger.debug_verbose("No handlers for command %s" % command_id)
+            decoded_command['received_at'] = received_at or time.time()
+            # Kept so the message can be logged compactly.
+            decoded_command['frame'] = msg
+            self.logger.debug_verbose("%r", decoded_command)
+        except Exception, ex:
+            self.logger.error("Problem handling command %r\n%r",
+                                  ex, encode_message_to_ascii(msg))
+            self.logger.error(traceback.format_exc())
+            return
+
+        if command_id == 'ZONE_STATUS' and self.zone_coalescer is not None:
+            to_deliver = self.zone_coalescer.add(decoded_command, time.time())
+            if len(to_deliver) == 0:
+                self.logger.debug_verbose("Holding back zone status for zone %d",
+                                              decoded_command['zone_number'])
+        else:
+            to_deliver = [ decoded_command ]
+        for decoded_command in to_deliver:
+            self.deliver_message(command_id, decoded_command)
+
+    def deliver_message(self, command_id, decoded_command):
+        """ Hand a parsed message to the handlers for *command_id*. """
+        try:
+            for batch in self.batches_flushed_by.get(command_id, ()):
+                if len(batch.messages) > 0:
+                    self.deliver_batch(batch)
+            batches = self.batches_by_id.get(command_id, ())
+            if len(self.message_handlers[command_id]) == 0 and len(batches) == 0:
+                self.logger.debug_verbose("No handlers for command %s", command_id)
             for handler in self.message_handlers[command_id]:
-                self.logger.debug_verbose("Calling handler %r" % handler)
+                self.logger.debug_verbose("Calling handler %r", handler)
                 handler(decoded_command)
+            for batch in batches:
+                batch.add(decoded_command)
+                if command_id == batch.terminator_id:
+                    self.deliver_batch(batch)
         
-            self.logger.debug_verbose("Finished handling command %s" % command_id)
+            self.logger.debug_verbose("Finished handling command %s", command_id)
         except Exception, ex:
-            self.logger.error("Problem handling command %r\n%r" % \
-                                  (ex, encode_message_to_ascii(msg)))
+            self.logger.error("Problem handling command %s %r\n%r",
+                                  command_id, ex, decoded_command)
             self.logger.error(traceback.format_exc())
 
 
@@ -499,6 +839,12 @@ class AlarmPanelInterface(object):
         msg = build_cmd_equipment_list(request_type=0)
         self.enqueue_msg_for_tx(msg)
 
+    def request_equipment(self, eqpt_type):
+        """ *eqpt_type* is a key of EQPT_LIST_REQ_TYPES, e.g. 'PART_DATA'. """
+        req = EQPT_LIST_REQ_TYPES[eqpt_type]
+        msg = build_cmd_equipment_list(request_type=req)
+        self.enqueue_msg_for_tx(msg)
+
     def request_zones(self):
         req = EQPT_LIST_REQ_TYPES['ZONE_DATA']
         msg = build_cmd_equipment_list(request_type=req)
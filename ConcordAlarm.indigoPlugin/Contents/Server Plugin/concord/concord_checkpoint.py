@@ -0,0 +1,112 @@
+"""
+Reconstruction of the zone and partition state as it was at any
+past moment, for looking into incidents.
+
+A client keeps a journal of every message it merges into its
+PanelState, as event log records in a SegmentedLog, and writes a
+checkpoint of the whole state every so often.  To rebuild the state
+at time T, the newest checkpoint before T is loaded and only the
+journalled messages from then until T are parsed again and merged.
+"""
+
+from bisect import bisect_right
+import os
+import re
+import time
+
+from concord_eventlog import EventQuery, decode_event
+from concord_snapshot import StateSnapshot
+from concord_state import PanelState
+
+CHECKPOINT_SECS = 3600
+CHECKPOINT_RE = re.compile(r'^checkpoint-(?P<ms>\d+)\.json$')
+
+
+class Checkpoints(object):
+    """
+    Checkpoint files in *dir_path*, one per checkpoint, named by the
+    time (in ms) they were taken; see StateSnapshot for the format.
+    """
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.times = [ ] # sorted
+        self.num_written = 0
+
+    def scan(self):
+        if not os.path.isdir(self.dir_path):
+            os.makedirs(self.dir_path)
+        times = [ ]
+        for fname in os.listdir(self.dir_path):
+            m = CHECKPOINT_RE.match(fname)
+            if m is not None:
+                times.append(int(m.group('ms')) / 1000.0)
+        self.times = sorted(times)
+
+    def path_for(self, t):
+        return os.path.join(self.dir_path, 'checkpoint-%d.json' % int(t * 1000))
+
+    def write(self, zones, parts, t=None):
+        """ Raises IOError/OSError if the checkpoint can't be written. """
+        if t is None:
+            t = time.time()
+        t = int(t * 1000) / 1000.0
+        StateSnapshot(self.path_for(t)).save(zones, parts, t)
+        if len(self.times) == 0 or t > self.times[-1]:
+            self.times.append(t)
+        self.num_written += 1
+        return t
+
+    def last(self):
+        if len(self.times) == 0:
+            return None
+        return self.times[-1]
+
+    def nearest(self, t):
+        """ Time of the newest checkpoint taken at or before *t*, or None. """
+        i = bisect_right(self.times, t)
+        if i == 0:
+            return None
+        return self.times[i - 1]
+
+    def load(self, t):
+        """ Returns (zones, partitions) saved in the checkpoint taken at *t*. """
+        zones, parts, saved_at = StateSnapshot(self.path_for(t)).load()
+        return zones, parts
+
+    def prune(self, before):
+        """
+        Remove checkpoints older than *before*, apart from the newest
+        of them, which is still needed to rebuild the state at
+        *before*.
+        """
+        i = bisect_right(self.times, before) - 1
+        for t in self.times[:max(0, i)]:
+            try:
+                os.remove(self.path_for(t))
+            except OSError:
+                pass
+        self.times = self.times[max(0, i):]
+
+
+def reconstruct(checkpoints, journal, t, logger=None):
+    """
+    Returns (PanelState as of time *t*, time of the checkpoint it was
+    built from, number of messages replayed).  *journal* is the
+    SegmentedLog the messages were written to.  Raises ValueError if
+    there is no checkpoint from before *t*.
+    """
+    checkpoint_at = checkpoints.nearest(t)
+    if checkpoint_at is None:
+        raise ValueError("No checkpoint from before %s" % time.ctime(t))
+    zones, parts = checkpoints.load(checkpoint_at)
+    state = PanelState(logger)
+    state.restore(zones, parts)
+    n = 0
+    with state.batch():
+        for rec in journal.query(EventQuery(start=checkpoint_at, end=t)):
+            msg = decode_event(rec[1], rec[4])
+            if not isinstance(msg, dict) or 'parse_error' in msg:
+                continue
+            if state.apply_message(msg) is not None:
+                n += 1
+    return state, checkpoint_at, n
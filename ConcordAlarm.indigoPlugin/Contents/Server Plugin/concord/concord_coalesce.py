@@ -0,0 +1,156 @@
+"""
+Coalescing of bursts of ZONE_STATUS messages, and quarantine of
+zones that keep flapping between tripped and not tripped.
+"""
+
+from collections import deque
+
+from concord_commands import ZONE_TRIPPED
+
+# Defaults
+COALESCE_WINDOW_SECS = 2.0
+FLAP_COUNT = 8
+FLAP_SECS = 60.0
+
+
+class _ZoneTrack(object):
+    __slots__ = ('last_msg', 'delivered_state', 'held', 'num_held',
+                 'window_end', 'transitions', 'flapping', 'num_flaps')
+
+    def __init__(self):
+        self.last_msg = None # most recent message for the zone
+        self.delivered_state = None # zone state of last delivered message
+        self.held = None # latest message held back in this window
+        self.num_held = 0 # messages collapsed into the held one
+        self.window_end = None
+        self.transitions = deque() # times of recent messages
+        self.flapping = False
+        self.num_flaps = 0 # messages suppressed while flapping
+
+
+class ZoneStatusCoalescer(object):
+    """
+    Per-zone coalescing stage for ZONE_STATUS messages.
+
+    The first change for a zone is delivered right away, and opens a
+    window of *window_secs*.  Further tripped/not-tripped changes
+    during the window are collapsed: when the window closes, only the
+    latest is delivered, with 'coalesced' set to the number of
+    earlier messages that were dropped.  Changes to any other zone
+    flag (alarm, trouble etc.) are always delivered right away.
+
+    A zone with *flap_count* messages within *flap_secs* seconds is
+    flapping.  One message, with 'flapping' set to 'start', is
+    delivered; after that its tripped changes are only counted.  Once
+    the zone has been quiet for *flap_secs*, its latest state is
+    delivered with 'flapping' set to 'end' and 'flap_transitions'
+    set to the number of messages suppressed.  A *flap_count* of 0
+    turns flap detection off.
+
+    The settings may be changed between calls by setting the
+    attributes of the same names.
+
+    Messages passed in are dicts as produced by cmd_zone_status().
+    """
+    def __init__(self, window_secs=COALESCE_WINDOW_SECS,
+                 flap_count=FLAP_COUNT, flap_secs=FLAP_SECS):
+        self.window_secs = window_secs
+        self.flap_count = flap_count
+        self.flap_secs = flap_secs
+        self.zones = { } # (partition, zone) -> _ZoneTrack
+        self.num_coalesced = 0
+        self.num_flap_suppressed = 0
+
+    def num_flapping(self):
+        return len([z for z in self.zones.itervalues() if z.flapping])
+
+    def add(self, msg, now):
+        """ Returns list of messages to be delivered now. """
+        zk = (msg['partition_number'], msg['zone_number'])
+        z = self.zones.get(zk)
+        if z is None:
+            z = self.zones[zk] = _ZoneTrack()
+        z.last_msg = msg
+        z.transitions.append(now)
+        while z.transitions[0] < now - self.flap_secs:
+            z.transitions.popleft()
+
+        zone_state = msg['zone_state']
+        tripped_only = z.delivered_state is not None and \
+            (zone_state ^ z.delivered_state) & ~ZONE_TRIPPED == 0
+
+        if not tripped_only:
+            return self._deliver(z, msg, now)
+
+        if z.flapping:
+            z.num_flaps += 1
+            self.num_flap_suppressed += 1
+            return [ ]
+
+        if self.flap_count > 0 and len(z.transitions) >= self.flap_count:
+            z.flapping = True
+            z.num_flaps = 0
+            msg['flapping'] = 'start'
+            return self._deliver(z, msg, now)
+
+        if z.window_end is None or now >= z.window_end:
+            return self._deliver(z, msg, now)
+
+        z.held = msg
+        z.num_held += 1
+        self.num_coalesced += 1
+        return [ ]
+
+    def _deliver(self, z, msg, now):
+        if z.held is not None and z.held is not msg:
+            # Superseded by this message
+            msg['coalesced'] = z.num_held
+        z.held = None
+        z.num_held = 0
+        z.window_end = now + self.window_secs
+        z.delivered_state = msg['zone_state']
+        return [ msg ]
+
+    def expire(self, now):
+        """
+        Returns list of messages to be delivered because their
+        window has closed, or their zone stopped flapping.
+        """
+        msgs = [ ]
+        for z in self.zones.itervalues():
+            if z.flapping:
+                if now - z.transitions[-1] >= self.flap_secs:
+                    msgs.extend(self._end_flapping(z, now))
+            elif z.window_end is not None and now >= z.window_end:
+                if z.held is not None:
+                    msgs.extend(self._deliver_held(z, now))
+                else:
+                    z.window_end = None
+        return msgs
+
+    def release(self, now):
+        """
+        Returns list of messages to be delivered when coalescing is
+        turned off: every held message, and the latest state of every
+        flapping zone.
+        """
+        msgs = [ ]
+        for z in self.zones.itervalues():
+            if z.flapping:
+                msgs.extend(self._end_flapping(z, now))
+            elif z.held is not None:
+                msgs.extend(self._deliver_held(z, now))
+        return msgs
+
+    def _end_flapping(self, z, now):
+        z.flapping = False
+        msg = z.last_msg.copy()
+        msg['flapping'] = 'end'
+        msg['flap_transitions'] = z.num_flaps
+        return self._deliver(z, msg, now)
+
+    def _deliver_held(self, z, now):
+        msg = z.held
+        msg['coalesced'] = z.num_held - 1
+        z.held = None
+        return self._deliver(z, msg, now)
@@ -204,26 +204,111 @@ def cmd_automation_event_lost(msg):
     return { }
 
 
+class StateFlags(int):
+    """
+    A bitmask of state flags exactly as sent by the panel.  It is an
+    int, so flags are tested and combined with ordinary bit operations
+    (e.g. ``zone_state & ZONE_TRIPPED``), but it also knows the names
+    of the bits that are set.
+
+    Subclasses must call _init_flag_class() to fill in the name
+    tables; names and instances are precomputed for every possible
+    value so nothing is built per message.
+    """
+    __slots__ = ()
+
+    FLAGS = { } # bit value -> state name
+    MASK = 0
+    _NAMES = ( ) # bitmask value -> tuple of state names
+    _VALUES = ( ) # bitmask value -> shared instance
+
+    def __new__(cls, value=0):
+        return int.__new__(cls, int(value) & cls.MASK)
+
+    @classmethod
+    def _init_flag_class(cls, flags):
+        cls.FLAGS = flags
+        cls.MASK = reduce(lambda a, b: a | b, flags.keys(), 0)
+        sorted_flags = sorted(flags.iteritems())
+        cls._NAMES = tuple(tuple(name for bit, name in sorted_flags if bit & v)
+                           for v in range(cls.MASK + 1))
+        cls._VALUES = tuple(int.__new__(cls, v) for v in range(cls.MASK + 1))
+
+    @classmethod
+    def from_code(cls, code):
+        """ Shared instance for *code*; no allocation. """
+        return cls._VALUES[code & cls.MASK]
+
+    @classmethod
+    def from_names(cls, names):
+        v = 0
+        for bit, name in cls.FLAGS.iteritems():
+            if name in names:
+                v |= bit
+        return cls._VALUES[v]
+
+    @property
+    def names(self):
+        return self._NAMES[self]
+
+    def __and__(self, other):
+        return self._VALUES[int(self) & int(other) & self.MASK]
+    __rand__ = __and__
+
+    def __or__(self, other):
+        return self._VALUES[(int(self) | int(other)) & self.MASK]
+    __ror__ = __or__
+
+    def __xor__(self, other):
+        return self._VALUES[(int(self) ^ int(other)) & self.MASK]
+    __rxor__ = __xor__
+
+    def __invert__(self):
+        return self._VALUES[~int(self) & self.MASK]
+
+    def __iter__(self):
+        return iter(self._NAMES[self])
+
+    def __len__(self):
+        return len(self._NAMES[self])
+
+    def __contains__(self, flag):
+        """ *flag* may be a bit value or a state name. """
+        if isinstance(flag, basestring):
+            return flag in self._NAMES[self]
+        return int(self) & flag == flag
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, '|'.join(self._NAMES[self]))
+
+
 TRIPPED = 'Tripped'
 FAULTED = 'Faulted'
 ALARM   = 'Alarm'
 TROUBLE = 'Trouble'
 BYPASSED = 'Bypassed'
 
+ZONE_TRIPPED  = 0x01
+ZONE_FAULTED  = 0x02
+ZONE_ALARM    = 0x04
+ZONE_TROUBLE  = 0x08
+ZONE_BYPASSED = 0x10
+
 ZONE_STATES = {
-    0x01: TRIPPED,
-    0x02: FAULTED,
-    0x04: ALARM,
-    0x08: TROUBLE,
-    0x10: BYPASSED,
+    ZONE_TRIPPED: TRIPPED,
+    ZONE_FAULTED: FAULTED,
+    ZONE_ALARM: ALARM,
+    ZONE_TROUBLE: TROUBLE,
+    ZONE_BYPASSED: BYPASSED,
 }
 
-def build_state_list(state_code, state_dict):
-    states = [ ]
-    for bitval, state_name in sorted(state_dict.iteritems()):
-        if bitval & state_code:
-            states.append(state_name)
-    return states
+# Any of these flags means the zone needs attention.
+ZONE_ERR_STATES = ZONE_ALARM | ZONE_FAULTED | ZONE_TROUBLE | ZONE_BYPASSED
+
+class ZoneState(StateFlags):
+    __slots__ = ()
+
+ZoneState._init_flag_class(ZONE_STATES)
 
 
 # Concord zone types only
@@ -239,7 +324,7 @@ def cmd_zone_status(msg):
     d = { 'partition_number': msg[2],
           'area_number': msg[3],
           'zone_number': (msg[4] << 8) + msg[5],
-          'zone_state': build_state_list(msg[6], ZONE_STATES)
+          'zone_state': ZoneState.from_code(msg[6])
           }
     return d;
 
@@ -251,7 +336,7 @@ def cmd_zone_data(msg):
           'group_number': msg[4],
           'zone_number': (msg[5] << 8) + msg[6],
           'zone_type': ZONE_TYPES.get(msg[7], 'Unknown'),
-          'zone_state': build_state_list(msg[8], ZONE_STATES),
+          'zone_state': ZoneState.from_code(msg[8]),
           'zone_text': '',
           'zone_text_tokens': [ ],
           }
@@ -476,12 +561,17 @@ FEAT_STATES = {
     0x20: 'Quick arm',
 }
 
+class FeatureState(StateFlags):
+    __slots__ = ()
+
+FeatureState._init_flag_class(FEAT_STATES)
+
 def cmd_feat_state(msg):
     assert (msg[1], msg[2]) == (0x22, 0x0c), "Unexpected command type"
     ck_msg_len(msg, (0x22, 0x0c), 0x06)
     d = { 'partition_number': msg[3],
           'area_number': msg[4],
-          'feature_state': build_state_list(msg[5], FEAT_STATES),
+          'feature_state': FeatureState.from_code(msg[5]),
           }
     return d;
 
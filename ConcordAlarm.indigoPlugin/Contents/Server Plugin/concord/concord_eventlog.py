@@ -0,0 +1,653 @@
+"""
+Compact in-memory store for the client's event log.
+
+Events are kept in a ring of preallocated arrays, one per field,
+rather than as a dict per event.  Panel messages are stored as the
+raw frame received from the panel, and only parsed again when the
+event is read back, so a logged event costs a few dozen bytes
+rather than a dict of a dozen entries.
+
+EventLog puts an EventStore of recent events in front of an
+optional on-disk SegmentedLog holding the full history.
+"""
+
+from array import array
+from bisect import bisect_left
+import json
+import struct
+import sys
+import threading
+import time
+
+from concord_commands import RX_COMMANDS, ZoneState
+from concord_snapshot import encode_info, decode_info
+
+# Event type codes
+EV_TEXT = 1 # payload: text, utf-8 encoded if it was unicode
+EV_MESSAGE = 2 # payload: raw panel frame
+EV_ZONE = 3 # payload: zone change header, zone name, raw panel frame
+EV_DICT = 4 # payload: JSON
+EV_MESSAGE_EXTRA = 5 # payload: extras header, JSON extras, raw panel frame
+
+EVENT_TYPE_NAMES = { EV_TEXT: 'text', EV_MESSAGE: 'message',
+                     EV_ZONE: 'zone', EV_DICT: 'dict',
+                     EV_MESSAGE_EXTRA: 'message+' }
+
+# Zone change descriptions, stored as their index.
+ZONE_EVENT_MESSAGES = ('Zone update message',
+                       'Zone monitor / Zone update message')
+
+# Zone change header: previous zone state (NO_STATE if not known),
+# description code, length of zone name.
+ZONE_HEADER = struct.Struct('BBB')
+NO_STATE = 0xff
+
+# Panel message extras header: length of the JSON extras.
+EXTRA_HEADER = struct.Struct('<H')
+
+# No partition or zone.  Partition numbers are kept in signed
+# shorts and zone numbers in signed ints, wide enough for any
+# partition byte or 16-bit zone number as well as NO_ENTITY.
+NO_ENTITY = -1
+PART_TYPECODE = 'h'
+ZONE_TYPECODE = 'i'
+
+# Default limits on the number of events kept.
+INITIAL_CAPACITY = 1024
+MAX_ENTRIES = 200000
+
+# Events a query looks at per hold of the EventLog lock.
+QUERY_CHUNK = 512
+
+# Approximate memory per event: the array slots and list pointer,
+# and the payload string object's own overhead.
+SLOT_BYTES = 8 + 1 + 2 + 4 + 8
+PAYLOAD_OVERHEAD = sys.getsizeof('')
+
+
+def encode_frame(frame):
+    return str(bytearray(frame))
+
+def decode_frame(payload):
+    """ Parse stored panel frame *payload*, as AlarmPanelInterface does. """
+    frame = list(bytearray(payload))
+    key = frame[1]
+    if key not in RX_COMMANDS and len(frame) > 3:
+        key = (frame[1], frame[2])
+    if key not in RX_COMMANDS or RX_COMMANDS[key][2] is None:
+        return { 'command_id': 'UNKNOWN', 'frame': frame }
+    command_id, command_name, command_parser = RX_COMMANDS[key]
+    try:
+        d = command_parser(frame)
+    except Exception, ex:
+        return { 'command_id': command_id, 'frame': frame, 'parse_error': str(ex) }
+    d['command_id'] = command_id
+    return d
+
+def frame_command_id(payload):
+    """ Command ID of stored panel frame *payload*, without parsing it. """
+    if len(payload) < 2:
+        return None
+    key = ord(payload[1])
+    if key not in RX_COMMANDS and len(payload) > 3:
+        key = (key, ord(payload[2]))
+    if key not in RX_COMMANDS:
+        return None
+    return RX_COMMANDS[key][0]
+
+def record_command_id(type_code, payload):
+    """ The panel command an event is about, or None. """
+    if type_code == EV_MESSAGE:
+        return frame_command_id(payload)
+    elif type_code == EV_ZONE:
+        name_len = ord(payload[ZONE_HEADER.size - 1])
+        return frame_command_id(payload[ZONE_HEADER.size + name_len:])
+    elif type_code == EV_MESSAGE_EXTRA:
+        extra_len, = EXTRA_HEADER.unpack_from(payload)
+        return frame_command_id(payload[EXTRA_HEADER.size + extra_len:])
+    elif type_code == EV_DICT:
+        d = json.loads(payload)
+        command_id = d.get('command', d.get('command_id'))
+        if command_id is None:
+            return None
+        return str(command_id)
+    return None
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def _entity(d):
+    part_num = d.get('partition_number', NO_ENTITY)
+    zone_num = d.get('zone_number', NO_ENTITY)
+    if not isinstance(part_num, int):
+        part_num = NO_ENTITY
+    if not isinstance(zone_num, int):
+        zone_num = NO_ENTITY
+    return part_num, zone_num
+
+def encode_event(info):
+    """
+    Returns (type code, partition number, zone number, payload) for
+    event *info*, which is a string, a panel message dict or some
+    other dict.  Panel messages are stored as their 'frame', so
+    anything else added to them is lost; see encode_message_event().
+    """
+    if isinstance(info, basestring):
+        return EV_TEXT, NO_ENTITY, NO_ENTITY, _utf8(info)
+    part_num, zone_num = _entity(info)
+    if info.get('frame') is not None:
+        return EV_MESSAGE, part_num, zone_num, encode_frame(info['frame'])
+    return EV_DICT, part_num, zone_num, json.dumps(encode_info(info), separators=(',', ':'))
+
+def encode_message_event(msg, extra):
+    """
+    As for encode_event(), for panel message *msg* with dict *extra*
+    of details the client added, which the frame doesn't carry.
+    """
+    if msg.get('frame') is None:
+        info = dict(msg)
+        info.update(extra)
+        return encode_event(info)
+    part_num, zone_num = _entity(msg)
+    extra = json.dumps(encode_info(extra), separators=(',', ':'))
+    if len(extra) > 0xffff:
+        raise ValueError("Event extras too long: %d bytes" % len(extra))
+    return EV_MESSAGE_EXTRA, part_num, zone_num, \
+        EXTRA_HEADER.pack(len(extra)) + extra + encode_frame(msg['frame'])
+
+def encode_zone_event(zone_name, prev_zone_state, message, msg):
+    """ As for encode_event(), for a zone change caused by panel message *msg*. """
+    if msg.get('frame') is None or message not in ZONE_EVENT_MESSAGES:
+        return encode_event({ 'zone_name': zone_name,
+                              'zone_state': msg['zone_state'],
+                              'prev_zone_state': prev_zone_state,
+                              'message': message,
+                              'command': msg['command_id'],
+                              'command_data': msg })
+    if prev_zone_state is None:
+        prev_zone_state = NO_STATE
+    zone_name = _utf8(zone_name)[:255]
+    header = ZONE_HEADER.pack(int(prev_zone_state), ZONE_EVENT_MESSAGES.index(message),
+                              len(zone_name))
+    return EV_ZONE, msg['partition_number'], msg['zone_number'], \
+        header + zone_name + encode_frame(msg['frame'])
+
+def decode_event(type_code, payload):
+    """ The event as originally logged: a string or dict. """
+    if type_code == EV_TEXT:
+        return payload
+    elif type_code == EV_MESSAGE:
+        return decode_frame(payload)
+    elif type_code == EV_ZONE:
+        prev_code, message_code, name_len = ZONE_HEADER.unpack_from(payload)
+        name_end = ZONE_HEADER.size + name_len
+        msg = decode_frame(payload[name_end:])
+        if prev_code == NO_STATE:
+            prev_zone_state = None
+        else:
+            prev_zone_state = ZoneState.from_code(prev_code)
+        return { 'zone_name': payload[ZONE_HEADER.size:name_end],
+                 'zone_state': msg.get('zone_state'),
+                 'prev_zone_state': prev_zone_state,
+                 'message': ZONE_EVENT_MESSAGES[message_code],
+                 'command': msg['command_id'],
+                 'command_data': msg }
+    elif type_code == EV_MESSAGE_EXTRA:
+        extra_len, = EXTRA_HEADER.unpack_from(payload)
+        extra_end = EXTRA_HEADER.size + extra_len
+        msg = decode_frame(payload[extra_end:])
+        msg.update(decode_info(json.loads(payload[EXTRA_HEADER.size:extra_end])))
+        return msg
+    elif type_code == EV_DICT:
+        return decode_info(json.loads(payload))
+    raise ValueError("Unknown event type %r" % type_code)
+
+
+class EventQuery(object):
+    """
+    Which events to find: those with *start* <= time < *end*, about
+    partition *part_num* (including its zones) or zone (*part_num*,
+    *zone_num*), for one of *command_ids*.  Any of these may be None
+    to match everything.
+    """
+    def __init__(self, start=None, end=None, part_num=None, zone_num=None,
+                 command_ids=None):
+        if zone_num is not None and part_num is None:
+            raise ValueError("A zone query needs a partition number")
+        self.start = start
+        self.end = end
+        self.part_num = part_num
+        self.zone_num = zone_num
+        if command_ids is not None:
+            command_ids = frozenset(command_ids)
+        self.command_ids = command_ids
+
+    def matches(self, rec):
+        """ *rec* is (time, type code, partition, zone, payload). """
+        t, type_code, part_num, zone_num, payload = rec
+        if (self.start is not None and t < self.start) or \
+                (self.end is not None and t >= self.end):
+            return False
+        if self.part_num is not None and part_num != self.part_num:
+            return False
+        if self.zone_num is not None and zone_num != self.zone_num:
+            return False
+        if self.command_ids is not None and \
+                record_command_id(type_code, payload) not in self.command_ids:
+            return False
+        return True
+
+    def describe(self):
+        v = [ ]
+        if self.start is not None:
+            v.append("from %s" % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start)))
+        if self.end is not None:
+            v.append("until %s" % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.end)))
+        if self.zone_num is not None:
+            v.append("zone %d/%d" % (self.part_num, self.zone_num))
+        elif self.part_num is not None:
+            v.append("partition %d" % self.part_num)
+        if self.command_ids is not None:
+            v.append("commands %s" % ', '.join(sorted(self.command_ids)))
+        return ', '.join(v) or 'all events'
+
+
+class _TimeKeys(object):
+    # Sequence view of an EventStore's times, oldest first, for bisect.
+    def __init__(self, store):
+        self.store = store
+    def __len__(self):
+        return self.store.count
+    def __getitem__(self, n):
+        return self.store.times[(self.store.head + n) % self.store.capacity]
+
+
+class EventStore(object):
+    """
+    Ring buffer of events, oldest first.  Each event is a time (secs
+    since the epoch), an event type code, the partition and zone
+    numbers it concerns (NO_ENTITY if none) and an encoded payload;
+    see encode_event().
+
+    The arrays start at *initial_capacity* events and double as
+    needed up to *max_entries*; after that, each new event replaces
+    the oldest.  If *max_bytes* is set, the oldest events are also
+    dropped to keep nbytes() within it.  Events older than
+    *max_age_secs*, if set, are dropped by expire().  Events must be
+    appended in time order.
+
+    Not thread-safe; the client must serialise access.
+    """
+    def __init__(self, max_age_secs=None, max_entries=MAX_ENTRIES, max_bytes=None,
+                 initial_capacity=INITIAL_CAPACITY):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.max_age_secs = max_age_secs
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.num_dropped_entries = 0 # dropped to stay within max_entries
+        self.num_dropped_bytes = 0 # dropped to stay within max_bytes
+        self.num_expired = 0
+        self.num_popped = 0 # events ever dropped, for event ids
+        self._alloc(self._initial_capacity(initial_capacity))
+
+    def _initial_capacity(self, capacity):
+        capacity = min(capacity, self.max_entries)
+        if self.max_bytes is not None:
+            capacity = min(capacity, max(1, self.max_bytes // SLOT_BYTES))
+        return capacity
+
+    def _alloc(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.types = array('B', [0]) * capacity
+        self.part_nums = array(PART_TYPECODE, [NO_ENTITY]) * capacity
+        self.zone_nums = array(ZONE_TYPECODE, [NO_ENTITY]) * capacity
+        self.payloads = [None] * capacity
+        self.head = 0 # slot of oldest event
+        self.count = 0
+        self.payload_bytes = 0 # including PAYLOAD_OVERHEAD each
+
+    def __len__(self):
+        return self.count
+
+    def num_dropped(self):
+        return self.num_dropped_entries + self.num_dropped_bytes
+
+    def clear(self):
+        self.num_popped += self.count
+        self._alloc(self._initial_capacity(INITIAL_CAPACITY))
+
+    def _resize(self, new_capacity):
+        # Lay the ring out again from slot 0, in *new_capacity* slots.
+        assert self.count <= new_capacity
+        h = self.head
+        end = h + self.count
+        if end <= self.capacity:
+            spans = [(h, end)]
+        else:
+            spans = [(h, self.capacity), (0, end - self.capacity)]
+        extra = new_capacity - self.count
+        def relayout(a, fill):
+            v = a[0:0]
+            for i, j in spans:
+                v += a[i:j]
+            return v + fill * extra
+        self.times = relayout(self.times, array('d', [0.0]))
+        self.types = relayout(self.types, array('B', [0]))
+        self.part_nums = relayout(self.part_nums, array(PART_TYPECODE, [NO_ENTITY]))
+        self.zone_nums = relayout(self.zone_nums, array(ZONE_TYPECODE, [NO_ENTITY]))
+        self.payloads = relayout(self.payloads, [None])
+        self.head = 0
+        self.capacity = new_capacity
+
+    def _pop_oldest(self):
+        h = self.head
+        self.payload_bytes -= len(self.payloads[h]) + PAYLOAD_OVERHEAD
+        self.payloads[h] = None
+        self.head = (h + 1) % self.capacity
+        self.count -= 1
+        self.num_popped += 1
+
+    def _fits(self, capacity, extra_bytes):
+        return self.max_bytes is None or \
+            capacity * SLOT_BYTES + self.payload_bytes + extra_bytes <= self.max_bytes
+
+    def set_limits(self, max_entries, max_bytes):
+        """ Change the caps, dropping the oldest events if need be. """
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        while self.count > max_entries:
+            self._pop_oldest()
+            self.num_dropped_entries += 1
+        capacity = min(self.capacity, max_entries)
+        if max_bytes is not None:
+            capacity = min(capacity, max(1, max_bytes // SLOT_BYTES))
+        while self.count > 0 and (self.count > capacity or not self._fits(capacity, 0)):
+            self._pop_oldest()
+            self.num_dropped_bytes += 1
+        if capacity != self.capacity:
+            self._resize(capacity)
+
+    def append(self, t, type_code, part_num, zone_num, payload):
+        size = len(payload) + PAYLOAD_OVERHEAD
+        while self.count > 0 and not self._fits(self.capacity, size):
+            self._pop_oldest()
+            self.num_dropped_bytes += 1
+        if self.count == self.capacity:
+            new_capacity = min(self.capacity * 2, self.max_entries)
+            if new_capacity > self.capacity and self._fits(new_capacity, size):
+                self._resize(new_capacity)
+            else:
+                self._pop_oldest()
+                if new_capacity > self.capacity:
+                    self.num_dropped_bytes += 1
+                else:
+                    self.num_dropped_entries += 1
+        i = (self.head + self.count) % self.capacity
+        self.times[i] = t
+        self.types[i] = type_code
+        self.part_nums[i] = part_num
+        self.zone_nums[i] = zone_num
+        self.payloads[i] = payload
+        self.payload_bytes += size
+        self.count += 1
+
+    def add(self, info, t=None):
+        """ Encode and append event *info*; see encode_event(). """
+        if t is None:
+            t = time.time()
+        self.append(t, *encode_event(info))
+
+    def expire(self, now=None):
+        """ Drop events older than max_age_secs; returns how many. """
+        if self.max_age_secs is None:
+            return 0
+        if now is None:
+            now = time.time()
+        cutoff = now - self.max_age_secs
+        n = 0
+        while self.count > 0 and self.times[self.head] < cutoff:
+            self._pop_oldest()
+            n += 1
+        self.num_expired += n
+        return n
+
+    def record(self, n):
+        """ (time, type code, partition, zone, payload) of the *n*th oldest event. """
+        if n < 0:
+            n += self.count
+        if not 0 <= n < self.count:
+            raise IndexError("Event index out of range")
+        i = (self.head + n) % self.capacity
+        return (self.times[i], self.types[i], self.part_nums[i],
+                self.zone_nums[i], self.payloads[i])
+
+    def records(self):
+        for n in xrange(self.count):
+            yield self.record(n)
+
+    def __iter__(self):
+        """ (time, decoded event) for each event, oldest first. """
+        for t, type_code, part_num, zone_num, payload in self.records():
+            yield t, decode_event(type_code, payload)
+
+    def query(self, q):
+        """ Records matching EventQuery *q*, oldest first. """
+        first = 0
+        if q.start is not None:
+            first = bisect_left(_TimeKeys(self), q.start)
+        for n in xrange(first, self.count):
+            i = (self.head + n) % self.capacity
+            if q.end is not None and self.times[i] >= q.end:
+                break
+            if q.part_num is not None and self.part_nums[i] != q.part_num:
+                continue
+            if q.zone_num is not None and self.zone_nums[i] != q.zone_num:
+                continue
+            rec = self.record(n)
+            if q.matches(rec):
+                yield rec
+
+    def oldest_time(self):
+        if self.count == 0:
+            return None
+        return self.times[self.head]
+
+    def first_id(self, start=None):
+        """
+        Id of the oldest event at or after *start*, or of the next
+        event to be appended if there is none.  Ids number every
+        event ever appended, so an id stays valid while older events
+        are dropped; an id below num_popped has itself been dropped.
+        """
+        n = 0
+        if start is not None:
+            n = bisect_left(_TimeKeys(self), start)
+        return self.num_popped + n
+
+    def query_chunk(self, q, first_id, max_events=QUERY_CHUNK):
+        """
+        Records matching EventQuery *q*, looking at no more than
+        *max_events* events from id *first_id* on, which mustn't
+        have been dropped.  Returns (records, id to go on from, True
+        if there are no more to look at).
+        """
+        n = first_id - self.num_popped
+        if n < 0:
+            raise IndexError("Event %d has been dropped" % first_id)
+        recs = [ ]
+        stop = min(self.count, n + max_events)
+        while n < stop:
+            i = (self.head + n) % self.capacity
+            if q.end is not None and self.times[i] >= q.end:
+                return recs, self.num_popped + n, True
+            n += 1
+            if q.part_num is not None and self.part_nums[i] != q.part_num:
+                continue
+            if q.zone_num is not None and self.zone_nums[i] != q.zone_num:
+                continue
+            rec = self.record(n - 1)
+            if q.matches(rec):
+                recs.append(rec)
+        return recs, self.num_popped + n, n >= self.count
+
+    def nbytes(self):
+        """ Approximate memory used, including the preallocated slots. """
+        return self.capacity * SLOT_BYTES + self.payload_bytes
+
+    def stats_str(self):
+        return "%d events, %d KB, %d expired, %d dropped for the entry limit, %d for the size limit" % \
+            (self.count, self.nbytes() / 1024, self.num_expired,
+             self.num_dropped_entries, self.num_dropped_bytes)
+
+
+class _QueryCursor(object):
+    # How far a query has got: the time of the last record returned,
+    # and how many matching records with that time were returned.
+    # Records are returned again when a query goes back to disk for
+    # events dropped from memory; filter() skips those.
+    def __init__(self):
+        self.t = None
+        self.n = 0
+
+    def filter(self, recs):
+        """ The records of time-ordered *recs* not yet returned. """
+        seen = 0 # records with time self.t so far
+        for rec in recs:
+            if self.t is not None and rec[0] <= self.t:
+                if rec[0] < self.t:
+                    continue
+                seen += 1
+                if seen <= self.n:
+                    continue
+                self.n = seen
+            else:
+                self.t = rec[0]
+                self.n = seen = 1
+            yield rec
+
+
+class EventLog(object):
+    """
+    An event log: the recent events in an EventStore, and if *disk*
+    (a started SegmentedLog) is given, every event on disk as well.
+
+    With a disk log, events are retired from disk a segment at a
+    time by its max_age_secs, and the memory store only keeps as
+    many as it has room for; without one, the memory store expires
+    events itself by its max_age_secs.
+
+    Methods may be called from any thread.
+    """
+    def __init__(self, store=None, disk=None):
+        if store is None:
+            store = EventStore()
+        self.store = store
+        self.disk = disk
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.store)
+
+    def set_max_age(self, max_age_secs):
+        self.store.max_age_secs = max_age_secs
+        if self.disk is not None:
+            self.disk.max_age_secs = max_age_secs
+
+    def set_limits(self, max_entries, max_bytes):
+        """ Caps on the events kept in memory; see EventStore. """
+        with self.lock:
+            self.store.set_limits(max_entries, max_bytes)
+
+    def usage(self):
+        """ (events in memory, approximate bytes, events dropped for the caps so far) """
+        with self.lock:
+            return len(self.store), self.store.nbytes(), self.store.num_dropped()
+
+    def add(self, record, t=None):
+        """ Add *record*, as returned by encode_event(). """
+        if t is None:
+            t = time.time()
+        with self.lock:
+            self.store.append(t, *record)
+            if self.disk is None:
+                self.store.expire(t)
+            else:
+                self.disk.append(t, *record)
+
+    def records(self, start=None, end=None):
+        """
+        (time, type code, partition, zone, payload) for events with
+        *start* <= time < *end*, oldest first.  Events no longer in
+        memory are read from disk.
+        """
+        return self.query(EventQuery(start, end))
+
+    def __iter__(self):
+        """ (time, decoded event) for each event, oldest first. """
+        for rec in self.records():
+            yield rec[0], decode_event(rec[1], rec[4])
+
+    def query(self, q):
+        """
+        Records matching EventQuery *q*, oldest first, read lazily,
+        so that results can be streamed.  The lock is only held to
+        read QUERY_CHUNK events from memory at a time.  Events older
+        than those in memory are read from disk, as are any dropped
+        from memory while the query is under way.
+        """
+        cursor = _QueryCursor()
+        while True:
+            start = q.start if cursor.t is None else cursor.t
+            if self.disk is not None:
+                self.disk.flush()
+            with self.lock:
+                mem_start = self.store.oldest_time()
+                next_id = self.store.first_id(start)
+            if self.disk is not None and (mem_start is None or start is None or start <= mem_start):
+                # Up to and including mem_start, as events with that
+                # time may have been dropped from memory already.
+                for rec in cursor.filter(self._disk_records(q, start, mem_start)):
+                    yield rec
+            dropped = [ False ]
+            for rec in cursor.filter(self._memory_records(q, next_id, dropped)):
+                yield rec
+            if not dropped[0]:
+                return
+
+    def _disk_records(self, q, start, last):
+        disk_q = EventQuery(start, q.end, q.part_num, q.zone_num, q.command_ids)
+        for rec in self.disk.query(disk_q):
+            if last is not None and rec[0] > last:
+                return
+            yield rec
+
+    def _memory_records(self, q, next_id, dropped):
+        # Sets dropped[0] if it gets to events no longer in memory.
+        while True:
+            with self.lock:
+                if next_id < self.store.num_popped:
+                    dropped[0] = True
+                    return
+                recs, next_id, done = self.store.query_chunk(q, next_id)
+            for rec in recs:
+                yield rec
+            if done:
+                return
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats_str(self):
+        s = "in memory %s" % self.store.stats_str()
+        if self.disk is not None:
+            s += "; on disk %s" % self.disk.stats_str()
+        return s
@@ -21,3 +21,76 @@ def total_secs(td):
     return td.days*3600*24 + td.seconds + td.microseconds/1.0e6
 
 
+class LRUCache(object):
+    """
+    Small least-recently-used cache.  Entries live in two generations:
+    a hit in the current generation is a single dict lookup; a hit in
+    the previous generation promotes the entry.  When the current
+    generation fills up it becomes the previous one, so whatever was
+    not used during a whole generation is dropped.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.curr = { }
+        self.prev = { }
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        v = self.curr.get(key, default)
+        if v is default:
+            v = self.prev.get(key, default)
+            if v is default:
+                self.misses += 1
+                return default
+            self.put(key, v)
+        self.hits += 1
+        return v
+
+    def put(self, key, value):
+        if len(self.curr) >= self.max_size:
+            self.prev = self.curr
+            self.curr = { }
+        self.curr[key] = value
+
+    def clear(self):
+        self.curr = { }
+        self.prev = { }
+
+    def __len__(self):
+        return len(self.curr) + len(self.prev)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def stats_str(self):
+        return "%d entries, %d hits, %d misses, %.1f%% hit rate" % \
+            (len(self), self.hits, self.misses, 100.0 * self.hit_rate())
+
+
+class LatencyStats(object):
+    """ Running count, mean, max and last value of a latency, in seconds. """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, secs):
+        self.count += 1
+        self.total += secs
+        self.last = secs
+        if secs > self.max:
+            self.max = secs
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def stats_str(self):
+        return "%d samples, last %.1f ms, mean %.1f ms, max %.1f ms" % \
+            (self.count, 1000*self.last, 1000*self.mean(), 1000*self.max)
@@ -0,0 +1,297 @@
+"""
+Long-term history of zone states and partition arming levels, for
+charting activity over months.
+
+Each zone and partition has a series: a pair of append-only arrays
+of transition times (float64) and states (uint8; the zone state
+flags, or the arming level code), recording only the changes.  A
+series is kept on disk in chunks of CHUNK_ENTRIES transitions, one
+file per chunk; full chunks are written once, and only the last,
+partly filled chunk is rewritten by later saves.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+import os
+import re
+import struct
+import sys
+import threading
+
+CHUNK_ENTRIES = 4096
+
+# Chunk file: header of magic, version and entry count, then the
+# times and then the states, little-endian.
+CHUNK_MAGIC = 'CTS1'
+CHUNK_VERSION = 1
+CHUNK_HEADER = struct.Struct('<4sBxxxI')
+CHUNK_RE = re.compile(r'^(?P<name>[a-z]+(-\d+)+)\.(?P<index>\d{6})\.chunk$')
+
+
+def zone_series(zone_key):
+    """ Series name for zone key (partition number, zone number). """
+    return 'zone-%d-%d' % zone_key
+
+def partition_series(part_num):
+    return 'partition-%d' % part_num
+
+
+def _to_disk(a):
+    if sys.byteorder != 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tostring()
+
+def _from_disk(typecode, s):
+    a = array(typecode)
+    a.fromstring(s)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+class Series(object):
+    """ Transitions of one zone or partition, oldest first. """
+    __slots__ = ('name', 'times', 'states', 'saved')
+
+    def __init__(self, name):
+        self.name = name
+        self.times = array('d')
+        self.states = array('B')
+        self.saved = 0 # entries on disk
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, t, state):
+        """ Returns True if *state* is a change. """
+        if len(self.states) > 0:
+            if self.states[-1] == state:
+                return False
+            # Keep the times sorted, whatever the clock does.
+            t = max(t, self.times[-1])
+        self.times.append(t)
+        self.states.append(state)
+        return True
+
+    def state_at(self, t):
+        """ State at time *t*, or None if before the first transition. """
+        i = bisect_right(self.times, t) - 1
+        if i < 0:
+            return None
+        return self.states[i]
+
+    def transitions(self, start=None, end=None):
+        """ List of (time, state) for transitions in [start, end). """
+        i = 0 if start is None else bisect_left(self.times, start)
+        j = len(self.times) if end is None else bisect_left(self.times, end)
+        return zip(self.times[i:j], self.states[i:j])
+
+    def downsample(self, start, end, step_secs):
+        """
+        Yields (bucket start, state at the end of the bucket, OR of
+        all states in the bucket, number of transitions in the
+        bucket) for each *step_secs* bucket from *start* until *end*.
+        The OR shows e.g. a door that was opened and closed again
+        within the bucket.
+        """
+        i = bisect_left(self.times, start)
+        state = self.state_at(start)
+        t = start
+        while t < end:
+            bucket_end = min(t + step_secs, end)
+            seen = state or 0
+            n = 0
+            while i < len(self.times) and self.times[i] < bucket_end:
+                if self.times[i] >= t:
+                    seen |= self.states[i]
+                    n += 1
+                state = self.states[i]
+                i += 1
+            yield t, state, seen, n
+            t = bucket_end
+
+
+class TimeSeriesStore(object):
+    """
+    Zone and partition series, persisted in chunks under *dir_path*.
+    record() is meant to be called from the panel message thread,
+    and save() periodically; queries may come from any thread.
+    """
+    def __init__(self, dir_path, logger=None, chunk_entries=CHUNK_ENTRIES):
+        self.dir_path = dir_path
+        self.logger = logger
+        self.chunk_entries = chunk_entries
+        self.lock = threading.Lock()
+        self.series = { } # name -> Series
+        self.dirty = set() # names of series with unsaved transitions
+        self.num_chunks_written = 0
+
+    def load(self):
+        """ Read the series saved by earlier runs. """
+        if not os.path.isdir(self.dir_path):
+            os.makedirs(self.dir_path)
+        chunks = { } # name -> [(index, file name)]
+        for fname in os.listdir(self.dir_path):
+            m = CHUNK_RE.match(fname)
+            if m is not None:
+                chunks.setdefault(m.group('name'), [ ]).append((int(m.group('index')), fname))
+        with self.lock:
+            for name, files in chunks.iteritems():
+                series = Series(name)
+                for index, fname in sorted(files):
+                    if index * self.chunk_entries != len(series):
+                        # A missing or short chunk; what follows can't be placed.
+                        if self.logger is not None:
+                            self.logger.warn("History %s: chunk %s out of place, ignoring the rest",
+                                             name, fname)
+                        break
+                    if not self._read_chunk(series, os.path.join(self.dir_path, fname)):
+                        break
+                series.saved = len(series)
+                self.series[name] = series
+
+    def _read_chunk(self, series, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            magic, version, n = CHUNK_HEADER.unpack_from(data)
+        except struct.error:
+            magic, version, n = None, None, 0
+        size = CHUNK_HEADER.size + 9 * n
+        if magic != CHUNK_MAGIC or version != CHUNK_VERSION or len(data) < size:
+            if self.logger is not None:
+                self.logger.warn("History: %s is not a valid chunk, ignoring it and the rest",
+                                 path)
+            return False
+        times_end = CHUNK_HEADER.size + 8 * n
+        series.times.extend(_from_disk('d', data[CHUNK_HEADER.size:times_end]))
+        series.states.extend(_from_disk('B', data[times_end:times_end + n]))
+        return True
+
+    def record(self, name, t, state):
+        """ Add a transition to series *name*; returns True if it was a change. """
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                series = self.series[name] = Series(name)
+            if not series.append(t, state):
+                return False
+            self.dirty.add(name)
+            return True
+
+    def record_zone(self, zone_key, t, zone_state):
+        return self.record(zone_series(zone_key), t, int(zone_state))
+
+    def record_partition(self, part_num, t, arming_level_code):
+        return self.record(partition_series(part_num), t, arming_level_code)
+
+    def save(self):
+        """
+        Write out the chunks with unsaved transitions: any newly
+        filled chunks, and the current partial one.  A series only
+        counts as saved as far as its chunks were written, so a
+        failed chunk is written again next time.  Raises the first
+        IOError/OSError, once the other series have been tried.
+        """
+        with self.lock:
+            todo = [ ]
+            for name in sorted(self.dirty):
+                series = self.series[name]
+                n = len(series)
+                first = series.saved // self.chunk_entries
+                last = (n - 1) // self.chunk_entries
+                for index in range(first, last + 1):
+                    lo = index * self.chunk_entries
+                    hi = min(n, lo + self.chunk_entries)
+                    todo.append((name, index, series.times[lo:hi], series.states[lo:hi], hi))
+        error = None
+        failed = set()
+        for name, index, times, states, hi in todo:
+            if name in failed:
+                # Later chunks can't count as saved before this one.
+                continue
+            try:
+                self._write_chunk(name, index, times, states)
+            except (IOError, OSError), ex:
+                failed.add(name)
+                error = error or ex
+                continue
+            with self.lock:
+                series = self.series[name]
+                series.saved = max(series.saved, hi)
+                if series.saved == len(series):
+                    self.dirty.discard(name)
+        if error is not None:
+            raise error
+
+    def _write_chunk(self, name, index, times, states):
+        path = os.path.join(self.dir_path, '%s.%06d.chunk' % (name, index))
+        # Write then rename, so a crash never leaves a partial file.
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(CHUNK_HEADER.pack(CHUNK_MAGIC, CHUNK_VERSION, len(times)))
+            f.write(_to_disk(times))
+            f.write(_to_disk(states))
+        os.rename(tmp_path, path)
+        self.num_chunks_written += 1
+
+    def names(self):
+        with self.lock:
+            return sorted(self.series)
+
+    def _get(self, name):
+        series = self.series.get(name)
+        if series is None:
+            raise KeyError("No history for %s" % name)
+        return series
+
+    def state_at(self, name, t):
+        with self.lock:
+            return self._get(name).state_at(t)
+
+    def transitions(self, name, start=None, end=None):
+        with self.lock:
+            return self._get(name).transitions(start, end)
+
+    def downsample(self, name, start, end, step_secs):
+        """
+        List of the buckets, as for Series.downsample().  The lock
+        is only held to copy the transitions needed, not while the
+        buckets are worked out.
+        """
+        with self.lock:
+            series = self._get(name)
+            copy = Series(name)
+            i = max(0, bisect_right(series.times, start) - 1)
+            j = bisect_left(series.times, end)
+            copy.times = series.times[i:j]
+            copy.states = series.states[i:j]
+        return list(copy.downsample(start, end, step_secs))
+
+    def first_time(self):
+        with self.lock:
+            times = [s.times[0] for s in self.series.itervalues() if len(s) > 0]
+        return min(times) if times else None
+
+    def export_csv(self, f, start, end, step_secs, names=None):
+        """
+        Write the downsampled series *names* (default all) to file
+        *f* as CSV; returns the number of rows.
+        """
+        f.write("time,series,state,states_seen,transitions\n")
+        n = 0
+        if names is None:
+            names = self.names()
+        for name in names:
+            for t, state, seen, count in self.downsample(name, start, end, step_secs):
+                f.write("%.0f,%s,%s,%d,%d\n" % (t, name, '' if state is None else state,
+                                                 seen, count))
+                n += 1
+        return n
+
+    def stats_str(self):
+        with self.lock:
+            n = sum(len(s) for s in self.series.itervalues())
+            return "%d series, %d transitions (%d KB), %d unsaved series, %d chunk writes" % \
+                (len(self.series), n, n * 9 / 1024, len(self.dirty), self.num_chunks_written)
@@ -0,0 +1,407 @@
+"""
+Logging facade for the panel interface and the plugin.
+
+Messages are given as a %-style format plus arguments, and are only
+formatted if their level is enabled, so debug logging on the
+per-byte and per-message paths costs a comparison when it is off.
+Arguments that are expensive to compute can be wrapped in lazy() so
+they are also only computed when the message is logged, e.g.
+
+    logger.debug("Sent %s", lazy(encode_message_to_ascii, msg))
+
+Code that does more than build arguments for a log line can test
+is_enabled(level), or the debug_enabled / verbose_enabled
+attributes, first.
+
+Lines that can repeat endlessly can be given a repeat window with
+set_repeat_window(), by format or by panel command ID (passed as
+the command_id keyword argument).  The first occurrence is logged,
+repeats of the same format and arguments within the window are only
+counted, and a summary is logged when the window closes.
+
+A LogShipper moves the writing of messages off the calling thread,
+so that a slow log never holds up the panel message thread.
+"""
+
+from collections import deque
+import threading
+import time
+
+LOG_ERR    = 0
+LOG_WARN   = 1
+LOG_INFO   = 2
+LOG_DEBUG  = 3
+LOG_DEBUGV = 4 # verbose debug
+
+LOG_PREFIX = {
+    LOG_ERR: "ERROR",
+    LOG_WARN: "WARNING",
+    LOG_INFO: "INFO",
+    LOG_DEBUG: "DEBUG",
+    LOG_DEBUGV: "DEBUG VERBOSE",
+}
+
+
+class lazy(object):
+    """
+    A log message argument computed by calling fn(*args), only if
+    the message is actually logged.
+    """
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __call__(self):
+        return self.fn(*self.args)
+
+
+def format_message(msg, args):
+    """
+    Return *msg* formatted with *args*, evaluating any lazy()
+    arguments.  With no arguments *msg* is returned as is, so it may
+    contain a literal '%'.  A bad format is logged rather than raised,
+    since a typo in a log line shouldn't stop message handling.
+    """
+    if not args:
+        return msg
+    args = tuple(a() if isinstance(a, lazy) else a for a in args)
+    try:
+        return msg % args
+    except (TypeError, ValueError), ex:
+        return "%s %r (bad log format: %s)" % (msg, args, ex)
+
+
+class RepeatSuppressor(object):
+    """
+    Tracks repeats of log lines which have a repeat window; see
+    LazyLogger.set_repeat_window().  Each line is keyed on its format
+    and arguments, so lines with unhashable arguments always get
+    through.
+    """
+    def __init__(self):
+        self.template_secs = { } # format -> window
+        self.command_secs = { } # command ID -> window
+        self.lock = threading.Lock()
+        self.active = { } # key -> [window start, window end, repeats, level, text]
+        self.num_suppressed = 0
+        self.num_summaries = 0
+
+    def set_window(self, secs, template=None, command_id=None):
+        if command_id is not None:
+            windows, key = self.command_secs, command_id
+        else:
+            windows, key = self.template_secs, template
+        if secs > 0:
+            windows[key] = secs
+        else:
+            windows.pop(key, None)
+
+    def window_for(self, msg, command_id):
+        if command_id is not None and command_id in self.command_secs:
+            return self.command_secs[command_id]
+        return self.template_secs.get(msg, 0)
+
+    def check(self, msg, args, command_id, now):
+        """
+        Returns (key, window, summary) for a line about to be logged;
+        key is None if the line is a repeat to be suppressed, or has
+        no window.  *summary* is a (level, text) summary to log first
+        for an earlier window which has closed, or None.
+        """
+        secs = self.window_for(msg, command_id)
+        if secs <= 0:
+            return None, 0, None
+        key = (msg, command_id, args)
+        try:
+            hash(key)
+        except TypeError:
+            return None, 0, None
+        with self.lock:
+            entry = self.active.get(key)
+            if entry is None:
+                return key, secs, None
+            if now < entry[1]:
+                entry[2] += 1
+                self.num_suppressed += 1
+                return None, secs, None
+            del self.active[key]
+        return key, secs, self._summary(entry, now)
+
+    def started(self, key, secs, level, text, now):
+        with self.lock:
+            self.active[key] = [now, now + secs, 0, level, text]
+
+    def expire(self, now, close_all=False):
+        """
+        Returns summaries for windows which have closed, or for all
+        of them if *close_all*.
+        """
+        summaries = [ ]
+        with self.lock:
+            for key, entry in self.active.items():
+                if close_all or now >= entry[1]:
+                    del self.active[key]
+                    summary = self._summary(entry, now)
+                    if summary is not None:
+                        summaries.append(summary)
+        return summaries
+
+    def _summary(self, entry, now):
+        window_start, window_end, repeats, level, text = entry
+        if repeats == 0:
+            return None
+        self.num_summaries += 1
+        secs = min(now, window_end) - window_start
+        return level, "Repeated %d more times in %d seconds: %s" % (repeats, secs, text)
+
+    def stats_str(self):
+        return "%d repeats suppressed, %d summaries, %d windows open" % \
+            (self.num_suppressed, self.num_summaries, len(self.active))
+
+
+class LazyLogger(object):
+    """
+    Base logger with deferred formatting; subclasses implement
+    emit(level, text) to write out a formatted message, where
+    *level* is None for log_always().
+    """
+    def __init__(self, level=LOG_INFO):
+        self.set_level(level)
+        self.repeats = RepeatSuppressor()
+
+    def set_level(self, level):
+        assert level >= LOG_ERR and level <= LOG_DEBUGV
+        self.level = level
+        self.debug_enabled = level >= LOG_DEBUG
+        self.verbose_enabled = level >= LOG_DEBUGV
+
+    def is_enabled(self, level):
+        return level <= self.level
+
+    def set_repeat_window(self, secs, template=None, command_id=None):
+        """
+        Log repeats of lines with format *template*, or logged with
+        *command_id*, at most once per *secs* seconds; 0 turns it off.
+        A command ID's window takes precedence over the format's.
+        """
+        self.repeats.set_window(secs, template, command_id)
+
+    def flush_repeats(self, now=None, close_all=False):
+        """
+        Log summaries for repeat windows which have closed, or for
+        all of them if *close_all*, e.g. when shutting down.
+        """
+        for level, text in self.repeats.expire(now or time.time(), close_all):
+            self.emit(level, text)
+
+    def emit(self, level, text):
+        raise NotImplementedError()
+
+    def _log(self, level, msg, args, command_id):
+        if not self.repeats.template_secs and not self.repeats.command_secs:
+            self.emit(level, format_message(msg, args))
+            return
+        now = time.time()
+        key, secs, summary = self.repeats.check(msg, args, command_id, now)
+        if summary is not None:
+            self.emit(*summary)
+        if key is None and secs > 0:
+            return
+        text = format_message(msg, args)
+        if key is not None:
+            self.repeats.started(key, secs, level, text, now)
+        self.emit(level, text)
+
+    def log(self, msg, *args, **kwargs):
+        level = kwargs.get('level', LOG_INFO)
+        if level <= self.level:
+            self._log(level, msg, args, kwargs.get('command_id'))
+
+    def error(self, msg, *args, **kwargs):
+        self._log(LOG_ERR, msg, args, kwargs.get('command_id'))
+
+    def warn(self, msg, *args, **kwargs):
+        if self.level >= LOG_WARN:
+            self._log(LOG_WARN, msg, args, kwargs.get('command_id'))
+
+    def info(self, msg, *args, **kwargs):
+        if self.level >= LOG_INFO:
+            self._log(LOG_INFO, msg, args, kwargs.get('command_id'))
+
+    def debug(self, msg, *args, **kwargs):
+        if self.debug_enabled:
+            self._log(LOG_DEBUG, msg, args, kwargs.get('command_id'))
+
+    def debug_verbose(self, msg, *args, **kwargs):
+        if self.verbose_enabled:
+            self._log(LOG_DEBUGV, msg, args, kwargs.get('command_id'))
+
+    def log_always(self, msg, *args):
+        self.emit(None, format_message(msg, args))
+
+
+class LoggerAdapter(LazyLogger):
+    """
+    Wraps a logger that only takes preformatted strings (error,
+    warn, info, debug and debug_verbose methods) and does its own
+    level filtering, so everything is passed through to it.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        LazyLogger.__init__(self, LOG_DEBUGV)
+
+    def emit(self, level, text):
+        if level == LOG_ERR:
+            self.logger.error(text)
+        elif level == LOG_WARN:
+            self.logger.warn(text)
+        elif level == LOG_DEBUG:
+            self.logger.debug(text)
+        elif level == LOG_DEBUGV:
+            self.logger.debug_verbose(text)
+        else:
+            self.logger.info(text)
+
+
+def lazy_logger(logger):
+    """ Return *logger*, wrapped in a LoggerAdapter if need be. """
+    if isinstance(logger, LazyLogger):
+        return logger
+    return LoggerAdapter(logger)
+
+
+# What LogShipper.put() does when the queue is full: drop the oldest
+# queued message, drop the new one, or wait for room.
+OVERFLOW_DROP_OLDEST = 'dropOldest'
+OVERFLOW_DROP_NEWEST = 'dropNewest'
+OVERFLOW_WAIT = 'wait'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_WAIT)
+
+# Longest a put() waits for room with OVERFLOW_WAIT before dropping
+# the message anyway.
+OVERFLOW_WAIT_SECS = 1.0
+
+
+class LogShipper(object):
+    """
+    Delivers log messages from a background thread, in the order
+    they were put.  Messages wait in a queue of at most *queue_size*;
+    the thread takes up to *batch_size* at a time and calls
+    write_fn(batch), where batch is a list of (level, text).
+
+    When messages are dropped because the queue is full, a warning
+    saying how many is delivered in their place.
+    """
+    def __init__(self, write_fn, queue_size=1000, overflow=OVERFLOW_DROP_OLDEST,
+                 batch_size=50):
+        assert overflow in OVERFLOW_POLICIES
+        self.write_fn = write_fn
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.busy = False # the thread has a batch in hand
+        self.unreported_drops = 0
+        self.num_shipped = 0
+        self.num_batches = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+        self.max_depth = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="LogShipper")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        """ Deliver what's queued, then stop the thread. """
+        if self.thread is None:
+            return
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def put(self, level, text):
+        with self.cond:
+            if len(self.queue) >= self.queue_size:
+                if self.overflow == OVERFLOW_WAIT and self.running:
+                    deadline = time.time() + OVERFLOW_WAIT_SECS
+                    while len(self.queue) >= self.queue_size and self.running:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                if len(self.queue) >= self.queue_size:
+                    self.num_dropped += 1
+                    self.unreported_drops += 1
+                    if self.overflow != OVERFLOW_DROP_OLDEST:
+                        return
+                    self.queue.popleft()
+            self.queue.append((level, text))
+            if len(self.queue) > self.max_depth:
+                self.max_depth = len(self.queue)
+            self.cond.notify_all()
+
+    def flush(self, timeout=10):
+        """ Wait for everything queued so far to be delivered. """
+        deadline = time.time() + timeout
+        with self.cond:
+            while (self.queue or self.busy) and self.thread is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def depth(self):
+        return len(self.queue)
+
+    def _take_batch(self):
+        """ Wait for messages and take a batch; None once stopped. """
+        with self.cond:
+            while not self.queue and not self.unreported_drops and self.running:
+                self.cond.wait(1.0)
+            if not self.queue and not self.unreported_drops:
+                return None
+            batch = [ ]
+            while self.queue and len(batch) < self.batch_size:
+                batch.append(self.queue.popleft())
+            if self.unreported_drops:
+                batch.append((LOG_WARN, "%d log messages dropped, logging fell behind" % \
+                                  self.unreported_drops))
+                self.unreported_drops = 0
+            self.busy = True
+            # Wake up anyone waiting for room.
+            self.cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                break
+            try:
+                self.write_fn(batch)
+                self.num_shipped += len(batch)
+            except Exception:
+                # Nowhere left to log this.
+                self.num_failed += len(batch)
+            self.num_batches += 1
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def stats_str(self):
+        return "%d shipped in %d batches, %d dropped, %d failed, %d waiting (max %d)" % \
+            (self.num_shipped, self.num_batches, self.num_dropped, self.num_failed,
+             len(self.queue), self.max_depth)
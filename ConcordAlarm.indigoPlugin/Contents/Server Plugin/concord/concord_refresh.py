@@ -0,0 +1,178 @@
+"""
+Tracking of equipment list and dynamic data refreshes, so that
+repeated requests for a refresh join the one already in progress,
+and only the categories of equipment that need it are requested.
+"""
+
+import threading
+import time
+
+# Refresh categories -> equipment list message types that belong to
+# them; see EQPT_LIST_REQ_TYPES in concord_commands.
+REFRESH_CATEGORIES = {
+    'zones': ('ZONE_DATA',),
+    'partitions': ('PART_DATA',),
+    'superbus': ('BUS_DEV_DATA', 'BUS_CAP_DATA'),
+    'outputs': ('OUTPUT_DATA',),
+    'users': ('USER_DATA',),
+    'schedules': ('SCHED_DATA', 'EVENT_DATA'),
+    'lights': ('LIGHT_ATTACH',),
+}
+ALL_CATEGORIES = frozenset(REFRESH_CATEGORIES)
+
+# Equipment list message type -> refresh category
+CATEGORY_FOR_TYPE = dict((t, cat) for cat, types in REFRESH_CATEGORIES.iteritems()
+                         for t in types)
+
+# A refresh still in flight after this long is given up on.
+REFRESH_TIMEOUT_SECS = 60.0
+
+# The reply to a dynamic data refresh is ordinary messages, so there's
+# no telling when it's done; one asked for within this long of the
+# last joins it.
+DYNAMIC_JOIN_SECS = 5.0
+
+
+class RefreshManager(object):
+    """
+    Issues refresh requests to an AlarmPanelInterface *panel*.
+
+    request() sends the equipment list requests for the categories
+    asked for, unless they are already in flight, in which case the
+    request joins the refresh in progress.  A request for every
+    category goes out as a single full equipment list request;
+    otherwise each category is requested by itself.
+
+    The client calls batch_done() whenever it has handled a batch of
+    equipment list messages, which records when each category was
+    last fresh, and expire() periodically to give up on refreshes the
+    panel never answered.  The dynamic data isn't tracked that way:
+    a request for it joins only one sent within *dynamic_join_secs*.
+
+    Methods may be called from any thread.
+    """
+    def __init__(self, panel, logger, timeout_secs=REFRESH_TIMEOUT_SECS,
+                 dynamic_join_secs=DYNAMIC_JOIN_SECS):
+        self.panel = panel
+        self.logger = logger
+        self.timeout_secs = timeout_secs
+        self.dynamic_join_secs = dynamic_join_secs
+        self.lock = threading.Lock()
+        self.in_flight = { } # category -> time requested
+        self.dynamic_sent_at = None # time last requested, or None
+        self.fresh_at = { } # category -> time last refreshed
+        self.num_requested = 0 # categories requested from the panel
+        self.num_coalesced = 0 # categories already in flight when asked for
+        self.num_timeouts = 0
+
+    def is_busy(self):
+        return len(self.in_flight) > 0
+
+    def request(self, categories=None, dynamic=True, reason='', now=None):
+        """
+        Refresh *categories* (an iterable of REFRESH_CATEGORIES keys;
+        None for all of them), and also the dynamic data if *dynamic*
+        is True.  Returns the list of categories actually requested.
+        """
+        if categories is None:
+            categories = ALL_CATEGORIES
+        if now is None:
+            now = time.time()
+        with self.lock:
+            wanted = set(categories)
+            for cat in wanted:
+                if cat not in REFRESH_CATEGORIES:
+                    raise KeyError("No such refresh category %r" % cat)
+            needed = sorted(wanted - set(self.in_flight))
+            self.num_coalesced += len(wanted) - len(needed)
+            send_dynamic = dynamic and (self.dynamic_sent_at is None or
+                                        now - self.dynamic_sent_at >= self.dynamic_join_secs)
+            for cat in needed:
+                self.in_flight[cat] = now
+            if send_dynamic:
+                self.dynamic_sent_at = now
+            self.num_requested += len(needed)
+
+        if len(needed) == 0 and not send_dynamic:
+            self.logger.info("Refresh (%s) joined one already in progress", reason)
+            return needed
+
+        what = list(needed)
+        if send_dynamic:
+            what.append('dynamic data')
+        self.logger.info("Refreshing %s (%s)", ', '.join(what), reason)
+        if len(needed) == len(ALL_CATEGORIES):
+            self.panel.request_all_equipment()
+        else:
+            for cat in needed:
+                for eqpt_type in REFRESH_CATEGORIES[cat]:
+                    self.panel.request_equipment(eqpt_type)
+        if send_dynamic:
+            self.panel.request_dynamic_data_refresh()
+        return needed
+
+    def batch_done(self, command_ids, now=None):
+        """
+        A batch of equipment list messages with *command_ids* has
+        been handled.  Each category with messages in the batch is
+        now fresh; if the batch was ended by EQPT_LIST_DONE, the
+        panel has finished a full list, so everything in flight is
+        complete.  Returns the list of categories completed.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if 'EQPT_LIST_DONE' in command_ids:
+                completed = set(self.in_flight)
+            else:
+                completed = set()
+            for command_id in command_ids:
+                cat = CATEGORY_FOR_TYPE.get(command_id)
+                if cat is not None:
+                    completed.add(cat)
+            for cat in completed:
+                self.fresh_at[cat] = now
+                self.in_flight.pop(cat, None)
+        return sorted(completed)
+
+    def expire(self, now=None):
+        """ Give up on timed out refreshes; returns their categories. """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            expired = sorted(cat for cat, t in self.in_flight.iteritems()
+                             if now - t > self.timeout_secs)
+            for cat in expired:
+                del self.in_flight[cat]
+            if len(expired) > 0:
+                self.num_timeouts += 1
+        if len(expired) > 0:
+            self.logger.warn("No reply from panel to refresh of %s", ', '.join(expired))
+        return expired
+
+    def age(self, category, now=None):
+        """ Seconds since *category* was refreshed, or None if never. """
+        if now is None:
+            now = time.time()
+        t = self.fresh_at.get(category)
+        if t is None:
+            return None
+        return now - t
+
+    def freshness_str(self, now=None):
+        if now is None:
+            now = time.time()
+        v = [ ]
+        for cat in sorted(ALL_CATEGORIES):
+            age = self.age(cat, now)
+            if cat in self.in_flight:
+                v.append("%s in progress" % cat)
+            elif age is None:
+                v.append("%s never" % cat)
+            else:
+                v.append("%s %ds ago" % (cat, age))
+        return ', '.join(v)
+
+    def stats_str(self):
+        return "%d categories requested, %d joined a refresh in progress, %d timeouts" % \
+            (self.num_requested, self.num_coalesced, self.num_timeouts)
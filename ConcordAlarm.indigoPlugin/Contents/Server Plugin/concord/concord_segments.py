@@ -0,0 +1,632 @@
+"""
+Append-only on-disk event log, split into one file (segment) per
+hour or day, so old events can be retired a whole file at a time.
+
+Records are written by a background thread in batches, and the
+files fsynced at most every few seconds, so callers never wait on
+the disk.  Each record carries a CRC; a record torn by a crash is
+cut off when the log is next opened.
+
+Sealed segments, i.e. all but the one being written, may be gzip
+compressed.  Readers mmap uncompressed segments rather than reading
+them in.  Each sealed segment also gets an index (a .idx file next
+to it) of the times, partitions, zones and commands in it, so a
+query only reads the segments that can match.
+"""
+
+from bisect import bisect_left
+import gzip
+import json
+import mmap
+import os
+import Queue
+import re
+import struct
+import threading
+import time
+import traceback
+import zlib
+
+SEGMENT_SECS = { 'hour': 3600, 'day': 24 * 3600 }
+
+# Defaults
+FSYNC_SECS = 5.0
+QUEUE_SIZE = 10000 # records waiting to be written
+BATCH_SIZE = 500 # records per write
+WAIT_SECS = 10.0 # longest to wait for the writer thread
+
+# Record header: time, event type code, partition number, zone
+# number, payload length, CRC32 of the rest of the header and
+# the payload.  The partition (a signed short) and zone (a signed
+# int) hold any partition byte or 16-bit zone number, and -1 for
+# none.
+RECORD = struct.Struct('<dBhiHI')
+HEAD = struct.Struct('<dBhiH') # RECORD less the CRC
+CRC_OFFSET = RECORD.size - 4
+MAX_PAYLOAD = 0xffff
+
+# Index time buckets; a query starting part way through a segment
+# starts reading at the first record of its bucket.
+INDEX_BUCKET_SECS = 60
+
+# Queued in place of a record to have the writer thread delete the log.
+CLEAR = 'clear'
+
+
+def pack_record(t, type_code, part_num, zone_num, payload):
+    """ Raises struct.error if a number is out of range for the format. """
+    payload = payload[:MAX_PAYLOAD]
+    head = HEAD.pack(t, type_code, part_num, zone_num, len(payload))
+    crc = zlib.crc32(payload, zlib.crc32(head)) & 0xffffffff
+    return head + struct.pack('<I', crc) + payload
+
+def unpack_records(buf, offset=0):
+    """
+    Yields (offset, record) for each good record in *buf* from
+    *offset*, where record is (time, type code, partition, zone,
+    payload).  Stops at the first torn or corrupt record.
+    """
+    n = len(buf)
+    while offset + RECORD.size <= n:
+        t, type_code, part_num, zone_num, length, crc = RECORD.unpack_from(buf, offset)
+        end = offset + RECORD.size + length
+        if end > n:
+            return
+        payload = buf[offset + RECORD.size:end]
+        if zlib.crc32(payload, zlib.crc32(buf[offset:offset + CRC_OFFSET])) & 0xffffffff != crc:
+            return
+        yield offset, (t, type_code, part_num, zone_num, payload)
+        offset = end
+
+def valid_length(buf):
+    """ Length of the good records at the start of *buf*. """
+    end = 0
+    for offset, rec in unpack_records(buf):
+        end = offset + RECORD.size + len(rec[4])
+    return end
+
+
+class SegmentIndex(object):
+    """
+    What a sealed segment holds: the range of record times, the
+    partitions, zones and command IDs that appear, and the offset of
+    the first record in each INDEX_BUCKET_SECS of time.  *data_len*
+    is the length of the (uncompressed) records indexed.
+    """
+    def __init__(self):
+        self.data_len = 0
+        self.num_records = 0
+        self.min_time = None
+        self.max_time = None
+        self.part_nums = set()
+        self.zone_keys = set() # (partition, zone)
+        self.command_ids = set()
+        self.ordered = True # records are in time order
+        self.bucket_times = [ ]
+        self.bucket_offsets = [ ]
+
+    @classmethod
+    def build(cls, buf, command_id_fn):
+        """ *command_id_fn*(type code, payload) gives a record's command ID, or None. """
+        idx = cls()
+        last_t = None
+        for offset, (t, type_code, part_num, zone_num, payload) in unpack_records(buf):
+            idx.num_records += 1
+            idx.data_len = offset + RECORD.size + len(payload)
+            if last_t is not None and t < last_t:
+                idx.ordered = False
+            last_t = t
+            if idx.min_time is None or t < idx.min_time:
+                idx.min_time = t
+            if idx.max_time is None or t > idx.max_time:
+                idx.max_time = t
+            bucket = int(t // INDEX_BUCKET_SECS) * INDEX_BUCKET_SECS
+            if len(idx.bucket_times) == 0 or bucket > idx.bucket_times[-1]:
+                idx.bucket_times.append(bucket)
+                idx.bucket_offsets.append(offset)
+            if part_num >= 0:
+                idx.part_nums.add(part_num)
+                if zone_num >= 0:
+                    idx.zone_keys.add((part_num, zone_num))
+            command_id = command_id_fn(type_code, payload)
+            if command_id is not None:
+                idx.command_ids.add(command_id)
+        return idx
+
+    def to_dict(self):
+        return { 'data_len': self.data_len,
+                 'num_records': self.num_records,
+                 'min_time': self.min_time,
+                 'max_time': self.max_time,
+                 'part_nums': sorted(self.part_nums),
+                 'zone_keys': sorted(self.zone_keys),
+                 'command_ids': sorted(self.command_ids),
+                 'ordered': self.ordered,
+                 'bucket_times': self.bucket_times,
+                 'bucket_offsets': self.bucket_offsets }
+
+    @classmethod
+    def from_dict(cls, d):
+        idx = cls()
+        idx.data_len = d['data_len']
+        idx.num_records = d['num_records']
+        idx.min_time = d['min_time']
+        idx.max_time = d['max_time']
+        idx.part_nums = set(d['part_nums'])
+        idx.zone_keys = set(tuple(zk) for zk in d['zone_keys'])
+        idx.command_ids = set(str(c) for c in d['command_ids'])
+        idx.ordered = d['ordered']
+        idx.bucket_times = d['bucket_times']
+        idx.bucket_offsets = d['bucket_offsets']
+        return idx
+
+    def may_match(self, q):
+        """ False if no record in the segment can match query *q*. """
+        if self.num_records == 0:
+            return False
+        if q.start is not None and self.max_time < q.start:
+            return False
+        if q.end is not None and self.min_time >= q.end:
+            return False
+        if q.zone_num is not None:
+            if (q.part_num, q.zone_num) not in self.zone_keys:
+                return False
+        elif q.part_num is not None and q.part_num not in self.part_nums:
+            return False
+        if q.command_ids is not None and self.command_ids.isdisjoint(q.command_ids):
+            return False
+        return True
+
+    def seek_offset(self, start):
+        """ Offset to start reading from for records at or after *start*. """
+        if start is None or not self.ordered or len(self.bucket_times) == 0:
+            return 0
+        i = bisect_left(self.bucket_times, int(start // INDEX_BUCKET_SECS) * INDEX_BUCKET_SECS)
+        if i >= len(self.bucket_offsets):
+            return self.data_len
+        return self.bucket_offsets[i]
+
+
+class Segment(object):
+    """ One segment file, holding the records for [start, end). """
+    __slots__ = ('path', 'start', 'end', 'compressed', 'index')
+
+    def __init__(self, path, start, end, compressed):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.compressed = compressed
+        self.index = None # SegmentIndex once loaded
+
+    def index_path(self):
+        if self.compressed:
+            return self.path[:-len('.gz')] + '.idx'
+        return self.path + '.idx'
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def read(self):
+        """
+        The segment's contents: an mmap for an uncompressed file, or
+        a string once decompressed.  Empty if the file is gone.
+        """
+        try:
+            if self.compressed:
+                with gzip.open(self.path, 'rb') as f:
+                    return f.read()
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return ''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            # Retired or compressed while we were looking.
+            return ''
+
+    def records(self, offset=0):
+        buf = self.read()
+        try:
+            for offset, rec in unpack_records(buf, offset):
+                yield rec
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+
+class SegmentedLog(object):
+    """
+    Log of event records (time, type code, partition, zone, payload)
+    in *dir_path*, in files named <name>-<segment start>.seg, or .seg.gz
+    once compressed.
+
+    append() may be called from any thread; records are written by
+    the log's own thread, which start() starts.  Segments older
+    than *max_age_secs* (if set) are deleted.
+
+    *command_id_fn*(type code, payload) gives the command ID of a
+    record for the segment indexes, or None if it has none.
+    """
+    def __init__(self, dir_path, name, logger, segment_secs=SEGMENT_SECS['hour'],
+                 fsync_secs=FSYNC_SECS, max_age_secs=None, compress=False,
+                 queue_size=QUEUE_SIZE, command_id_fn=None):
+        self.dir_path = dir_path
+        self.name = name
+        self.logger = logger
+        self.segment_secs = segment_secs
+        self.fsync_secs = fsync_secs
+        self.max_age_secs = max_age_secs
+        self.compress = compress
+        self.command_id_fn = command_id_fn or (lambda type_code, payload: None)
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock() # for self.segment_list
+        self.segment_list = [ ] # oldest first; the last may be current
+        self.current = None # Segment being written
+        self.file = None
+        self.last_fsync = 0.0
+        self.thread = None
+        self.num_written = 0
+        self.num_dropped = 0 # queue was full
+        self.num_errors = 0
+        self.num_retired = 0
+        self.name_re = re.compile(r'^%s-(\d+)\.seg(\.gz)?$' % re.escape(name))
+
+    def _path(self, start, compressed=False):
+        path = os.path.join(self.dir_path, "%s-%d.seg" % (self.name, start))
+        if compressed:
+            path += '.gz'
+        return path
+
+    def _scan(self):
+        found = { }
+        for fname in os.listdir(self.dir_path):
+            m = self.name_re.match(fname)
+            if m is None:
+                continue
+            start = int(m.group(1))
+            compressed = m.group(2) is not None
+            # After a crash while compressing both may exist; the
+            # plain one is complete.
+            if compressed and start in found:
+                continue
+            found[start] = Segment(os.path.join(self.dir_path, fname), start,
+                                   start + self.segment_secs, compressed)
+        return [found[start] for start in sorted(found)]
+
+    def start(self):
+        """ Find existing segments and start the writer thread. """
+        if self.thread is not None:
+            return
+        if not os.path.isdir(self.dir_path):
+            os.makedirs(self.dir_path)
+        segments = self._scan()
+        # Only the newest segment can have been cut short by a crash.
+        if len(segments) > 0 and not segments[-1].compressed:
+            self._repair(segments[-1])
+        with self.lock:
+            self.segment_list = segments
+        self.thread = threading.Thread(target=self._run, name="SegmentedLog-%s" % self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _repair(self, seg):
+        buf = seg.read()
+        try:
+            good = valid_length(buf)
+            size = len(buf)
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+        if good < size:
+            self.logger.warn("Event log %s: dropping %d bytes of incomplete records",
+                                 seg.path, size - good)
+            with open(seg.path, 'r+b') as f:
+                f.truncate(good)
+
+    def stop(self):
+        """ Write everything queued, then stop the writer thread. """
+        if self.thread is None:
+            return
+        try:
+            self.queue.put(None, True, WAIT_SECS)
+        except Queue.Full:
+            self.logger.error("Event log %s: writer thread not responding", self.name)
+        self.thread.join(WAIT_SECS)
+        self.thread = None
+
+    def append(self, t, type_code, part_num, zone_num, payload):
+        try:
+            self.queue.put_nowait((t, type_code, part_num, zone_num, payload))
+        except Queue.Full:
+            self.num_dropped += 1
+
+    def flush(self, timeout=WAIT_SECS):
+        """
+        Wait until everything queued so far has been written, for
+        at most *timeout* seconds.  Returns False if it wasn't, e.g.
+        because the writer thread has died.
+        """
+        thread = self.thread
+        if thread is None:
+            return True
+        deadline = time.time() + timeout
+        # As Queue.join(), but giving up in the end.
+        q = self.queue
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not thread.is_alive():
+                    self.logger.warn("Event log %s: %d records not yet written",
+                                     self.name, q.unfinished_tasks)
+                    return False
+                q.all_tasks_done.wait(min(remaining, 1.0))
+        return True
+
+    def segments(self):
+        with self.lock:
+            return list(self.segment_list)
+
+    def records(self, start=None, end=None):
+        """ Records with *start* <= time < *end*, oldest segment first. """
+        for seg in self.segments():
+            if (start is not None and seg.end <= start) or \
+                    (end is not None and seg.start >= end):
+                continue
+            for rec in seg.records():
+                if (start is None or rec[0] >= start) and (end is None or rec[0] < end):
+                    yield rec
+
+    def query(self, q):
+        """
+        Records matching query *q*, which has attributes start, end,
+        part_num, zone_num and command_ids as for EventQuery in
+        concord_eventlog, and a matches(record) method.  Segments the
+        index rules out aren't read at all.
+        """
+        for seg in self.segments():
+            if (q.start is not None and seg.end <= q.start) or \
+                    (q.end is not None and seg.start >= q.end):
+                continue
+            idx = self.index_for(seg)
+            offset = 0
+            if idx is not None:
+                if not idx.may_match(q):
+                    continue
+                offset = idx.seek_offset(q.start)
+            for rec in seg.records(offset):
+                if q.matches(rec):
+                    yield rec
+                elif idx is not None and idx.ordered and q.end is not None and rec[0] >= q.end:
+                    break
+
+    def index_for(self, seg):
+        """
+        The SegmentIndex for sealed segment *seg*, loaded from its
+        .idx file or built and saved; None for the segment being
+        written.
+        """
+        if seg is self.current or seg.end > time.time():
+            return None
+        if seg.index is not None:
+            return seg.index
+        idx_path = seg.index_path()
+        idx = None
+        try:
+            with open(idx_path) as f:
+                idx = SegmentIndex.from_dict(json.load(f))
+            # Compressed segments don't change; a plain one that
+            # has grown since needs a new index.
+            if not seg.compressed and idx.data_len != seg.size():
+                idx = None
+        except (IOError, OSError, ValueError, KeyError):
+            idx = None
+        if idx is None:
+            buf = seg.read()
+            try:
+                idx = SegmentIndex.build(buf, self.command_id_fn)
+            finally:
+                if isinstance(buf, mmap.mmap):
+                    buf.close()
+            try:
+                tmp_path = idx_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(idx.to_dict(), f, separators=(',', ':'))
+                os.rename(tmp_path, idx_path)
+            except (IOError, OSError), ex:
+                self.logger.warn("Event log: can't save index %s: %s", idx_path, ex)
+        seg.index = idx
+        return idx
+
+    def size(self):
+        return sum(seg.size() for seg in self.segments())
+
+    def clear(self):
+        """ Delete every segment, including the one being written. """
+        if self.thread is None:
+            self._clear()
+        else:
+            try:
+                self.queue.put(CLEAR, True, WAIT_SECS)
+            except Queue.Full:
+                self.logger.error("Event log %s: writer thread not responding", self.name)
+                return
+            self.flush()
+
+    def _clear(self):
+        with self.lock:
+            segments = self.segment_list
+            self.segment_list = [ ]
+            self._close_current()
+        for seg in segments:
+            for path in (seg.path, seg.index_path()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    #
+    # Writer thread
+    #
+    def _run(self):
+        self._guarded(self._seal_old, time.time())
+        while True:
+            try:
+                item = self.queue.get(True, max(self.fsync_secs, 0.1))
+            except Queue.Empty:
+                self._guarded(self._maybe_fsync, time.time(), True)
+                continue
+            items = [ item ]
+            while len(items) < BATCH_SIZE and item not in (None, CLEAR):
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                items.append(item)
+            stopping = items[-1] is None
+            try:
+                if items[-1] in (None, CLEAR):
+                    self._write(items[:-1])
+                else:
+                    self._write(items)
+                if stopping:
+                    self._maybe_fsync(time.time(), force=True)
+                    with self.lock:
+                        self._close_current()
+                elif items[-1] == CLEAR:
+                    self._clear()
+            except Exception, ex:
+                self._write_failed(ex)
+            for i in xrange(len(items)):
+                self.queue.task_done()
+            if stopping:
+                return
+
+    def _guarded(self, fn, *args):
+        # Anything that fails in the writer thread is logged, never
+        # allowed to kill it.
+        try:
+            fn(*args)
+        except Exception, ex:
+            self._write_failed(ex)
+
+    def _write_failed(self, ex):
+        self.num_errors += 1
+        self.logger.error("Event log %s: problem writing: %s", self.name, ex)
+        self.logger.error(traceback.format_exc())
+        with self.lock:
+            self._close_current()
+
+    def _write(self, recs):
+        if len(recs) == 0:
+            return
+        now = time.time()
+        chunks = [ ]
+        for rec in recs:
+            if self.current is None or rec[0] >= self.current.end:
+                self._flush_chunks(chunks)
+                chunks = [ ]
+                self._roll(rec[0])
+            try:
+                chunks.append(pack_record(*rec))
+            except struct.error, ex:
+                # Drop just this record, not the whole batch.
+                self.num_errors += 1
+                self.logger.error("Event log %s: can't write record %r: %s",
+                                  self.name, rec[:4], ex)
+                continue
+            self.num_written += 1
+        self._flush_chunks(chunks)
+        self._maybe_fsync(now)
+
+    def _flush_chunks(self, chunks):
+        if len(chunks) > 0:
+            self.file.write(''.join(chunks))
+            self.file.flush()
+
+    def _maybe_fsync(self, now, force=False):
+        if self.file is None:
+            return
+        if force or now - self.last_fsync >= self.fsync_secs:
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+
+    def _close_current(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.current = None
+
+    def _roll(self, t):
+        """ Start writing the segment for time *t*. """
+        start = int(t // self.segment_secs) * self.segment_secs
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+            self._close_current()
+            seg = None
+            if len(self.segment_list) > 0 and self.segment_list[-1].start == start and \
+                    not self.segment_list[-1].compressed:
+                seg = self.segment_list[-1]
+            else:
+                seg = Segment(self._path(start), start, start + self.segment_secs, False)
+                self.segment_list.append(seg)
+            self.file = open(seg.path, 'ab')
+            self.current = seg
+        self._seal_old(t)
+
+    def _seal_old(self, now):
+        """ Retire segments that are too old, and compress sealed ones. """
+        if self.max_age_secs is not None:
+            with self.lock:
+                retired = [seg for seg in self.segment_list
+                           if seg.end <= now - self.max_age_secs and seg is not self.current]
+                self.segment_list = [seg for seg in self.segment_list if seg not in retired]
+            for seg in retired:
+                try:
+                    os.remove(seg.path)
+                    self.num_retired += 1
+                except OSError, ex:
+                    self.logger.warn("Event log: can't remove %s: %s", seg.path, ex)
+                try:
+                    os.remove(seg.index_path())
+                except OSError:
+                    pass
+        for seg in self.segments():
+            if seg is self.current or seg.end > now:
+                continue
+            # Index while the segment can still be mmapped.
+            self.index_for(seg)
+            if self.compress and not seg.compressed:
+                self._compress(seg)
+
+    def _compress(self, seg):
+        gz_path = self._path(seg.start, True)
+        tmp_path = gz_path + '.tmp'
+        try:
+            with open(seg.path, 'rb') as f_in:
+                data = f_in.read()
+            f_out = gzip.open(tmp_path, 'wb')
+            try:
+                f_out.write(data)
+            finally:
+                f_out.close()
+            os.rename(tmp_path, gz_path)
+        except (IOError, OSError), ex:
+            self.logger.warn("Event log: can't compress %s: %s", seg.path, ex)
+            return
+        with self.lock:
+            seg.path = gz_path
+            seg.compressed = True
+        try:
+            os.remove(self._path(seg.start))
+        except OSError, ex:
+            self.logger.warn("Event log: can't remove %s: %s",
+                             self._path(seg.start), ex)
+
+    def stats_str(self):
+        segments = self.segments()
+        return "%d segments (%d compressed), %d KB, %d written, %d retired, %d dropped, %d errors" % \
+            (len(segments), len([s for s in segments if s.compressed]), self.size() / 1024,
+             self.num_written, self.num_retired, self.num_dropped, self.num_errors)
@@ -0,0 +1,134 @@
+"""
+Compact on-disk snapshot of the zone and partition state learned
+from the panel, so that a restarted client can show the last known
+state straight away rather than waiting for a full equipment list
+refresh over the serial link.
+"""
+
+import json
+import os
+import time
+
+from concord_commands import ZoneState, FeatureState
+
+SNAPSHOT_VERSION = 1
+
+# Writes are debounced: the snapshot is written once changes have
+# stopped for DELAY secs, but at least every MAX_DELAY secs while
+# they keep coming.
+SNAPSHOT_DELAY_SECS = 5.0
+SNAPSHOT_MAX_DELAY_SECS = 60.0
+
+# Keys with StateFlags values, which are stored as plain ints.
+FLAG_KEYS = { 'zone_state': ZoneState,
+              'feature_state': FeatureState }
+
+
+def encode_info(info):
+    d = info.copy()
+    for k in FLAG_KEYS:
+        if d.get(k) is not None:
+            d[k] = int(d[k])
+    return d
+
+def _from_json(v):
+    # json gives back unicode strings; the parsers produce str.
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    elif isinstance(v, list):
+        return [_from_json(x) for x in v]
+    elif isinstance(v, dict):
+        return dict((_from_json(k), _from_json(x)) for k, x in v.iteritems())
+    return v
+
+def decode_info(info):
+    d = dict((str(k), _from_json(v)) for k, v in info.iteritems())
+    for k, flag_class in FLAG_KEYS.iteritems():
+        if d.get(k) is not None:
+            d[k] = flag_class.from_code(d[k])
+    return d
+
+
+class StateSnapshot(object):
+    """
+    Snapshot of zone and partition info dicts, as kept by a client
+    of AlarmPanelInterface: zones keyed by (partition number, zone
+    number), partitions keyed by partition number.  Call
+    mark_dirty() whenever the state changes, and maybe_save()
+    periodically.
+    """
+    def __init__(self, path, delay_secs=SNAPSHOT_DELAY_SECS,
+                 max_delay_secs=SNAPSHOT_MAX_DELAY_SECS):
+        self.path = path
+        self.delay_secs = delay_secs
+        self.max_delay_secs = max_delay_secs
+        self.first_change_at = None # first change not yet saved
+        self.last_change_at = None
+        self.num_saves = 0
+        self.num_changes = 0 # changes since last save
+
+    def mark_dirty(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.first_change_at is None:
+            self.first_change_at = now
+        self.last_change_at = now
+        self.num_changes += 1
+
+    def is_dirty(self):
+        return self.first_change_at is not None
+
+    def is_due(self, now):
+        if self.first_change_at is None:
+            return False
+        return now - self.last_change_at >= self.delay_secs or \
+            now - self.first_change_at >= self.max_delay_secs
+
+    def maybe_save(self, zones, parts, now=None):
+        """ Save if there are changes due to be saved; returns True if saved. """
+        if now is None:
+            now = time.time()
+        if not self.is_due(now):
+            return False
+        self.save(zones, parts, now)
+        return True
+
+    def save(self, zones, parts, now=None):
+        """ Raises IOError/OSError if the file can't be written. """
+        if now is None:
+            now = time.time()
+        d = { 'version': SNAPSHOT_VERSION,
+              'saved_at': now,
+              'zones': [ [part_num, zone_num, encode_info(info)]
+                         for (part_num, zone_num), info in sorted(zones.iteritems()) ],
+              'partitions': [ [part_num, encode_info(info)]
+                              for part_num, info in sorted(parts.iteritems()) ] }
+        # Write then rename, so a crash never leaves a partial file.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(d, f, separators=(',', ':'))
+        os.rename(tmp_path, self.path)
+        self.first_change_at = None
+        self.last_change_at = None
+        self.num_changes = 0
+        self.num_saves += 1
+
+    def load(self):
+        """
+        Returns (zones, partitions, time saved), or None if there is
+        no snapshot.  Raises IOError or ValueError if the snapshot
+        can't be read.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            d = json.load(f)
+        if d.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("Unknown snapshot version %r" % d.get('version'))
+        zones = { }
+        for part_num, zone_num, info in d['zones']:
+            zones[(part_num, zone_num)] = decode_info(info)
+        parts = { }
+        for part_num, info in d['partitions']:
+            parts[part_num] = decode_info(info)
+        return zones, parts, d['saved_at']
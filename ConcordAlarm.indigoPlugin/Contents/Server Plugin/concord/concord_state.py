@@ -0,0 +1,614 @@
+"""
+The panel's zone and partition state, as learned from its messages.
+
+PanelState is changed by a single writer, normally the message loop
+thread.  Other threads read it through immutable, versioned
+PanelSnapshots, which are swapped in whole after each change, so
+readers never take a lock or see a half-applied update.  Each
+snapshot shares everything that didn't change with the one before,
+so publishing costs the same however many zones there are.
+
+Each change also produces typed delta events (ZoneStateChanged,
+ArmingLevelChanged etc.) which clients can subscribe to, filtered
+by zone or partition, rather than working out from the raw panel
+messages what changed.
+
+Aggregate views of the zone state are kept up to date as zone
+messages arrive, so questions like "which zones are open?" or "is
+partition 1 ready to arm?" don't need a scan of every zone.
+"""
+
+from collections import Mapping
+from contextlib import contextmanager
+import time
+import traceback
+
+from concord_commands import ZoneState, ZONE_TRIPPED, ZONE_FAULTED, \
+    ZONE_ALARM, ZONE_TROUBLE, ZONE_BYPASSED
+
+ZONE_FLAGS = (ZONE_TRIPPED, ZONE_FAULTED, ZONE_ALARM, ZONE_TROUBLE, ZONE_BYPASSED)
+
+# Zones with any of these flags, unless bypassed, keep their
+# partition from being armed.
+ZONE_NOT_READY = ZONE_TRIPPED | ZONE_FAULTED | ZONE_TROUBLE
+
+# Pseudo-flag for the set of not-ready zones; outside the range of
+# the real flags.
+NOT_READY = 0x100
+
+
+# Keys the panel interface adds to messages, as opposed to the data
+# carried by the message; they aren't part of the state.
+MSG_META_KEYS = ('command_id', 'received_at', 'coalesced', 'flapping', 'flap_transitions',
+                 'frame')
+
+# Buckets in a SharedMap.
+SHARED_MAP_BUCKETS = 32
+
+# Messages which update zone or partition state.
+ZONE_MESSAGES = ('ZONE_DATA', 'ZONE_STATUS')
+PARTITION_MESSAGES = ('PART_DATA', 'ARM_LEVEL', 'FEAT_STATE', 'DELAY', 'TOUCHPAD')
+
+
+def zone_not_ready(zone_state):
+    return zone_state & ZONE_NOT_READY != 0 and zone_state & ZONE_BYPASSED == 0
+
+
+class ZoneQueries(object):
+    """
+    Queries on the zone flag sets, for classes which have
+    zones_with (flag -> set of zone keys) and part_zones_with
+    ((partition number, flag) -> set of zone keys).
+    """
+    def zones_with_flag(self, flag, part_num=None):
+        """
+        Sorted list of keys of zones with *flag* (a zone flag or
+        NOT_READY), in partition *part_num* or in all partitions.
+        """
+        if part_num is None:
+            return sorted(self.zones_with[flag])
+        return sorted(self.part_zones_with.get((part_num, flag), ()))
+
+    def count(self, flag, part_num=None):
+        if part_num is None:
+            return len(self.zones_with[flag])
+        return len(self.part_zones_with.get((part_num, flag), ()))
+
+    def open_zones(self, part_num=None):
+        return self.zones_with_flag(ZONE_TRIPPED, part_num)
+
+    def not_ready_zones(self, part_num=None):
+        return self.zones_with_flag(NOT_READY, part_num)
+
+    def alarm_state(self, part_num):
+        """ 'alarm', 'trouble' or 'normal', from the partition's zones. """
+        if self.count(ZONE_ALARM, part_num) > 0:
+            return 'alarm'
+        elif self.count(ZONE_TROUBLE, part_num) > 0 or self.count(ZONE_FAULTED, part_num) > 0:
+            return 'trouble'
+        return 'normal'
+
+
+class ZoneFlagIndex(ZoneQueries):
+    """
+    For each zone flag, and for not-ready zones, the set of zones
+    with it, both overall and per partition.  update() costs the
+    same however many zones there are.  Zones are keyed by
+    (partition number, zone number).
+    """
+    def __init__(self):
+        self.zone_states = { } # zone key -> zone state as last indexed
+        self.zones_with = dict((flag, set()) for flag in ZONE_FLAGS + (NOT_READY,))
+        self.part_zones_with = { } # (partition number, flag) -> set of zone keys
+        self.part_num_zones = { } # partition number -> number of zones
+        self.changed_sets = set() # keys of zones_with and part_zones_with changed since reset
+
+    def _flags(self, zone_state):
+        # Plain int, as ZoneState masks off NOT_READY.
+        flags = int(zone_state)
+        if zone_not_ready(zone_state):
+            flags |= NOT_READY
+        return flags
+
+    def update(self, zone_key, zone_state):
+        """
+        Index *zone_state* for the zone.  Returns True if any of the
+        zone's flags changed.
+        """
+        old_state = self.zone_states.get(zone_key)
+        if old_state is None:
+            self.part_num_zones[zone_key[0]] = self.part_num_zones.get(zone_key[0], 0) + 1
+            old_flags = 0
+        else:
+            if old_state == zone_state:
+                return False
+            old_flags = self._flags(old_state)
+        self.zone_states[zone_key] = zone_state
+        new_flags = self._flags(zone_state)
+        changed = old_flags ^ new_flags
+        if changed == 0:
+            return False
+        part_num = zone_key[0]
+        for flag in ZONE_FLAGS + (NOT_READY,):
+            if changed & flag == 0:
+                continue
+            part_set = self.part_zones_with.get((part_num, flag))
+            if part_set is None:
+                part_set = self.part_zones_with[(part_num, flag)] = set()
+            self.changed_sets.add(flag)
+            self.changed_sets.add((part_num, flag))
+            if new_flags & flag:
+                self.zones_with[flag].add(zone_key)
+                part_set.add(zone_key)
+            else:
+                self.zones_with[flag].discard(zone_key)
+                part_set.discard(zone_key)
+        return True
+
+    def remove(self, zone_key):
+        if zone_key not in self.zone_states:
+            return
+        self.update(zone_key, ZoneState.from_code(0))
+        del self.zone_states[zone_key]
+        self.part_num_zones[zone_key[0]] -= 1
+
+
+class StateEvent(object):
+    """
+    A change to the panel state.  *command_id* is the message that
+    caused it, if known; *version* is the PanelState version that
+    includes it.  Subclasses set *zone_key* and/or *part_num*.
+    """
+    zone_key = None
+    part_num = None
+
+    def __init__(self, old_info, new_info, command_id=None):
+        self.old_info = old_info # None if newly learned
+        self.new_info = new_info
+        self.command_id = command_id
+        self.version = None
+
+    def is_new(self):
+        return self.old_info is None
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.describe())
+
+
+class ZoneStateChanged(StateEvent):
+    """ A zone's flags changed, e.g. from {tripped} to {}. """
+    def __init__(self, zone_key, old_info, new_info, command_id=None):
+        StateEvent.__init__(self, old_info, new_info, command_id)
+        self.zone_key = zone_key
+        self.part_num = zone_key[0]
+        self.old_state = (old_info or { }).get('zone_state')
+        self.new_state = new_info.get('zone_state')
+
+    def changed_flags(self):
+        """ Bitmask of zone flags which changed. """
+        return int(self.old_state or 0) ^ int(self.new_state or 0)
+
+    def describe(self):
+        return "zone %d/%d %r -> %r" % (self.zone_key + (self.old_state, self.new_state))
+
+
+class ZoneInfoChanged(StateEvent):
+    """
+    Zone info other than its flags changed, e.g. its text or type.
+    *changed* maps each key to (old value, new value).
+    """
+    def __init__(self, zone_key, old_info, new_info, changed, command_id=None):
+        StateEvent.__init__(self, old_info, new_info, command_id)
+        self.zone_key = zone_key
+        self.part_num = zone_key[0]
+        self.changed = changed
+
+    def describe(self):
+        return "zone %d/%d %s" % (self.zone_key + (', '.join(sorted(self.changed)),))
+
+
+class ArmingLevelChanged(StateEvent):
+    """
+    A partition's arming level changed, e.g. to 'Away' by user 5.
+    *user_info* is only known for ARM_LEVEL messages.
+    """
+    def __init__(self, part_num, old_info, new_info, command_id=None):
+        StateEvent.__init__(self, old_info, new_info, command_id)
+        self.part_num = part_num
+        self.old_level_code = (old_info or { }).get('arming_level_code')
+        self.new_level_code = new_info.get('arming_level_code')
+        self.arming_level = new_info.get('arming_level')
+        self.user_info = new_info.get('user_info') if command_id == 'ARM_LEVEL' else None
+
+    def describe(self):
+        s = "partition %d %r -> %r (%s)" % \
+            (self.part_num, self.old_level_code, self.new_level_code, self.arming_level)
+        if self.user_info is not None:
+            s += " by %s" % self.user_info
+        return s
+
+
+class PartitionInfoChanged(StateEvent):
+    """
+    Partition info other than its arming level changed, e.g. its
+    feature state, delay or touchpad display.  *changed* maps each
+    key to (old value, new value).
+    """
+    def __init__(self, part_num, old_info, new_info, changed, command_id=None):
+        StateEvent.__init__(self, old_info, new_info, command_id)
+        self.part_num = part_num
+        self.changed = changed
+
+    def describe(self):
+        return "partition %d %s" % (self.part_num, ', '.join(sorted(self.changed)))
+
+
+ZONE_EVENTS = (ZoneStateChanged, ZoneInfoChanged)
+PARTITION_EVENTS = (ArmingLevelChanged, PartitionInfoChanged)
+ARMING_KEYS = ('arming_level', 'arming_level_code', 'user_info')
+
+
+def diff_info(old_info, new_info, skip=()):
+    """ Dict of key -> (old value, new value) for keys that differ. """
+    old_info = old_info or { }
+    changed = { }
+    for k, v in new_info.iteritems():
+        if k in skip:
+            continue
+        old_v = old_info.get(k)
+        if old_v != v:
+            changed[k] = (old_v, v)
+    return changed
+
+
+class Subscriptions(object):
+    """
+    Event handlers, indexed by event class and entity, so that
+    dispatching an event only looks at the handlers that want it.
+    Entities are ('zone', zone key), ('partition', partition number)
+    or None for all.  A partition subscription covers the events
+    of the partition's zones as well as the partition itself.
+    """
+    def __init__(self):
+        self.handlers = { } # (event class, entity) -> list of (token, handler_fn)
+        self.keys_by_token = { } # token -> list of (event class, entity)
+        self.next_token = 1
+
+    def add(self, handler_fn, event_classes, entity):
+        token = self.next_token
+        self.next_token += 1
+        keys = [(cls, entity) for cls in event_classes]
+        for k in keys:
+            self.handlers.setdefault(k, [ ]).append((token, handler_fn))
+        self.keys_by_token[token] = keys
+        return token
+
+    def remove(self, token):
+        for k in self.keys_by_token.pop(token, ()):
+            v = [(t, fn) for t, fn in self.handlers[k] if t != token]
+            if v:
+                self.handlers[k] = v
+            else:
+                del self.handlers[k]
+
+    def __len__(self):
+        return len(self.keys_by_token)
+
+    def match(self, event):
+        """ Handler functions for *event*, in the order subscribed. """
+        cls = event.__class__
+        entities = [None]
+        if event.part_num is not None:
+            entities.append(('partition', event.part_num))
+        if event.zone_key is not None:
+            entities.append(('zone', event.zone_key))
+        found = [ ]
+        for entity in entities:
+            found.extend(self.handlers.get((cls, entity), ()))
+        found.sort()
+        return [fn for token, fn in found]
+
+
+class ReadOnlyDict(dict):
+    """ A dict that can't be changed once built; copy() gives a plain dict. """
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("%s is read-only" % self.__class__.__name__)
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+class SharedMap(Mapping):
+    """
+    Read-only mapping that shares structure with the map it was
+    derived from.  Keys are spread over SHARED_MAP_BUCKETS buckets,
+    and with_changes() copies only the buckets it changes, so
+    deriving a map with one new entry doesn't copy the rest.
+    """
+    __slots__ = ('_buckets', '_len')
+
+    def __init__(self, items=()):
+        buckets = [{ } for i in xrange(SHARED_MAP_BUCKETS)]
+        for k, v in dict(items).iteritems():
+            buckets[hash(k) % SHARED_MAP_BUCKETS][k] = v
+        self._buckets = tuple(buckets)
+        self._len = sum(len(b) for b in buckets)
+
+    def __getitem__(self, k):
+        return self._buckets[hash(k) % SHARED_MAP_BUCKETS][k]
+
+    def __contains__(self, k):
+        return k in self._buckets[hash(k) % SHARED_MAP_BUCKETS]
+
+    def __iter__(self):
+        for b in self._buckets:
+            for k in b:
+                yield k
+
+    def __len__(self):
+        return self._len
+
+    def iteritems(self):
+        for b in self._buckets:
+            for item in b.iteritems():
+                yield item
+
+    def copy(self):
+        """ A plain dict of the entries. """
+        return dict(self.iteritems())
+
+    def with_changes(self, changes):
+        """ A new SharedMap with the entries of dict *changes* added or replaced. """
+        if not changes:
+            return self
+        buckets = list(self._buckets)
+        copied = set()
+        n = self._len
+        for k, v in changes.iteritems():
+            i = hash(k) % SHARED_MAP_BUCKETS
+            if i not in copied:
+                buckets[i] = dict(buckets[i])
+                copied.add(i)
+            if k not in buckets[i]:
+                n += 1
+            buckets[i][k] = v
+        shared = SharedMap.__new__(SharedMap)
+        shared._buckets = tuple(buckets)
+        shared._len = n
+        return shared
+
+
+class PanelSnapshot(ZoneQueries):
+    """
+    Immutable view of PanelState as of *version*.  zones and parts
+    are SharedMaps of read-only info dicts; zones_with and
+    part_zones_with map to frozensets.  Snapshots are built with
+    PanelSnapshot.derive() from the one before.
+    """
+    def __init__(self, version, zones, parts, zones_with, part_zones_with):
+        self.version = version
+        self.created_at = time.time()
+        self.zones = zones
+        self.parts = parts
+        self.zones_with = zones_with
+        self.part_zones_with = part_zones_with
+
+    @classmethod
+    def empty(cls):
+        return cls(0, SharedMap(), SharedMap(),
+                   dict((flag, frozenset()) for flag in ZONE_FLAGS + (NOT_READY,)), { })
+
+    def derive(self, version, zone_changes, part_changes, index):
+        """
+        The next snapshot: this one with *zone_changes* and
+        *part_changes* (dicts of new info by key) applied, and the
+        flag sets that *index* has changed since this one frozen
+        again.  Everything else is shared.
+        """
+        zones_with = self.zones_with
+        part_zones_with = self.part_zones_with
+        if index.changed_sets:
+            zones_with = dict(zones_with)
+            part_zones_with = dict(part_zones_with)
+            for k in index.changed_sets:
+                if isinstance(k, tuple):
+                    zks = index.part_zones_with.get(k)
+                    if zks:
+                        part_zones_with[k] = frozenset(zks)
+                    else:
+                        part_zones_with.pop(k, None)
+                else:
+                    zones_with[k] = frozenset(index.zones_with[k])
+            index.changed_sets = set()
+        return PanelSnapshot(version, self.zones.with_changes(zone_changes),
+                             self.parts.with_changes(part_changes),
+                             zones_with, part_zones_with)
+
+
+class PanelState(ZoneQueries):
+    """
+    Zone and partition info, keyed as the panel reports them: zones
+    by (partition number, zone number), partitions by partition
+    number.  Info dicts are the merged parsed messages for that zone
+    or partition.
+
+    Only the writer thread may call the update methods, or read
+    the state directly; the query methods are the same as for
+    PanelSnapshot.  Any thread may call snapshot().  Info dicts are
+    never changed once stored; an update stores a new one, so
+    snapshots can share them.
+
+    Each update that changes anything produces StateEvents, which
+    are passed to the handlers given to subscribe() once the change
+    is published, so handlers always see a snapshot that includes
+    it.  Handlers run in the writer thread.  Exceptions they raise
+    are logged to *logger* if there is one, and otherwise passed on.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.zones = { } # zone key -> ReadOnlyDict of zone info
+        self.parts = { } # partition number -> ReadOnlyDict of partition info
+        self.index = ZoneFlagIndex()
+        self.zones_with = self.index.zones_with
+        self.part_zones_with = self.index.part_zones_with
+        self.version = 0
+        self.batch_depth = 0
+        self.published_version = 0
+        self._snapshot = PanelSnapshot.empty()
+        self.zone_changes = { } # zone key -> info, since the last publish
+        self.part_changes = { } # partition number -> info, since the last publish
+        self.subscriptions = Subscriptions()
+        self.pending_events = [ ]
+        self.num_events = 0
+        self.num_dispatched = 0 # handler calls
+
+    def subscribe(self, handler_fn, event_classes=None, zone_key=None, part_num=None):
+        """
+        Call *handler_fn* with each StateEvent of one of
+        *event_classes* (default all of them), for zone *zone_key*,
+        or partition *part_num* and its zones, or everything if
+        neither is given.  Returns a token for unsubscribe().
+        """
+        if zone_key is not None and part_num is not None:
+            raise ValueError("Subscribe to a zone or a partition, not both")
+        if zone_key is not None:
+            entity = ('zone', zone_key)
+            default_classes = ZONE_EVENTS
+        elif part_num is not None:
+            entity = ('partition', part_num)
+            default_classes = ZONE_EVENTS + PARTITION_EVENTS
+        else:
+            entity = None
+            default_classes = ZONE_EVENTS + PARTITION_EVENTS
+        if event_classes is None:
+            event_classes = default_classes
+        for cls in event_classes:
+            if not (isinstance(cls, type) and issubclass(cls, StateEvent)):
+                raise TypeError("Not a StateEvent class: %r" % cls)
+            if zone_key is not None and cls not in ZONE_EVENTS:
+                raise ValueError("%s is not a zone event" % cls.__name__)
+        return self.subscriptions.add(handler_fn, event_classes, entity)
+
+    def unsubscribe(self, token):
+        self.subscriptions.remove(token)
+
+    def snapshot(self):
+        """ The latest PanelSnapshot; never blocks. """
+        return self._snapshot
+
+    def publish(self):
+        if self.published_version == self.version:
+            return
+        # Replacing the attribute is atomic, so readers get either
+        # the old snapshot or the new one.
+        self._snapshot = self._snapshot.derive(self.version, self.zone_changes,
+                                               self.part_changes, self.index)
+        self.zone_changes = { }
+        self.part_changes = { }
+        self.published_version = self.version
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.pending_events:
+            events, self.pending_events = self.pending_events, [ ]
+            for event in events:
+                for handler_fn in self.subscriptions.match(event):
+                    self.num_dispatched += 1
+                    try:
+                        handler_fn(event)
+                    except Exception, ex:
+                        if self.logger is None:
+                            raise
+                        self.logger.error("State event handler failed on %r: %s", event, ex)
+                        self.logger.error(traceback.format_exc())
+
+    @contextmanager
+    def batch(self):
+        """
+        Publish one snapshot when the enclosed updates are done,
+        rather than one per update.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.publish()
+
+    def _changed(self, events):
+        self.version += 1
+        if self.subscriptions and events:
+            for event in events:
+                event.version = self.version
+            self.pending_events.extend(events)
+        self.num_events += len(events)
+        if self.batch_depth == 0:
+            self.publish()
+
+    def update_zone(self, zone_key, updates, command_id=None):
+        """
+        Merge dict *updates* into the zone's info.  Returns (old
+        info or None if the zone wasn't known, new info).
+        *command_id* is recorded in the events for the change.
+        """
+        old_info = self.zones.get(zone_key)
+        info = dict(old_info or ())
+        info.update(updates)
+        info = self.zones[zone_key] = self.zone_changes[zone_key] = ReadOnlyDict(info)
+        if 'zone_state' in info:
+            self.index.update(zone_key, info['zone_state'])
+        events = [ ]
+        changed = diff_info(old_info, info, skip=('zone_state',))
+        if old_info is None or info.get('zone_state') != old_info.get('zone_state'):
+            events.append(ZoneStateChanged(zone_key, old_info, info, command_id))
+        if changed:
+            events.append(ZoneInfoChanged(zone_key, old_info, info, changed, command_id))
+        self._changed(events)
+        return old_info, info
+
+    def update_partition(self, part_num, updates, command_id=None):
+        """ As for update_zone(), for partition *part_num*. """
+        old_info = self.parts.get(part_num)
+        info = dict(old_info or ())
+        info.update(updates)
+        info = self.parts[part_num] = self.part_changes[part_num] = ReadOnlyDict(info)
+        events = [ ]
+        if 'arming_level_code' in updates and \
+                (old_info is None or old_info.get('arming_level_code') != info['arming_level_code']):
+            events.append(ArmingLevelChanged(part_num, old_info, info, command_id))
+        changed = diff_info(old_info, info, skip=ARMING_KEYS)
+        if changed:
+            events.append(PartitionInfoChanged(part_num, old_info, info, changed, command_id))
+        self._changed(events)
+        return old_info, info
+
+    def apply_message(self, msg):
+        """
+        Merge a parsed zone or partition panel message into the
+        state.  Returns (old info, new info) as for update_zone(), or
+        None if the message isn't about zones or partitions.
+        """
+        cmd_id = msg.get('command_id')
+        updates = dict((k, v) for k, v in msg.iteritems() if k not in MSG_META_KEYS)
+        if cmd_id in ZONE_MESSAGES:
+            zone_key = (msg['partition_number'], msg['zone_number'])
+            return self.update_zone(zone_key, updates, cmd_id)
+        elif cmd_id in PARTITION_MESSAGES:
+            return self.update_partition(msg['partition_number'], updates, cmd_id)
+        return None
+
+    def restore(self, zones, parts):
+        """
+        Merge in saved *zones* and *parts*, e.g. from a StateSnapshot.
+        This isn't news from the panel, so no events are sent.
+        """
+        subscriptions, self.subscriptions = self.subscriptions, Subscriptions()
+        try:
+            with self.batch():
+                for zone_key, info in zones.iteritems():
+                    self.update_zone(zone_key, info)
+                for part_num, info in parts.iteritems():
+                    self.update_partition(part_num, info)
+        finally:
+            self.subscriptions = subscriptions
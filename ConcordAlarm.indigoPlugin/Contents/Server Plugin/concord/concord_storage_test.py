@@ -0,0 +1,451 @@
+"""
+Tests for the plugin's message handling, state and storage modules:
+the zone status coalescer, the refresh manager, the panel state
+store, event logs in memory and on disk, the zone and partition
+history, zone statistics and state checkpoints.
+
+Can be run from the command line, from this directory.
+"""
+
+import os
+import shutil
+import StringIO
+import struct
+import tempfile
+import time
+import unittest
+
+from concord_checkpoint import Checkpoints, reconstruct
+from concord_coalesce import ZoneStatusCoalescer
+from concord_commands import ZoneState, ZONE_TRIPPED
+from concord_eventlog import EventLog, EventQuery, EventStore, NO_ENTITY, EV_TEXT, \
+    EV_MESSAGE_EXTRA, encode_event, encode_frame, encode_message_event, decode_event, \
+    decode_frame, record_command_id
+from concord_history import TimeSeriesStore, zone_series
+from concord_refresh import RefreshManager
+from concord_segments import SegmentedLog, RECORD, pack_record, unpack_records
+from concord_state import PanelState
+from concord_zonestats import ZoneStatsTracker
+
+PART_NUMS = (0, 1, 127, 128, 200, 255, NO_ENTITY)
+ZONE_NUMS = (0, 1, 32767, 32768, 40000, 65535, NO_ENTITY)
+
+
+class TestLogger(object):
+    """ Keeps what is logged, by level. """
+    def __init__(self):
+        self.lines = { }
+
+    def _log(self, level, msg, *args):
+        self.lines.setdefault(level, [ ]).append(msg % args if args else msg)
+
+    def __getattr__(self, level):
+        return lambda msg, *args: self._log(level, msg, *args)
+
+
+def with_checksum(frame):
+    return frame + [sum(frame) % 256]
+
+def zone_status_frame(part_num, zone_num, code):
+    return with_checksum([0x07, 0x21, part_num, 0, zone_num >> 8, zone_num & 0xff, code])
+
+def arm_level_frame(part_num, user_num, level):
+    return with_checksum([0x08, 0x22, 0x01, part_num, 0, 0, user_num, level])
+
+def panel_message(frame):
+    """ The message the panel interface would pass on for *frame*. """
+    msg = decode_frame(encode_frame(frame))
+    msg['frame'] = frame
+    return msg
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp(prefix='concord_test')
+        self.logger = TestLogger()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, True)
+
+
+class SegmentRecordTest(unittest.TestCase):
+    def test_round_trip_full_range(self):
+        recs = [ ]
+        for part_num in PART_NUMS:
+            for zone_num in ZONE_NUMS:
+                recs.append((1234.5, EV_TEXT, part_num, zone_num, 'p%d z%d' % (part_num, zone_num)))
+        buf = ''.join(pack_record(*rec) for rec in recs)
+        self.assertEqual([rec for offset, rec in unpack_records(buf)], recs)
+
+    def test_out_of_range_raises(self):
+        self.assertRaises(struct.error, pack_record, 0.0, EV_TEXT, 1, 1 << 32, '')
+
+    def test_stops_at_corrupt_record(self):
+        good = pack_record(1.0, EV_TEXT, 1, 1, 'good')
+        bad = pack_record(2.0, EV_TEXT, 1, 1, 'bad')
+        bad = bad[:-1] + 'X'
+        buf = good + bad + pack_record(3.0, EV_TEXT, 1, 1, 'after')
+        self.assertEqual([rec[4] for offset, rec in unpack_records(buf)], ['good'])
+
+
+class SegmentedLogTest(TempDirTestCase):
+    def open_log(self, **kwargs):
+        log = SegmentedLog(self.dir_path, 'test', self.logger, **kwargs)
+        log.start()
+        self.addCleanup(log.stop)
+        return log
+
+    def test_append_and_query_full_range(self):
+        log = self.open_log()
+        now = time.time()
+        for part_num in PART_NUMS:
+            for zone_num in ZONE_NUMS:
+                log.append(now, EV_TEXT, part_num, zone_num, 'x')
+        self.assertTrue(log.flush())
+        self.assertEqual(len(list(log.records())), len(PART_NUMS) * len(ZONE_NUMS))
+        found = list(log.query(EventQuery(part_num=200, zone_num=40000)))
+        self.assertEqual([rec[2:4] for rec in found], [(200, 40000)])
+        self.assertEqual(log.num_errors, 0)
+
+    def test_bad_record_skipped_not_batch(self):
+        log = self.open_log()
+        now = time.time()
+        log.append(now, EV_TEXT, 1, 1, 'before')
+        log.append(now, EV_TEXT, 1, 1 << 32, 'bad')
+        log.append(now, EV_TEXT, 1, 2, 'after')
+        log.flush()
+        self.assertEqual([rec[4] for rec in log.records()], ['before', 'after'])
+        self.assertEqual(log.num_errors, 1)
+
+    def test_repair_cuts_torn_record(self):
+        start = int(time.time() // 3600) * 3600
+        path = os.path.join(self.dir_path, 'test-%d.seg' % start)
+        with open(path, 'wb') as f:
+            f.write(pack_record(start + 1, EV_TEXT, 1, 2, 'one'))
+            f.write(pack_record(start + 2, EV_TEXT, 1, 2, 'two')[:-1])
+        log = self.open_log()
+        self.assertEqual(os.path.getsize(path), RECORD.size + 3)
+        log.append(start + 3, EV_TEXT, 1, 2, 'three')
+        log.flush()
+        self.assertEqual([rec[4] for rec in log.records()], ['one', 'three'])
+        self.assertEqual(len(self.logger.lines['warn']), 1)
+
+    def test_retire_and_compress(self):
+        log = self.open_log(max_age_secs=3 * 3600, compress=True)
+        now = time.time()
+        for hours_ago in (10, 2, 0):
+            log.append(now - hours_ago * 3600, EV_TEXT, 1, 1, '%d hours ago' % hours_ago)
+        log.flush()
+        self.assertEqual([rec[4] for rec in log.records()], ['2 hours ago', '0 hours ago'])
+        self.assertEqual(log.num_retired, 1)
+        segments = log.segments()
+        self.assertEqual([seg.compressed for seg in segments], [True, False])
+        names = os.listdir(self.dir_path)
+        self.assertEqual(len([n for n in names if n.endswith('.seg.gz')]), 1)
+        self.assertEqual(len([n for n in names if n.endswith('.seg')]), 1)
+
+    def test_flush_gives_up_on_dead_writer(self):
+        log = self.open_log()
+        log.queue.put(None) # stops the writer thread
+        log.thread.join()
+        log.append(time.time(), EV_TEXT, 1, 1, 'lost')
+        self.assertFalse(log.flush(timeout=1))
+
+
+class EventStoreTest(unittest.TestCase):
+    def test_full_range_entities(self):
+        store = EventStore(initial_capacity=2)
+        for part_num in PART_NUMS:
+            for zone_num in ZONE_NUMS:
+                store.add({ 'partition_number': part_num, 'zone_number': zone_num })
+        self.assertEqual([rec[2:4] for rec in store.records()],
+                         [(p, z) for p in PART_NUMS for z in ZONE_NUMS])
+
+    def test_ring_keeps_newest(self):
+        store = EventStore(max_entries=5, initial_capacity=2)
+        for i in range(12):
+            store.add('event %d' % i, float(i))
+        self.assertEqual([event for t, event in store], ['event %d' % i for i in range(7, 12)])
+        self.assertEqual(store.num_dropped_entries, 7)
+
+    def test_message_extras_kept(self):
+        msg = panel_message(zone_status_frame(200, 40000, 1))
+        type_code, part_num, zone_num, payload = encode_message_event(msg, { 'source_desc': 'Zone X' })
+        self.assertEqual((type_code, part_num, zone_num), (EV_MESSAGE_EXTRA, 200, 40000))
+        self.assertEqual(record_command_id(type_code, payload), 'ZONE_STATUS')
+        event = decode_event(type_code, payload)
+        self.assertEqual(event['source_desc'], 'Zone X')
+        self.assertEqual(event['zone_number'], 40000)
+
+
+class EventLogTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.disk = SegmentedLog(self.dir_path, 'events', self.logger)
+        self.disk.start()
+        self.addCleanup(self.disk.stop)
+        self.log = EventLog(EventStore(max_entries=10, initial_capacity=4), self.disk)
+        self.base = time.time() - 100
+
+    def add(self, first, last):
+        # Several events share each time, so the oldest time in
+        # memory is shared with events only on disk.
+        for i in range(first, last):
+            self.log.add((EV_TEXT, i % 3, NO_ENTITY, 'e%d' % i), self.base + i // 7)
+
+    def test_query_spans_disk_and_memory(self):
+        self.add(0, 40)
+        self.assertEqual([rec[4] for rec in self.log.query(EventQuery())],
+                         ['e%d' % i for i in range(40)])
+        self.assertEqual([rec[4] for rec in self.log.query(EventQuery(part_num=1))],
+                         ['e%d' % i for i in range(40) if i % 3 == 1])
+        self.assertEqual([rec[4] for rec in self.log.query(EventQuery(self.base + 4, self.base + 5))],
+                         ['e%d' % i for i in range(28, 35)])
+
+    def test_events_dropped_during_query(self):
+        self.add(0, 40)
+        found = self.log.query(EventQuery())
+        first = [found.next()[4] for i in range(35)]
+        self.add(40, 80)
+        self.assertEqual(first + [rec[4] for rec in found], ['e%d' % i for i in range(80)])
+
+
+class PanelStateTest(unittest.TestCase):
+    def test_snapshots_share_unchanged(self):
+        state = PanelState()
+        with state.batch():
+            for zone_num in range(1, 50):
+                state.update_zone((1, zone_num), { 'zone_state': ZoneState.from_code(0) })
+            state.update_partition(1, { 'arming_level_code': 1 })
+        before = state.snapshot()
+        state.update_partition(1, { 'display_text': '12:00' })
+        after = state.snapshot()
+        self.assertTrue(after.zones is before.zones)
+        self.assertTrue(after.zones_with is before.zones_with)
+        self.assertEqual(after.parts[1]['display_text'], '12:00')
+        self.assertTrue('display_text' not in before.parts[1])
+
+        state.update_zone((1, 3), { 'zone_state': ZoneState.from_code(ZONE_TRIPPED) })
+        latest = state.snapshot()
+        self.assertEqual(latest.open_zones(1), [(1, 3)])
+        self.assertEqual(after.open_zones(1), [ ])
+        self.assertEqual(len(latest.zones), 49)
+        self.assertEqual(dict(latest.zones.iteritems()), state.zones)
+        self.assertEqual(int(after.zones[(1, 3)]['zone_state']), 0)
+
+    def test_batch_publishes_once(self):
+        state = PanelState()
+        with state.batch():
+            state.update_partition(5, { 'arming_level_code': 1 })
+            self.assertTrue(5 not in state.snapshot().parts)
+            state.update_partition(5, { 'arming_level_code': 2 })
+        self.assertEqual(state.snapshot().parts[5]['arming_level_code'], 2)
+
+
+def zone_status(zone_num, code):
+    return { 'partition_number': 1, 'zone_number': zone_num,
+             'zone_state': ZoneState.from_code(code) }
+
+
+class CoalescerTest(unittest.TestCase):
+    def test_tripped_changes_coalesced(self):
+        c = ZoneStatusCoalescer(window_secs=2, flap_count=100)
+        self.assertEqual(len(c.add(zone_status(3, ZONE_TRIPPED), 0.0)), 1)
+        self.assertEqual(c.add(zone_status(3, 0), 0.5), [ ])
+        self.assertEqual(c.add(zone_status(3, ZONE_TRIPPED), 1.0), [ ])
+        delivered = c.expire(2.5)
+        self.assertEqual(len(delivered), 1)
+        self.assertEqual(delivered[0]['coalesced'], 1)
+
+    def test_flap_count_0_is_off(self):
+        c = ZoneStatusCoalescer(window_secs=1, flap_count=0)
+        for i in range(20):
+            c.add(zone_status(3, ZONE_TRIPPED * (i % 2)), float(i))
+        self.assertEqual(c.num_flapping(), 0)
+
+    def test_settings_changed_in_place(self):
+        c = ZoneStatusCoalescer(window_secs=2, flap_count=3, flap_secs=60)
+        for i in range(3):
+            c.add(zone_status(3, ZONE_TRIPPED * (i % 2)), float(i))
+        self.assertEqual(c.num_flapping(), 1)
+        c.flap_secs = 10
+        delivered = c.expire(13.0)
+        self.assertEqual([(m['flapping'], int(m['zone_state'])) for m in delivered], [('end', 0)])
+
+    def test_release_delivers_everything_held(self):
+        c = ZoneStatusCoalescer(window_secs=5, flap_count=3, flap_secs=60)
+        c.add(zone_status(3, ZONE_TRIPPED), 0.0)
+        c.add(zone_status(3, 0), 1.0)
+        for i in range(4):
+            c.add(zone_status(4, ZONE_TRIPPED * (i % 2)), float(i))
+        self.assertEqual(c.expire(4.0), [ ])
+        delivered = sorted(c.release(4.0), key=lambda m: m['zone_number'])
+        self.assertEqual([(m['zone_number'], int(m['zone_state'])) for m in delivered],
+                         [(3, 0), (4, ZONE_TRIPPED)])
+        self.assertEqual(delivered[1]['flapping'], 'end')
+        self.assertEqual(c.num_flapping(), 0)
+
+
+class FakePanel(object):
+    """ Keeps the refresh requests sent to the panel. """
+    def __init__(self):
+        self.sent = [ ]
+
+    def request_all_equipment(self):
+        self.sent.append('all')
+
+    def request_equipment(self, eqpt_type):
+        self.sent.append(eqpt_type)
+
+    def request_dynamic_data_refresh(self):
+        self.sent.append('dynamic')
+
+
+class RefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.panel = FakePanel()
+        self.refresher = RefreshManager(self.panel, TestLogger(), dynamic_join_secs=5)
+
+    def test_repeated_dynamic_refresh(self):
+        self.refresher.request([ ], now=100.0)
+        self.refresher.request([ ], now=102.0)
+        self.refresher.request([ ], now=106.0)
+        self.assertEqual(self.panel.sent, ['dynamic', 'dynamic'])
+        self.assertFalse(self.refresher.is_busy())
+
+    def test_dynamic_not_held_by_equipment_in_flight(self):
+        self.assertEqual(self.refresher.request(['zones'], now=100.0), ['zones'])
+        self.assertEqual(self.refresher.request(['zones'], now=110.0), [ ])
+        self.assertEqual(self.panel.sent, ['ZONE_DATA', 'dynamic', 'dynamic'])
+        self.assertEqual(self.refresher.batch_done(['ZONE_DATA'], now=111.0), ['zones'])
+        self.refresher.request(now=112.0)
+        self.assertEqual(self.panel.sent[3:], ['all'])
+
+
+class HistoryTest(TempDirTestCase):
+    def open_store(self):
+        store = TimeSeriesStore(self.dir_path, self.logger, chunk_entries=4)
+        store.load()
+        return store
+
+    def record(self, store, first, last):
+        for i in range(first, last):
+            store.record_zone((200, 40000), float(i), i % 2)
+            store.record_partition(1, float(i), i % 3)
+
+    def test_chunks_saved_and_loaded(self):
+        store = self.open_store()
+        self.record(store, 0, 10)
+        store.save()
+        self.assertEqual(store.num_chunks_written, 6)
+        loaded = self.open_store()
+        self.assertEqual(loaded.names(), ['partition-1', zone_series((200, 40000))])
+        self.assertEqual(loaded.transitions('partition-1'), store.transitions('partition-1'))
+
+        # Only the partly filled chunk and the new ones are written.
+        self.record(loaded, 10, 13)
+        loaded.save()
+        self.assertEqual(loaded.num_chunks_written, 4)
+        again = self.open_store()
+        self.assertEqual(len(again.transitions('zone-200-40000')), 13)
+        self.assertEqual(again.state_at('zone-200-40000', 11.5), 1)
+
+    def test_failed_chunk_written_again(self):
+        store = self.open_store()
+        self.record(store, 0, 10)
+        write_chunk = store._write_chunk
+        def failing_write_chunk(name, index, times, states):
+            if name == 'partition-1' and index == 1:
+                raise IOError(28, 'No space left on device')
+            write_chunk(name, index, times, states)
+        store._write_chunk = failing_write_chunk
+        self.assertRaises(IOError, store.save)
+        self.assertEqual(store.dirty, set(['partition-1']))
+        store._write_chunk = write_chunk
+        store.save()
+        self.assertEqual(store.dirty, set())
+        self.assertEqual(len(self.open_store().transitions('partition-1')), 10)
+
+    def test_downsample_and_export(self):
+        store = self.open_store()
+        self.record(store, 0, 10)
+        buckets = store.downsample('partition-1', 0, 10, 5)
+        self.assertEqual(buckets, [(0, 1, 3, 5), (5, 0, 3, 5)])
+        f = StringIO.StringIO()
+        self.assertEqual(store.export_csv(f, 0, 10, 5, names=[ ]), 0)
+        self.assertEqual(store.export_csv(f, 0, 10, 5), 4)
+
+
+class ZoneStatsTest(TempDirTestCase):
+    def test_counts_saved_and_loaded(self):
+        path = os.path.join(self.dir_path, 'zone_stats.json')
+        stats = ZoneStatsTracker(path)
+        zk = (200, 40000)
+        stats.track(zk, 100.0)
+        stats.update(zk, 0, ZONE_TRIPPED, 110.0)
+        stats.update(zk, ZONE_TRIPPED, 0, 140.0)
+        stats.update(zk, 0, ZONE_TRIPPED, 200.0)
+        copy = stats.stats(zk)
+        copy.trips = 99
+        self.assertEqual(stats.stats(zk).trips, 2)
+        self.assertEqual(stats.stats(zk).total_open_secs(210.0), 40.0)
+        stats.save()
+        loaded = ZoneStatsTracker(path)
+        self.assertEqual(loaded.load(), 1)
+        self.assertEqual(loaded.snapshot()[zk].to_dict(), stats.snapshot()[zk].to_dict())
+        self.assertEqual(loaded.reset(), 1)
+        self.assertEqual(loaded.stats(zk).trips, 0)
+
+
+class CheckpointTest(TempDirTestCase):
+    def test_replay_matches_live_state(self):
+        journal = SegmentedLog(os.path.join(self.dir_path, 'logs'), 'messages', self.logger)
+        journal.start()
+        self.addCleanup(journal.stop)
+        checkpoints = Checkpoints(os.path.join(self.dir_path, 'checkpoints'))
+        checkpoints.scan()
+
+        live = PanelState()
+        base = int(time.time()) - 3000
+        checkpoints.write({ }, { }, base)
+        frames = [ ]
+        for i in range(200):
+            if i % 10 == 0:
+                frames.append(arm_level_frame(200, 5, 1 + i % 3))
+            else:
+                frames.append(zone_status_frame(200, 40000 + i % 7, i % 4))
+        expected = { }
+        for i, frame in enumerate(frames):
+            t = base + 10 + i * 10
+            msg = panel_message(frame)
+            journal.append(t, *encode_event(msg))
+            live.apply_message(msg)
+            if i == 120:
+                snap = live.snapshot()
+                checkpoints.write(snap.zones, snap.parts, t + 1)
+            if i in (50, 150, 199):
+                snap = live.snapshot()
+                expected[t + 5] = (snap.zones.copy(), snap.parts.copy())
+        journal.flush()
+
+        for t, (zones, parts) in sorted(expected.iteritems()):
+            state, checkpoint_at, n = reconstruct(checkpoints, journal, t)
+            snap = state.snapshot()
+            self.assertEqual(snap.zones.copy(), zones)
+            self.assertEqual(snap.parts.copy(), parts)
+            self.assertEqual(checkpoint_at, base if t < base + 1211 else base + 1211)
+        self.assertRaises(ValueError, reconstruct, checkpoints, journal, base - 1)
+
+    def test_prune_keeps_newest_before(self):
+        checkpoints = Checkpoints(self.dir_path)
+        checkpoints.scan()
+        for t in (100, 200, 300):
+            checkpoints.write({ }, { }, t)
+        checkpoints.prune(250)
+        self.assertEqual(checkpoints.times, [200, 300])
+        checkpoints.scan()
+        self.assertEqual(checkpoints.times, [200, 300])
+
+
+if __name__ == '__main__':
+    unittest.main()
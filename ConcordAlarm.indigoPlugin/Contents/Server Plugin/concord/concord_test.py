@@ -18,15 +18,20 @@ class FakeSerial(object):
         self.curr_char_idx = 0
 
     def ck_msg_avail(self):
-        if self.curr_msg_idx >= len(self.msg_list):
+        if self.is_done():
             raise StopIteration("No more fake messages to send")
 
+    def is_done(self):
+        return self.curr_msg_idx >= len(self.msg_list)
+
     def write(self, c):
         print "WROTE: %r" % c
 
     # Dummy for testing, will make sure panel driver code always tries
     # to read to end of available fake messages.
     def inWaiting(self):
+        if self.is_done():
+            return 0
         return 1
 
     def read1(self):
@@ -46,8 +51,12 @@ class FakeSerial(object):
 
     def read(self, size=1):
         b = '';
-        for i in range(size):
-            b += self.read1()
+        try:
+            for i in range(size):
+                b += self.read1()
+        except StopIteration:
+            # Looks like a timeout to the caller
+            pass
         return b
 
     def close(self):
@@ -64,6 +73,9 @@ class FakeLog(object):
     def debug(self, s): self.log(s)
     def debug_verbose(self, s): self.log(s)
 
+def print_batch(msgs):
+    print "BATCH: %r" % [m['command_id'] for m in msgs]
+
 def run_test():
     """ 
     Run some fake messages through the code to make sure there are no
@@ -82,6 +94,7 @@ def run_test():
         '0d22020600020102030409050600', # Alarm/trouble
         '090304001100ff020400', # zone data, no zone text
         '0c0304001100ff02046e574600', # zone data, with zone text
+        '020800', # equipment list done
         '0b0114030202040000000700', # ???
         '0b0114040716690003834575', # Jesse's system -- Panel type command
         ]
@@ -95,10 +108,16 @@ def run_test():
     # fake test mode
     panel = concord.AlarmPanelInterface("fake", 0.010, FakeLog(sys.stdout))
     panel.serial_interface.serdev = FakeSerial(messages)
-    try:
-        panel.message_loop()
-    except StopIteration:
-        print "No more fake messages"
+    panel.register_batch_handler(['ZONE_DATA'], print_batch)
+    t = threading.Thread(target=panel.message_loop)
+    t.start()
+    while not panel.serial_interface.serdev.is_done():
+        time.sleep(0.1)
+    print "No more fake messages"
+    panel.stop_loop()
+    t.join()
+    for lane, stats in sorted(panel.dispatch_latency.iteritems()):
+        print "Dispatch latency, %s: %s" % (lane, stats.stats_str())
 
 
 def main():
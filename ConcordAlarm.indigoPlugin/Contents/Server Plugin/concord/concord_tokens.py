@@ -1,5 +1,12 @@
 
-TOKENS = {
+"""
+Text token codes used by the panel for zone names, partition names
+and touchpad display text.
+"""
+
+from concord_helpers import LRUCache
+
+TOKEN_TEXT = {
 0x0: '0',
 0x1: '1',
 0x2: '2',
@@ -225,23 +232,46 @@ TOKENS = {
 0xfe: '<blink>', # blink next token
 }
 
-def decode_text_tokens(tokens):
+UNKNOWN_TOKEN = '@'
+BACKSPACE = 0xFD
+
+# Token code -> text, indexed directly by the code.
+TOKENS = tuple(TOKEN_TEXT.get(t, UNKNOWN_TOKEN) for t in range(256))
+
+# Token code -> True for 'word' tokens, which are followed by a space.
+TOKEN_IS_WORD = tuple(len(c) > 1 and c[0] != '<' for c in TOKENS)
+
+# The same token strings turn up over and over: zone names in every
+# ZONE_DATA message and the same touchpad display every minute.
+TOKEN_CACHE = LRUCache(256)
+
+def _decode_text_tokens(tokens):
     # Convert token codes to strings, adding appropriate spaces.
-    s = ''
-    n = len(tokens)
+    parts = [ ]
+    last = len(tokens) - 1
     for i, t in enumerate(tokens):
         # Handle 'backspace' by discarding last character; if previous
         # token was a word token, then we are just removing the
         # trailing space; otherwise we are removing the last letter
         # token.  Not sure if this is exactly the algorithm but it
         # will work for my zone names.
-        if t == 0xFD:
-            s = s[:-1]
+        if t == BACKSPACE:
+            if parts:
+                if len(parts[-1]) > 1:
+                    parts[-1] = parts[-1][:-1]
+                else:
+                    parts.pop()
             continue
-        c = TOKENS.get(t, '@')
-        s += c
+        parts.append(TOKENS[t])
         # For 'word' tokens, put a space afterwards, unless it's the last one
-        if len(c) > 1 and i < n-1 and c[0] != '<':
-            s += ' '
-        
+        if TOKEN_IS_WORD[t] and i < last:
+            parts.append(' ')
+    return ''.join(parts)
+
+def decode_text_tokens(tokens):
+    key = tuple(tokens)
+    s = TOKEN_CACHE.get(key)
+    if s is None:
+        s = _decode_text_tokens(key)
+        TOKEN_CACHE.put(key, s)
     return s
@@ -0,0 +1,201 @@
+"""
+Running per-zone activity statistics, for maintenance: zones that
+never trip may have a dead battery, and zones that stay open may be
+stuck.  Each zone's counters are updated in constant time on every
+zone state change, and saved to a small JSON file now and then.
+"""
+
+import json
+import os
+import threading
+import time
+
+from concord_commands import ZONE_TRIPPED, ZONE_TROUBLE, ZONE_BYPASSED, ZONE_ALARM
+
+ZONE_STATS_VERSION = 1
+
+
+class ZoneStats(object):
+    """
+    Counters for one zone since *since*.  Open durations are of the
+    tripped flag; *open_since* is the time the zone was last tripped
+    if it still is.
+    """
+    __slots__ = ('since', 'trips', 'open_since', 'open_secs', 'longest_open_secs',
+                 'last_activity', 'troubles', 'bypasses', 'alarms')
+
+    def __init__(self, since):
+        self.since = since
+        self.trips = 0
+        self.open_since = None
+        self.open_secs = 0.0
+        self.longest_open_secs = 0.0
+        self.last_activity = None
+        self.troubles = 0
+        self.bypasses = 0
+        self.alarms = 0
+
+    def update(self, old_state, new_state, t):
+        """ Account for a change from *old_state* to *new_state* flags at time *t*. """
+        old_state = int(old_state or 0)
+        new_state = int(new_state or 0)
+        changed = old_state ^ new_state
+        if changed == 0:
+            return False
+        self.last_activity = t
+        went_on = changed & new_state
+        if went_on & ZONE_TRIPPED:
+            self.trips += 1
+            self.open_since = t
+        elif changed & ZONE_TRIPPED and self.open_since is not None:
+            secs = max(0.0, t - self.open_since)
+            self.open_secs += secs
+            self.longest_open_secs = max(self.longest_open_secs, secs)
+            self.open_since = None
+        if went_on & ZONE_TROUBLE:
+            self.troubles += 1
+        if went_on & ZONE_BYPASSED:
+            self.bypasses += 1
+        if went_on & ZONE_ALARM:
+            self.alarms += 1
+        return True
+
+    def total_open_secs(self, now):
+        """ Total time open, including the current opening if any. """
+        if self.open_since is None:
+            return self.open_secs
+        return self.open_secs + max(0.0, now - self.open_since)
+
+    def longest_open(self, now):
+        """ Longest time open, including the current opening if any. """
+        if self.open_since is None:
+            return self.longest_open_secs
+        return max(self.longest_open_secs, now - self.open_since)
+
+    def idle_secs(self, now):
+        """ Time since the last change, or since tracking began. """
+        return max(0.0, now - (self.last_activity or self.since))
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def copy(self):
+        return ZoneStats.from_dict(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(d['since'])
+        for k in cls.__slots__:
+            if k in d:
+                setattr(stats, k, d[k])
+        return stats
+
+
+class ZoneStatsTracker(object):
+    """
+    ZoneStats for each zone, keyed by (partition number, zone
+    number), saved to *path*.  Call update() for each zone state
+    change and maybe_save() periodically.
+
+    Methods may be called from any thread.  Other threads should
+    read the statistics through snapshot() or stats(), which return
+    copies, rather than the live zones dict.
+    """
+    def __init__(self, path, save_secs=300):
+        self.path = path
+        self.save_secs = save_secs
+        self.lock = threading.Lock()
+        self.zones = { } # zone key -> ZoneStats
+        self.dirty = False
+        self.saved_at = 0
+        self.num_saves = 0
+
+    def load(self):
+        """ Returns the number of zones loaded. """
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            d = json.load(f)
+        if d.get('version') != ZONE_STATS_VERSION:
+            return 0
+        with self.lock:
+            for part_num, zone_num, stats in d['zones']:
+                self.zones[(part_num, zone_num)] = ZoneStats.from_dict(stats)
+            return len(self.zones)
+
+    def save(self, now=None):
+        with self.lock:
+            d = { 'version': ZONE_STATS_VERSION,
+                  'saved_at': now or time.time(),
+                  'zones': [[zk[0], zk[1], stats.to_dict()]
+                            for zk, stats in sorted(self.zones.iteritems())] }
+            self.dirty = False
+        try:
+            # Write then rename, so a crash never leaves a partial file.
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(d, f)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            self.dirty = True
+            raise
+        self.saved_at = now or time.time()
+        self.num_saves += 1
+
+    def maybe_save(self, now=None):
+        now = now or time.time()
+        if self.dirty and now - self.saved_at >= self.save_secs:
+            self.save(now)
+            return True
+        return False
+
+    def __len__(self):
+        return len(self.zones)
+
+    def _get(self, zone_key, now=None):
+        stats = self.zones.get(zone_key)
+        if stats is None:
+            stats = self.zones[zone_key] = ZoneStats(now or time.time())
+            self.dirty = True
+        return stats
+
+    def track(self, zone_key, now=None):
+        """ Start counting for the zone, if not already. """
+        with self.lock:
+            self._get(zone_key, now)
+
+    def update(self, zone_key, old_state, new_state, t=None):
+        t = t or time.time()
+        with self.lock:
+            if self._get(zone_key, t).update(old_state, new_state, t):
+                self.dirty = True
+                return True
+            return False
+
+    def stats(self, zone_key):
+        """ A copy of the zone's ZoneStats, or None if it isn't tracked. """
+        with self.lock:
+            stats = self.zones.get(zone_key)
+            return None if stats is None else stats.copy()
+
+    def snapshot(self):
+        """ Dict of zone key -> copy of its ZoneStats. """
+        with self.lock:
+            return dict((zk, stats.copy()) for zk, stats in self.zones.iteritems())
+
+    def reset(self, zone_key=None, now=None):
+        """
+        Start counting afresh for one zone, or all of them.  Returns
+        the number of zones reset.
+        """
+        now = now or time.time()
+        with self.lock:
+            keys = self.zones.keys() if zone_key is None else [zone_key]
+            for zk in keys:
+                old = self.zones.get(zk)
+                still_open = old is not None and old.open_since is not None
+                self.zones[zk] = ZoneStats(now)
+                if still_open:
+                    self.zones[zk].open_since = now
+            self.dirty = True
+            return len(keys)
@@ -3,14 +3,28 @@ Main plugin driver code for Indigo plugin.
 """
 
 import os
+import Queue
 import sys
+import threading
 import time
 
-from collections import deque
 from datetime import datetime
 
-from concord import concord, concord_commands, concord_alarm_codes
-from concord.concord_commands import STAR, HASH, TRIPPED, FAULTED, ALARM, TROUBLE, BYPASSED
+from concord import concord, concord_commands, concord_alarm_codes, concord_tokens
+from concord.concord_helpers import LatencyStats
+from concord.concord_log import LazyLogger, LogShipper, OVERFLOW_POLICIES, lazy, LOG_ERR, LOG_WARN, LOG_INFO, LOG_DEBUG, \
+    LOG_DEBUGV, LOG_PREFIX
+from concord.concord_snapshot import StateSnapshot
+from concord.concord_refresh import RefreshManager
+from concord.concord_eventlog import EventLog, EventQuery, encode_event, encode_message_event, \
+    encode_zone_event, decode_event, record_command_id
+from concord.concord_segments import SegmentedLog, SEGMENT_SECS
+from concord.concord_history import TimeSeriesStore
+from concord.concord_zonestats import ZoneStatsTracker
+from concord.concord_checkpoint import Checkpoints, reconstruct, CHECKPOINT_SECS
+from concord.concord_state import PanelState, ZoneStateChanged, NOT_READY, MSG_META_KEYS
+from concord.concord_commands import STAR, HASH, ZoneState, ZONE_ERR_STATES, \
+    ZONE_TRIPPED, ZONE_FAULTED, ZONE_ALARM, ZONE_TROUBLE, ZONE_BYPASSED
 
 # Note: the "indigo" module is automatically imported and made
 # available inside our global name space by the host process.
@@ -20,25 +34,92 @@ from concord.concord_commands import STAR, HASH, TRIPPED, FAULTED, ALARM, TROUBL
 # the Indigo system log.
 DEF_LOG_DAYS = 5
 DEF_ERR_LOG_DAYS = 30
+DEF_LOG_SEGMENT = 'hour'
+DEF_LOG_FSYNC_SECS = 5
+# Caps on the memory used by each log; older entries stay on disk.
+DEF_LOG_MAX_ENTRIES = 100000
+DEF_LOG_MAX_KB = 8192
+DEF_ERR_LOG_MAX_ENTRIES = 100000
+DEF_ERR_LOG_MAX_KB = 4096
+# How often the panel device's log usage states are updated.
+LOG_USAGE_SECS = 60
+
+# File in the plugin's data directory with the last known zone and
+# partition state, restored at startup.
+SNAPSHOT_FILE = 'panel_state.json'
+
+# Directory in the plugin's data directory for the event and error
+# logs; see concord_segments.
+LOG_DIR = 'logs'
+
+# Every message merged into the panel state is journalled to this
+# log in LOG_DIR, and the whole state checkpointed to CHECKPOINT_DIR
+# in the data directory, so the state at any past time can be
+# rebuilt; see concord_checkpoint.
+JOURNAL_NAME = 'messages'
+CHECKPOINT_DIR = 'checkpoints'
+
+# Directory in the plugin's data directory for the zone and
+# partition history, saved this often; see concord_history.
+# Exports of it go to HISTORY_EXPORT_FILE in the data directory.
+HISTORY_DIR = 'history'
+HISTORY_SAVE_SECS = 60
+HISTORY_EXPORT_FILE = 'history_export.csv'
+DEF_HISTORY_STEP_MINS = 60
+
+# File in the plugin's data directory with the per-zone activity
+# statistics, saved this often.  Zone devices' time-dependent
+# statistics states are brought up to date every REFRESH secs.
+ZONE_STATS_FILE = 'zone_stats.json'
+ZONE_STATS_SAVE_SECS = 300
+ZONE_STATS_REFRESH_SECS = 3600
+# The activity report flags zones idle or open this long.
+ZONE_IDLE_WARN_DAYS = 30
+ZONE_OPEN_WARN_HOURS = 24
+
+# Event log queries write to this file in the data directory, or to
+# the Indigo log a page at a time.
+QUERY_FILE = 'event_log_query.txt'
+QUERY_PAGE_SIZE = 50
+QUERY_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+# Default zone status coalescing; see concord_coalesce.
+DEF_ZONE_COALESCE_SECS = 2
+DEF_ZONE_FLAP_COUNT = 8
+DEF_ZONE_FLAP_SECS = 60
+
+# Default window over which zone monitor emails are gathered into a
+# single digest email; 0 sends one email per zone change.
+DEF_EMAIL_DIGEST_SECS = 60
+
+# Log messages waiting to go to Indigo, and what happens when there
+# are more; see concord_log.
+DEF_LOG_QUEUE_SIZE = 1000
+DEF_LOG_OVERFLOW = 'dropOldest'
+
+# Lines which can repeat for as long as the panel keeps sending the
+# same thing; repeats within logRepeatSecs are only counted, and
+# summarised when the window closes.  Some commands get a longer
+# window.  See concord_log.
+DEF_LOG_REPEAT_SECS = 300
+REPEATED_LOG_TEMPLATES = (
+    "No Indigo zone device for zone %s",
+    "No Indigo partition device for partition %d",
+    "Plugin: unhandled panel message %s",
+    )
+LOG_REPEAT_COMMAND_SECS = {
+    'TOUCHPAD': 3600, # every minute, for every partition
+    'SIREN_SYNC': 3600,
+}
+
+# Warn if this many notifications are waiting to be sent.
+NOTIFY_QUEUE_WARN = 20
 
 
 #
-# Logging.  Roll our own because we want two levels of DEBUG.
+# Logging.  Roll our own because we want two levels of DEBUG; the
+# levels and deferred formatting are in concord_log.
 #
-LOG_ERR    = 0
-LOG_WARN   = 1
-LOG_INFO   = 2
-LOG_DEBUG  = 3
-LOG_DEBUGV = 4 # verbose debug
-
-LOG_PREFIX = {
-    LOG_ERR: "ERROR",
-    LOG_WARN: "WARNING",
-    LOG_INFO: "INFO",
-    LOG_DEBUG: "DEBUG",
-    LOG_DEBUGV: "DEBUG VERBOSE",
-}
-
 LOG_CONFIG = {
     'error': LOG_ERR,
     'warn': LOG_WARN,
@@ -47,24 +128,266 @@ LOG_CONFIG = {
     'debugVerbose': LOG_DEBUGV,
 }
 
-class Logger(object):
-    def __init__(self, lev=LOG_INFO):
-        self.log_fn = indigo.server.log
-        self.level = lev
-    def set_level(self, lev):
-        assert lev >= 0 and lev <= LOG_DEBUGV
-        self.level = lev
-    def log(self, msg, level=LOG_INFO):
-        if level == LOG_ERR:
-            indigo.server.log(msg, isError=True)
-        elif level <= self.level:
-            indigo.server.log("[%s] %s" % (LOG_PREFIX[level], msg))
-    def error(self, msg): self.log(msg, level=LOG_ERR)
-    def warn(self, msg): self.log(msg, level=LOG_WARN)
-    def info(self, msg): self.log(msg, level=LOG_INFO)
-    def debug(self, msg): self.log(msg, level=LOG_DEBUG)
-    def debug_verbose(self, msg): self.log(msg, level=LOG_DEBUGV)
-    def log_always(self, msg): indigo.server.log(msg)
+class Logger(LazyLogger):
+    """
+    Logs to Indigo.  Once the shipper is started, messages go to
+    Indigo from its thread, since each log call is a round trip to
+    the Indigo server.
+    """
+    def __init__(self, level=LOG_INFO):
+        LazyLogger.__init__(self, level)
+        self.shipper = LogShipper(self.write, DEF_LOG_QUEUE_SIZE, DEF_LOG_OVERFLOW)
+
+    def emit(self, level, text):
+        if self.shipper.running:
+            self.shipper.put(level, text)
+        else:
+            self.write([(level, text)])
+
+    def write(self, batch):
+        """
+        Send a batch of (level, text) to Indigo, one call for each
+        run of errors or other messages.
+        """
+        lines = [ ]
+        is_error = False
+        for level, text in batch:
+            if level != LOG_ERR and level is not None:
+                text = "[%s] %s" % (LOG_PREFIX[level], text)
+            if lines and (level == LOG_ERR) != is_error:
+                indigo.server.log("\n".join(lines), isError=is_error)
+                lines = [ ]
+            is_error = level == LOG_ERR
+            lines.append(text)
+        if lines:
+            indigo.server.log("\n".join(lines), isError=is_error)
+
+class NotificationSender(object):
+    """
+    Sends notifications from a background thread, so the panel
+    message thread never waits on the mail server.
+
+    send() queues a notification to go out right away, e.g. for
+    alarms.  add_to_digest() gathers notifications for *digest_secs*
+    seconds from the first one, then sends them as a single digest;
+    with *digest_secs* of 0 they go out right away like send().
+
+    *send_fn* is called as send_fn(subject, body) on the sender
+    thread.
+    """
+    def __init__(self, send_fn, logger, digest_secs=DEF_EMAIL_DIGEST_SECS):
+        self.send_fn = send_fn
+        self.logger = logger
+        self.digest_secs = digest_secs
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.digest = [ ] # (time queued, subject, body)
+        self.digest_title = None
+        self.digest_deadline = None
+        self.thread = None
+        self.send_latency = LatencyStats()
+        self.num_sent = 0
+        self.num_digests = 0
+        self.num_failed = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, name="NotificationSender")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Send anything pending, then stop the sender thread. """
+        if self.thread is None:
+            return
+        self.flush_digest()
+        self.queue.put(None)
+        self.thread.join(10)
+        self.thread = None
+
+    def queue_depth(self):
+        with self.lock:
+            return self.queue.qsize() + len(self.digest)
+
+    def send(self, subject, body):
+        self.queue.put((time.time(), subject, body))
+        depth = self.queue.qsize()
+        if depth >= NOTIFY_QUEUE_WARN:
+            self.logger.warn("%d notifications waiting to be sent", depth)
+
+    def add_to_digest(self, title, subject, body):
+        """
+        *title* is the subject for the digest email; *subject* and
+        *body* describe this one notification.
+        """
+        if self.digest_secs <= 0:
+            self.send(subject, body)
+            return
+        with self.lock:
+            if len(self.digest) == 0:
+                self.digest_deadline = time.time() + self.digest_secs
+            self.digest_title = title
+            self.digest.append((time.time(), subject, body))
+
+    def flush_digest(self):
+        with self.lock:
+            items = self.digest
+            title = self.digest_title
+            self.digest = [ ]
+            self.digest_deadline = None
+        if len(items) == 0:
+            return
+        if len(items) == 1:
+            self.queue.put(items[0])
+            return
+        self.num_digests += 1
+        subject = "%s: %d notifications" % (title, len(items))
+        body = "\n".join("%s%s" % (item_subject, item_body) for t, item_subject, item_body in items)
+        # Latency is measured from the oldest notification in the digest.
+        self.queue.put((items[0][0], subject, body))
+
+    def _run(self):
+        while True:
+            with self.lock:
+                deadline = self.digest_deadline
+            if deadline is None:
+                timeout = 1.0
+            else:
+                timeout = max(0.0, deadline - time.time())
+            try:
+                item = self.queue.get(True, timeout)
+            except Queue.Empty:
+                if deadline is not None and time.time() >= deadline:
+                    self.flush_digest()
+                continue
+            if item is None:
+                break
+            queued_at, subject, body = item
+            try:
+                self.send_fn(subject, body)
+                self.num_sent += 1
+            except Exception, ex:
+                self.num_failed += 1
+                self.logger.error("Unable to send notification %r: %s", subject, str(ex))
+            self.send_latency.add(time.time() - queued_at)
+
+    def stats_str(self):
+        return "%d sent (%d digests), %d failed, %d waiting; send latency %s" % \
+            (self.num_sent, self.num_digests, self.num_failed, self.queue_depth(),
+             self.send_latency.stats_str())
+
+class DeviceStateCache(object):
+    """
+    Shadow copy of the state values we last pushed to each Indigo
+    device.  Each update sends only the values that changed, in a
+    single updateStatesOnServer() call, since every call is a round
+    trip to the Indigo server.
+    """
+    def __init__(self):
+        self.shadow = { } # device ID -> (state key -> value)
+        self.sent = 0 # state values sent to the server
+        self.suppressed = 0 # state values not sent, as unchanged
+        self.calls = 0 # calls to updateStatesOnServer()
+
+    def update(self, dev, states):
+        """
+        *states* is a list of (state key, value) pairs for *dev*.
+        Returns the number of states that were sent.
+        """
+        shadow = self.shadow.setdefault(dev.id, { })
+        changed = [ ]
+        for key, value in states:
+            if key in shadow and shadow[key] == value:
+                self.suppressed += 1
+            else:
+                shadow[key] = value
+                changed.append({ 'key': key, 'value': value })
+        if len(changed) > 0:
+            self.sent += len(changed)
+            self.calls += 1
+            dev.updateStatesOnServer(changed)
+        return len(changed)
+
+    def forget(self, dev_id):
+        """ Next update to the device will send all the states. """
+        self.shadow.pop(dev_id, None)
+
+    def stats_str(self):
+        return "%d values sent in %d calls, %d unchanged values suppressed" % \
+            (self.sent, self.calls, self.suppressed)
+
+# For trigger types which match on more than the partition: the
+# trigger property that holds the extra key, and its conversion.
+TRIGGER_SUBKEY_PROPS = {
+    'armingLevel': ('partitionState', str),
+    'alarm': ('alarmGeneralType', int),
+}
+
+class TriggerIndex(object):
+    """
+    Our Indigo triggers, indexed by trigger type, then partition
+    number, then arming level or alarm general code where the type
+    has one.  Trigger properties are parsed once when the trigger is
+    added, so matching a message is a few dictionary lookups.  A
+    partition or extra key of 'any' matches every message.
+    """
+    def __init__(self):
+        self.keys = { } # trigger ID -> (trigger type ID, index key)
+        self.index = { } # trigger type ID -> ((partition, subkey) -> [trigger])
+
+    def _key(self, trigger):
+        """ Raises ValueError if the trigger properties are not valid. """
+        props = trigger.pluginProps
+        part = any_if_blank(props.get('address', ''))
+        if part != 'any':
+            part = int(part)
+        subkey = 'any'
+        if trigger.pluginTypeId in TRIGGER_SUBKEY_PROPS:
+            prop, conv = TRIGGER_SUBKEY_PROPS[trigger.pluginTypeId]
+            subkey = any_if_blank(props.get(prop, ''))
+            if subkey != 'any':
+                subkey = conv(subkey)
+        return (part, subkey)
+
+    def add(self, trigger):
+        key = self._key(trigger)
+        bucket = self.index.setdefault(trigger.pluginTypeId, { }).setdefault(key, [ ])
+        bucket.append(trigger)
+        bucket.sort(key=lambda t: t.id)
+        self.keys[trigger.id] = (trigger.pluginTypeId, key)
+
+    def remove(self, trigger_id):
+        if trigger_id not in self.keys:
+            return
+        type_id, key = self.keys.pop(trigger_id)
+        by_key = self.index[type_id]
+        by_key[key] = [t for t in by_key[key] if t.id != trigger_id]
+        if len(by_key[key]) == 0:
+            del by_key[key]
+
+    def __contains__(self, trigger_id):
+        return trigger_id in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def match(self, type_id, part_num, subkey='any'):
+        """
+        Return the triggers of type *type_id* matching partition
+        *part_num* and *subkey*, in trigger ID order.
+        """
+        by_key = self.index.get(type_id)
+        if not by_key:
+            return [ ]
+        t = [ ]
+        for p in (part_num, 'any'):
+            t.extend(by_key.get((p, subkey), [ ]))
+            if subkey != 'any':
+                t.extend(by_key.get((p, 'any'), [ ]))
+        if len(t) > 1:
+            t.sort(key=lambda trig: trig.id)
+        return t
 
 def zonekey(zoneDev):
     """ Return internal key for supplied Indigo zone device. """
@@ -77,21 +400,67 @@ def partkey(partDev):
     assert partDev.deviceTypeId in ('partition', 'touchpad')
     return int(partDev.address)
 
+def infoUnchanged(info, msg):
+    """
+    True if merging panel message *msg* into our zone or partition
+    *info* dict (None if not known) would not change anything.
+    """
+    if info is None:
+        return False
+    for k, v in msg.iteritems():
+        if k in MSG_META_KEYS:
+            continue
+        if k not in info or info[k] != v:
+            return False
+    return True
+
+def parseQueryTime(s):
+    """ Seconds since the epoch for local time *s*, or None if blank. """
+    s = s.strip()
+    if s == '':
+        return None
+    for fmt in QUERY_TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(s, fmt))
+        except ValueError:
+            pass
+    raise ValueError("Time must be YYYY-MM-DD, optionally followed by HH:MM or HH:MM:SS")
+
+def formatLogEntry(rec):
+    t, type_code, part_num, zone_num, payload = rec
+    return "%s: %r" % (datetime.fromtimestamp(t).isoformat(' '), decode_event(type_code, payload))
+
 def any_if_blank(s):
     if s == '': return 'any'
     else: return s
 
-def isZoneErrState(state_list):
-    for err_state in [ ALARM, FAULTED, TROUBLE, BYPASSED ]:
-        if err_state in state_list:
-            return True;
-    return False
+def isZoneErrState(zone_state):
+    """ *zone_state* is a ZoneState bitmask, or None if not known. """
+    return zone_state is not None and zone_state & ZONE_ERR_STATES != 0
 
 def zoneStateChangedExceptTripped(old, new):
-    old = list(sorted(old)).remove(TRIPPED)
-    new = list(sorted(new)).remove(TRIPPED)
-    return old != new
-    
+    """ Ignoring the tripped flag, did the zone state change? """
+    if old is None or new is None:
+        return old is not new
+    return (old ^ new) & ~ZONE_TRIPPED != 0
+
+def _zoneDevState(zone_state):
+    # See Devices.xml to understand how we map multiple state flags
+    # into a single state that Indigo understands.
+    if zone_state == 0:
+        return 'enabled'
+    elif zone_state & (ZONE_FAULTED | ZONE_TROUBLE):
+        return 'faulted'
+    elif zone_state & ZONE_ALARM:
+        return 'alarm'
+    elif zone_state & ZONE_TRIPPED:
+        return 'tripped'
+    elif zone_state & ZONE_BYPASSED:
+        return 'disabled'
+    return 'unavailable'
+
+# Zone state bitmask -> summary zoneState of the Indigo zone device.
+ZONE_DEV_STATE = tuple(_zoneDevState(v) for v in range(ZoneState.MASK + 1))
 
 
 #
@@ -99,6 +468,19 @@ def zoneStateChangedExceptTripped(old, new):
 #
 NO_DATA = '<NO DATA>'
 
+def lcdLines(display_text):
+    """ Split touchpad *display_text* into the two LCD lines. """
+    if display_text is None:
+        return NO_DATA, NO_DATA
+    # Throw out the blink information.  Not sure how to handle it.
+    lines = display_text.replace('<blink>', '').split('\n')
+    line1 = lines[0].strip()
+    if len(lines) > 1:
+        line2 = lines[1].strip()
+    else:
+        line2 = NO_DATA
+    return line1, line2
+
 #
 # Keypad sequences for various actions
 #
@@ -110,6 +492,17 @@ KEYPRESS_TOGGLE_CHIME = [ 7, 1 ]
 
 KEYPRESS_EXIT_PROGRAM = [ STAR, 0, 0, HASH ]
 
+#
+# Messages the panel sends in reply to an equipment list request;
+# these are handled in batches.
+#
+EQPT_LIST_COMMANDS = [ 'ZONE_DATA', 'PART_DATA', 'BUS_DEV_DATA', 'BUS_CAP_DATA',
+                       'OUTPUT_DATA', 'EQPT_LIST_DONE', 'USER_DATA', 'SCHED_DATA',
+                       'EVENT_DATA', 'LIGHT_ATTACH' ]
+# Live messages that deliver a partly collected batch before being
+# handled themselves.
+EQPT_LIST_FLUSH_COMMANDS = [ 'ZONE_STATUS', 'ARM_LEVEL' ]
+
 
 
 
@@ -155,21 +548,31 @@ class Plugin(indigo.PluginBase):
 
     def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
         indigo.PluginBase.__init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
-        self.logger = Logger(lev=LOG_INFO)
+        self.logger = Logger(LOG_INFO)
 
         self.panel = None
         self.panelDev = None
         self.panelInitialQueryDone = False
+        self.refresher = None # RefreshManager for the panel
     
-        # Zones are keyed by (partitition number, zone number)
-        self.zones = { } # zone key -> dict of zone info, i.e. output of cmd_zone_data
+        # Zone and partition info from the panel.  Only the panel
+        # message thread changes it; everything else reads snapshots
+        # from self.state.snapshot().  Zones are keyed by (partitition
+        # number, zone number), partitions by partition number.
+        self.state = PanelState(self.logger)
+        self.state.subscribe(self.zoneStateEventHandler, [ZoneStateChanged])
+
         self.zoneDevs = { } # zone key -> active Indigo zone device
         self.zoneKeysById = { } # zone device ID -> zone key
 
-        # Partitions are keyed by partition number
-        self.parts = { } # partition number -> partition info
         self.partDevs = { } # partition number -> active Indigo partition device
         self.partKeysById = { } # partition device ID -> partition number
+
+        # Zones and partitions restored from the state snapshot which
+        # the panel hasn't yet confirmed.
+        self.savedState = None
+        self.staleZones = set()
+        self.staleParts = set()
         
         # Touchpads don't actually have any of their own internal
         # data; they just mirror their configured partition.  To aid
@@ -177,9 +580,12 @@ class Plugin(indigo.PluginBase):
         # internal partition state.
         self.touchpadDevs = { } # partition number -> (touchpad device ID -> Indigo touchpad device)
 
-        # Triggers are keyed by Indigo trigger ID; these are used to
-        # fire off the events described in our Events.xml.
-        self.triggers = { }
+        # Last state values sent to each Indigo device.
+        self.devStates = DeviceStateCache()
+
+        # Triggers which fire off the events described in our
+        # Events.xml, indexed for matching against panel messages.
+        self.triggerIndex = TriggerIndex()
 
         # We maintain a regular event log, and an 'error' event log
         # with only exception-type information.  Each has an
@@ -189,19 +595,47 @@ class Plugin(indigo.PluginBase):
         # These are logs of events kept internally to the plugin, as
         # opposed to the log messages which are printed/sent to Indigo
         # and controlled by the 'log level'
-        self.eventLog = deque()
-        self.errLog = deque()
+        #
+        # Panel messages are kept as their raw frames, and only
+        # parsed again when the log is displayed.  Once the plugin has
+        # started, the logs are also written to disk, so they survive
+        # restarts.
+        self.eventLog = EventLog()
+        self.errLog = EventLog()
         self.eventLogDays = 0
         self.errLogDays = 0
+        self.logSegment = DEF_LOG_SEGMENT
+        self.logFsyncSecs = DEF_LOG_FSYNC_SECS
+        self.logCompress = True
+        self.logUsageAt = 0
+        self.logDropped = { } # log name -> dropped entries last reported
+
+        # Journal of the messages merged into self.state, and
+        # checkpoints of it; opened at startup.
+        self.journal = None
+        self.checkpoints = None
+
+        # Zone state and arming level transitions, kept for months;
+        # opened at startup.
+        self.history = None
+        self.historySavedAt = 0
+
+        # Per-zone activity statistics; loaded at startup.
+        self.zoneStats = ZoneStatsTracker(None, ZONE_STATS_SAVE_SECS)
+        self.zoneStatsRefreshedAt = 0
 
         # If a reporting email address is specified, we will try to
         # send emails about exception events.
         self.reportEmail = None
+        self.notifier = NotificationSender(self.sendEmailNow, self.logger)
 
         # Zone monitor configurations
         self.zoneMonitorEnabled = False
         self.zoneMonitorSendEmail = True
 
+        # Time from ALARM message arrival to Indigo triggers firing.
+        self.alarmLatency = LatencyStats()
+
         # Process settings from the Config UI after initialising all
         # the member variables, in case we want to override the
         # defaults.
@@ -214,74 +648,295 @@ class Plugin(indigo.PluginBase):
     def startup(self):
         self.logger.debug("startup called")
         self.logEvent("Plugin starting up", True)
+        self.logger.shipper.start()
+        self.notifier.start()
+        self.restoreSnapshot()
+        self.openDiskLogs()
+        self.openJournal()
+        self.openHistory()
+        self.loadZoneStats()
 
     def shutdown(self):
         self.logger.debug("shutdown called")
         self.logEvent("Plugin stopping", True)
+        self.notifier.stop()
+        self.saveSnapshot(force=True)
+        self.saveHistory()
+        self.saveZoneStats(force=True)
+        for log in (self.eventLog, self.errLog):
+            if log.disk is not None:
+                log.disk.stop()
+        if self.journal is not None:
+            self.journal.stop()
+        self.logger.flush_repeats(close_all=True)
+        self.logger.shipper.stop()
+
+    def dataDir(self):
+        """ Directory for files the plugin keeps between runs. """
+        path = os.path.join(indigo.server.getInstallFolderPath(), 'Preferences',
+                            'Plugins', self.pluginId)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def openDiskLogs(self):
+        """
+        Start writing the event and error logs to disk.  Logs from
+        earlier runs stay on disk, and are read only when needed.
+        """
+        for log, name, days in ((self.eventLog, 'events', self.eventLogDays),
+                                (self.errLog, 'errors', self.errLogDays)):
+            disk = SegmentedLog(os.path.join(self.dataDir(), LOG_DIR), name, self.logger,
+                                segment_secs=SEGMENT_SECS[self.logSegment],
+                                fsync_secs=self.logFsyncSecs,
+                                max_age_secs=(days + 1) * 24 * 3600,
+                                compress=self.logCompress,
+                                command_id_fn=record_command_id)
+            try:
+                disk.start()
+            except (IOError, OSError), ex:
+                self.logger.error("Unable to open %s log on disk, keeping it in memory only: %s",
+                                      name, ex)
+                continue
+            log.disk = disk
+
+    def openJournal(self):
+        """
+        Start journalling panel messages, and checkpoint the state
+        as restored at startup so the journal can be replayed on it.
+        """
+        journal = SegmentedLog(os.path.join(self.dataDir(), LOG_DIR), JOURNAL_NAME, self.logger,
+                               segment_secs=SEGMENT_SECS[self.logSegment],
+                               fsync_secs=self.logFsyncSecs,
+                               max_age_secs=self.journalMaxAge(),
+                               compress=self.logCompress,
+                               command_id_fn=record_command_id)
+        checkpoints = Checkpoints(os.path.join(self.dataDir(), CHECKPOINT_DIR))
+        try:
+            journal.start()
+            checkpoints.scan()
+        except (IOError, OSError), ex:
+            self.logger.error("Unable to open the message journal: %s", ex)
+            return
+        self.journal = journal
+        self.checkpoints = checkpoints
+        self.writeCheckpoint()
+
+    def journalMaxAge(self):
+        """
+        The journal, and the checkpoints it is replayed on, are kept
+        as long as the event log.
+        """
+        return (self.eventLogDays + 1) * 24 * 3600
+
+    def journalMessage(self, msg):
+        if self.journal is not None:
+            self.journal.append(time.time(), *encode_event(msg))
+
+    def writeCheckpoint(self):
+        snap = self.state.snapshot()
+        try:
+            self.checkpoints.write(snap.zones, snap.parts)
+        except (IOError, OSError), ex:
+            self.logger.error("Unable to write state checkpoint: %s", ex)
+            return
+        self.checkpoints.prune(time.time() - self.journalMaxAge())
 
-    def sendEmail(self, subject, body):
+    def openHistory(self):
+        history = TimeSeriesStore(os.path.join(self.dataDir(), HISTORY_DIR), self.logger)
+        try:
+            history.load()
+        except (IOError, OSError), ex:
+            self.logger.error("Unable to load zone and partition history: %s", ex)
+            return
+        self.history = history
+        self.historySavedAt = time.time()
+
+    def saveHistory(self):
+        if self.history is None:
+            return
+        self.historySavedAt = time.time()
+        try:
+            self.history.save()
+        except (IOError, OSError), ex:
+            self.logger.error("Unable to save zone and partition history: %s", ex)
+
+    def loadZoneStats(self):
+        self.zoneStats.path = os.path.join(self.dataDir(), ZONE_STATS_FILE)
+        try:
+            n = self.zoneStats.load()
+        except (IOError, OSError, ValueError, KeyError), ex:
+            self.logger.warn("Unable to load zone activity statistics: %s", ex)
+            return
+        self.logger.debug("Loaded activity statistics for %d zones", n)
+
+    def saveZoneStats(self, force=False):
+        if self.zoneStats.path is None:
+            return
+        try:
+            if force:
+                if self.zoneStats.dirty:
+                    self.zoneStats.save()
+            else:
+                self.zoneStats.maybe_save()
+        except (IOError, OSError), ex:
+            self.logger.error("Unable to save zone activity statistics: %s", ex)
+
+    def restoreSnapshot(self):
+        """
+        Load the last known zone and partition state, so devices show
+        it (marked stale) until the panel refresh confirms it.
+        """
+        try:
+            self.savedState = StateSnapshot(os.path.join(self.dataDir(), SNAPSHOT_FILE))
+            restored = self.savedState.load()
+        except (IOError, OSError, ValueError), ex:
+            self.logger.warn("Unable to restore saved panel state: %s", str(ex))
+            return
+        if restored is None:
+            return
+        zones, parts, saved_at = restored
+        self.state.restore(zones, parts)
+        self.staleZones.update(zones)
+        self.staleParts.update(parts)
+        self.logger.info("Restored %d zones and %d partitions saved at %s",
+                             len(zones), len(parts), datetime.fromtimestamp(saved_at).isoformat(' ')[:19])
+
+    def saveSnapshot(self, force=False):
+        if self.savedState is None:
+            return
+        snap = self.state.snapshot()
+        try:
+            if force:
+                if self.savedState.is_dirty():
+                    self.savedState.save(snap.zones, snap.parts)
+            else:
+                self.savedState.maybe_save(snap.zones, snap.parts)
+        except (IOError, OSError), ex:
+            self.logger.error("Unable to save panel state: %s", str(ex))
+            # Don't retry on every pass of the loop.
+            self.savedState.mark_dirty()
+
+    # Will be run in the concurrent thread.
+    def periodicTasks(self):
+        self.saveSnapshot()
+        self.logger.flush_repeats()
+        if self.refresher is not None:
+            self.refresher.expire()
+        if time.time() - self.logUsageAt >= LOG_USAGE_SECS:
+            self.updateLogUsage()
+        if time.time() - self.historySavedAt >= HISTORY_SAVE_SECS:
+            self.saveHistory()
+        self.saveZoneStats()
+        if self.checkpoints is not None and \
+                time.time() - (self.checkpoints.last() or 0) >= CHECKPOINT_SECS:
+            self.writeCheckpoint()
+        if time.time() - self.zoneStatsRefreshedAt >= ZONE_STATS_REFRESH_SECS:
+            self.refreshZoneStatsStates()
+
+    def updateLogUsage(self):
+        """
+        Show the memory used by the event and error logs on the panel
+        device, and note in each log any entries dropped from memory
+        to keep within its caps.
+        """
+        self.logUsageAt = time.time()
+        states = [ ]
+        for log, prefix, name in ((self.eventLog, 'eventLog', 'Event log'),
+                                  (self.errLog, 'errLog', 'Error log')):
+            entries, nbytes, dropped = log.usage()
+            states.extend([(prefix + 'Entries', entries),
+                           (prefix + 'KB', nbytes / 1024),
+                           (prefix + 'Dropped', dropped)])
+            newly_dropped = dropped - self.logDropped.get(prefix, 0)
+            self.logDropped[prefix] = dropped
+            if newly_dropped > 0:
+                if log.disk is not None:
+                    where = "; they are still on disk"
+                else:
+                    where = ""
+                msg = "%s: %d older entries dropped from memory to stay within its limits%s" % \
+                    (name, newly_dropped, where)
+                self.logger.warn(msg)
+                log.add(encode_event(msg))
+        if self.panelDev is not None:
+            self.devStates.update(self.panelDev, states)
+
+    def sendEmailNow(self, subject, body):
+        # Called on the notifier thread.
         if self.reportEmail is None:
             return
         indigo.server.sendEmailTo(self.reportEmail, subject=subject, body=body)
 
+    def sendEmail(self, subject, body, digest=None):
+        """
+        Queue an email to the report address.  If *digest* is given,
+        the email is gathered with others into a digest email with
+        that subject.
+        """
+        if self.reportEmail is None:
+            return
+        if digest is None:
+            self.notifier.send(subject, body)
+        else:
+            self.notifier.add_to_digest(digest, subject, body)
+
     #
     # Internal event log
     #
-    def _logEvent(self, eventInfo, eventTime, q, maxAge):
-        pair = (eventTime, eventInfo)
-        q.append(pair)
-        while len(q) > 0:
-            dt = eventTime - q[0][0]
-            if dt.days > maxAge:
-                q.popleft()
-            else:
-                break
+    def _logEvent(self, record, isErr):
+        event_time = time.time()
+        self.eventLog.add(record, event_time)
+        if isErr:
+            self.errLog.add(record, event_time)
 
     def logEvent(self, eventInfo, isErr=False):
-        event_time = datetime.now()
-        self._logEvent(eventInfo, event_time, self.eventLog, self.eventLogDays)
-        if isErr:
-            self._logEvent(eventInfo, event_time, self.errLog, self.errLogDays)
+        """
+        *eventInfo* is a string, a panel message, or a dict of other
+        event details.
+        """
+        self._logEvent(encode_event(eventInfo), isErr)
 
     def logEventZone(self, zoneName, zoneState, prevZoneState, logMessage, cmd, cmdData, isErr=False):
-        d = { 'zone_name': zoneName,
-              'zone_state': zoneState,
-              'prev_zone_state': prevZoneState,
-              'message': logMessage,
-              'command': cmd,
-              'command_data': cmdData }
-        self.logEvent(d, isErr)
+        """ *cmdData* is the zone message; *zoneState* and *cmd* are from it. """
+        self._logEvent(encode_zone_event(zoneName, prevZoneState, logMessage, cmdData), isErr)
 
     #
     # Triggers
     #
     def triggerStartProcessing(self, trigger):
-        self.logger.debug("Adding Trigger %d - %s" % (trigger.id, trigger.name))
-        assert trigger.id not in self.triggers
-        self.triggers[trigger.id] = trigger
+        self.logger.debug("Adding Trigger %d - %s", trigger.id, trigger.name)
+        assert trigger.id not in self.triggerIndex
+        try:
+            self.triggerIndex.add(trigger)
+        except ValueError, ex:
+            self.logger.error("Ignoring trigger %s with invalid settings: %s", trigger.name, str(ex))
  
     def triggerStopProcessing(self, trigger):
-        self.logger.debug("Removing Trigger %d - %s" % (trigger.id, trigger.name))
-        assert trigger.id in self.triggers
-        del self.triggers[trigger.id] 
+        self.logger.debug("Removing Trigger %d - %s", trigger.id, trigger.name)
+        self.triggerIndex.remove(trigger.id)
 
-    def getTriggersForType(self, triggerTypeIds):
-        """ 
-        *triggerTypeIds* is a set or list of trigger type IDs we want
-        to check.  We will give back the list of those types of
-        triggers we know about in a deterministic order.
-v        """
-        t = [ ]
-        for tid, trigger in sorted(self.triggers.iteritems()):
-            if trigger.pluginTypeId in triggerTypeIds:
-                t.append(trigger)
-        return t
+    # Will be run in the concurrent thread.
+    def zoneStateEventHandler(self, event):
+        """
+        Count the change in the zone's activity statistics, and fire
+        the zone state changed triggers for the zone's partition.
+        Zones learned from the panel for the first time haven't
+        changed, so don't count.
+        """
+        if event.is_new():
+            # Start counting from now.
+            self.zoneStats.track(event.zone_key)
+            return
+        self.zoneStats.update(event.zone_key, event.old_state, event.new_state)
+        for trigger in self.triggerIndex.match('zoneStateChanged', event.part_num):
+            indigo.trigger.execute(trigger)
 
     #
     # Plugin prefs methods
     #
     def validatePrefsConfigUi(self, valuesDict):
-        self.logger.debug("Validating prefs: %r" % (valuesDict))
+        self.logger.debug("Validating prefs: %r", valuesDict)
         errorsDict = indigo.Dict()
         self.validateSerialPortUi(valuesDict, errorsDict, "panelSerialPort")
         
@@ -296,6 +951,32 @@ v        """
         if logDays < 0:
             errorsDict['errLogDays'] = "Error log size must be integer >= 0 days"
 
+        for key, desc in (('logQueueSize', "Log message queue size"),
+                          ('logMaxEntries', "Log entry limit"),
+                          ('logMaxKB', "Log memory limit"),
+                          ('errLogMaxEntries', "Error log entry limit"),
+                          ('errLogMaxKB', "Error log memory limit")):
+            try: v = int(valuesDict.get(key, 1))
+            except ValueError: v = 0
+            if v < 1:
+                errorsDict[key] = "%s must be integer > 0" % desc
+
+        for key, desc in (('logFsyncSecs', "Log sync interval"),
+                          ('logRepeatSecs', "Repeated log line window"),
+                          ('zoneCoalesceSecs', "Zone coalescing window"),
+                          ('zoneFlapSecs', "Zone flapping period"),
+                          ('emailDigestSecs', "Zone monitor email digest window")):
+            try: v = int(valuesDict.get(key, 0))
+            except ValueError: v = -1
+            if v < 0:
+                errorsDict[key] = "%s must be integer >= 0" % desc
+
+        # A single change can't be flapping; 0 turns the check off.
+        try: flapCount = int(valuesDict.get('zoneFlapCount', DEF_ZONE_FLAP_COUNT))
+        except ValueError: flapCount = -1
+        if flapCount < 0 or flapCount == 1:
+            errorsDict['zoneFlapCount'] = "Zone flapping change count must be 0 (off) or an integer >= 2"
+
         email = valuesDict['reportEmail']
         if email.strip() != '' and '@' not in email:
             errorsDict['reportEmail'] = "Report email should be blank or a valid email address"
@@ -316,26 +997,67 @@ v        """
     def processPluginConfigPrefs(self, pluginPrefsDict):
         self.logger.debug("Loading plugin prefs...")
         self.serialPortUrl = self.getSerialPortUrl(pluginPrefsDict, 'panelSerialPort')        
-        self.logger.info("Serial port is: %s" % self.serialPortUrl)
+        self.logger.info("Serial port is: %s", self.serialPortUrl)
         # Need to keep and reconfigure same logger object as we have
         # gone and passed it off to subsystems like the
         # AlarmPanelInterface.
         self.logger.set_level(LOG_CONFIG.get(pluginPrefsDict.get('logLevel', 'info'), LOG_INFO))
         self.keepAlive = pluginPrefsDict.get('keepAlive', False)
+        self.priorityArmLevel = pluginPrefsDict.get('priorityArmLevel', True)
         self.reportEmail = pluginPrefsDict.get('reportEmail', '')
         if self.reportEmail.strip() == '':
             self.reportEmail = None
         self.eventLogDays = int(pluginPrefsDict.get('logDays', DEF_LOG_DAYS))
         self.errLogDays = int(pluginPrefsDict.get('errLogDays', DEF_ERR_LOG_DAYS))
-        self.logger.log_always("New prefs: Keep Alive=%r, Log Level=%s, Report Email=%s, Log days=%d, Err log days=%d" % \
-                                   (self.keepAlive, LOG_PREFIX[self.logger.level], self.reportEmail,
-                                    self.eventLogDays, self.errLogDays))
+        # Entries are kept for the configured number of whole days.
+        self.eventLog.set_max_age((self.eventLogDays + 1) * 24 * 3600)
+        self.errLog.set_max_age((self.errLogDays + 1) * 24 * 3600)
+        self.eventLog.set_limits(int(pluginPrefsDict.get('logMaxEntries', DEF_LOG_MAX_ENTRIES)),
+                                 int(pluginPrefsDict.get('logMaxKB', DEF_LOG_MAX_KB)) * 1024)
+        self.errLog.set_limits(int(pluginPrefsDict.get('errLogMaxEntries', DEF_ERR_LOG_MAX_ENTRIES)),
+                               int(pluginPrefsDict.get('errLogMaxKB', DEF_ERR_LOG_MAX_KB)) * 1024)
+        # The segment length only changes once the plugin restarts.
+        self.logSegment = pluginPrefsDict.get('logSegment', DEF_LOG_SEGMENT)
+        self.logFsyncSecs = int(pluginPrefsDict.get('logFsyncSecs', DEF_LOG_FSYNC_SECS))
+        self.logCompress = pluginPrefsDict.get('logCompress', True)
+        for disk in (self.eventLog.disk, self.errLog.disk, self.journal):
+            if disk is not None:
+                disk.fsync_secs = self.logFsyncSecs
+                disk.compress = self.logCompress
+        if self.journal is not None:
+            self.journal.max_age_secs = self.journalMaxAge()
+        self.zoneCoalesceSecs = int(pluginPrefsDict.get('zoneCoalesceSecs', DEF_ZONE_COALESCE_SECS))
+        self.zoneFlapCount = int(pluginPrefsDict.get('zoneFlapCount', DEF_ZONE_FLAP_COUNT))
+        self.zoneFlapSecs = int(pluginPrefsDict.get('zoneFlapSecs', DEF_ZONE_FLAP_SECS))
+        self.notifier.digest_secs = int(pluginPrefsDict.get('emailDigestSecs', DEF_EMAIL_DIGEST_SECS))
+        self.setRepeatWindows(int(pluginPrefsDict.get('logRepeatSecs', DEF_LOG_REPEAT_SECS)))
+        self.logger.shipper.queue_size = int(pluginPrefsDict.get('logQueueSize', DEF_LOG_QUEUE_SIZE))
+        overflow = pluginPrefsDict.get('logOverflow', DEF_LOG_OVERFLOW)
+        if overflow in OVERFLOW_POLICIES:
+            self.logger.shipper.overflow = overflow
+        if self.panel is not None:
+            self.panel.enable_zone_coalescing(self.zoneCoalesceSecs, self.zoneFlapCount,
+                                              self.zoneFlapSecs)
+        self.logger.log_always("New prefs: Keep Alive=%r, Log Level=%s, Report Email=%s, Log days=%d, Err log days=%d",
+                                   self.keepAlive, LOG_PREFIX[self.logger.level], self.reportEmail,
+                                   self.eventLogDays, self.errLogDays)
+
+    def setRepeatWindows(self, secs):
+        """
+        Set the repeat windows for the log lines that repeat; *secs*
+        of 0 logs every repeat.
+        """
+        for template in concord.REPEATED_LOG_TEMPLATES + REPEATED_LOG_TEMPLATES:
+            self.logger.set_repeat_window(secs, template=template)
+        for command_id, command_secs in LOG_REPEAT_COMMAND_SECS.iteritems():
+            self.logger.set_repeat_window(secs and max(secs, command_secs),
+                                          command_id=command_id)
 
     #
     # Device methods
     #
     def validateDeviceConfigUi(self, valuesDict, typeId, devId):
-        self.logger.debug("Validating %s device config..." % typeId)
+        self.logger.debug("Validating %s device config...", typeId)
         dev = indigo.devices[devId]
         errors = indigo.Dict()
 
@@ -382,41 +1104,56 @@ v        """
 
 
     def deviceStartComm(self, dev):
-        self.logger.debug("Device start comm: %s, %s, %s" % (dev.name, dev.id, dev.deviceTypeId))
+        self.logger.debug("Device start comm: %s, %s, %s", dev.name, dev.id, dev.deviceTypeId)
+        # We don't know what states the device has on the server
+        self.devStates.forget(dev.id)
 
         if dev.deviceTypeId == "panel":
             self.logEvent("Starting panel device %r" % dev.name, True)
             if self.panel is not None and self.panelDev.id != dev.id:
-                dev.updateStateOnServer('panelState', 'unavailable')
-                self.logger.error("Can't have more than one panel device; panel already setup at device id %r" % self.panelDev.id)
+                self.devStates.update(dev, [('panelState', 'unavailable')])
+                self.logger.error("Can't have more than one panel device; panel already setup at device id %r", self.panelDev.id)
                 return
 
-            dev.updateStateOnServer('panelState', 'connecting')
+            self.devStates.update(dev, [('panelState', 'connecting')])
 
             self.panelDev = dev
             try:
-                self.panel = concord.AlarmPanelInterface(self.serialPortUrl, 0.5, self.logger)
+                self.panel = concord.AlarmPanelInterface(self.serialPortUrl, 0.5, self.logger,
+                                                         priority_arm_level=self.priorityArmLevel)
             except Exception, ex:
-                dev.updateStateOnServer("panelState", "faulted")
+                self.devStates.update(dev, [("panelState", "faulted")])
                 dev.setErrorStateOnServer("Unable to connect")
-                self.logger.error("Unable to start alarm panel interface: %s" % str(ex))
+                self.logger.error("Unable to start alarm panel interface: %s", str(ex))
                 return
 
+            self.panel.enable_zone_coalescing(self.zoneCoalesceSecs, self.zoneFlapCount,
+                                              self.zoneFlapSecs)
+            self.refresher = RefreshManager(self.panel, self.logger)
+
             # Set the plugin object to handle all incoming commands
             # from the panel via the messageHandler() method.
             self.panel_command_names = { } # code -> display-friendly name
             for code, cmd_info in concord_commands.RX_COMMANDS.iteritems():
                 cmd_id, cmd_name = cmd_info[0], cmd_info[1]
                 self.panel_command_names[cmd_id] = cmd_name
-                self.panel.register_message_handler(cmd_id, self.panelMessageHandler)
+                if cmd_id not in EQPT_LIST_COMMANDS:
+                    self.panel.register_message_handler(cmd_id, self.panelMessageHandler)
+            # Equipment list replies come in bursts, so handle them
+            # all in one go.  Live zone and arming changes are newer
+            # than anything already collected, so that goes first.
+            self.panel.register_batch_handler(EQPT_LIST_COMMANDS, self.panelBatchHandler,
+                                              terminator_id='EQPT_LIST_DONE',
+                                              flush_ids=EQPT_LIST_FLUSH_COMMANDS)
+            self.panel.register_periodic_handler(self.periodicTasks)
 
             self.refreshPanelState("Indigo panel device startup")
 
         elif dev.deviceTypeId == 'zone':
             zk = zonekey(dev)
             if zk in self.zoneDevs:
-                self.logger.warn("Zone device %s has a duplicate zone %d in partition %d, ignoring" % \
-                                     (dev.name, zk[1], zk[0]))
+                self.logger.warn("Zone device %s has a duplicate zone %d in partition %d, ignoring",
+                                     dev.name, zk[1], zk[0])
                 return
             self.zoneDevs[zk] = dev
             self.zoneKeysById[dev.id] = zk
@@ -425,8 +1162,8 @@ v        """
         elif dev.deviceTypeId == 'partition':
             pk = partkey(dev)
             if pk in self.partDevs:
-                self.logger.warn("Partition device %s has a duplicate partition number %d, ignoring" % \
-                               (dev.name, pk))
+                self.logger.warn("Partition device %s has a duplicate partition number %d, ignoring",
+                               dev.name, pk)
                 return
             self.partDevs[pk] = dev
             self.updatePartitionDeviceState(dev, pk)
@@ -443,12 +1180,13 @@ v        """
 
 
     def deviceStopComm(self, dev):
-        self.logger.debug("Device stop comm: %s, %s, %s" % (dev.name, dev.id, dev.deviceTypeId))
+        self.logger.debug("Device stop comm: %s, %s, %s", dev.name, dev.id, dev.deviceTypeId)
+        self.devStates.forget(dev.id)
 
         if dev.deviceTypeId == "panel":
             self.logEvent("Stopping panel device %r" % dev.name, True)
             if self.panelDev is None or self.panelDev.id != dev.id:
-                self.logger.error("Stopping a panel we don't know about at device id %r" % dev.id)
+                self.logger.error("Stopping a panel we don't know about at device id %r", dev.id)
                 raise Exception("Extra panel device")
             # AlarmPanel object may never have been successfully
             # started (e.g. was unable to open serial port in the
@@ -457,39 +1195,40 @@ v        """
                 self.panel.stop_loop()
             self.panel = None
             self.panelDev = None
+            self.refresher = None
             self.panelInitialQueryDone = False
             
         elif dev.deviceTypeId == "zone":
             zk = zonekey(dev)
             if zk not in self.zoneDevs:
-                self.logger.warn("Zone device %s - zone %d partition %d - is not known, ignoring" % \
-                             (dev.name, zk[1], zk[0]))
+                self.logger.warn("Zone device %s - zone %d partition %d - is not known, ignoring",
+                             dev.name, zk[1], zk[0])
                 return
             known_dev = self.zoneDevs[zk]
             if dev.id != known_dev.id:
-                self.logger.warn("Zone device id %d does not match id %d we already know about for zone %d, partition %d, ignoring" % (dev.id, known_dev.id, zk[1], zk[0]))
+                self.logger.warn("Zone device id %d does not match id %d we already know about for zone %d, partition %d, ignoring", dev.id, known_dev.id, zk[1], zk[0])
                 return
-            self.logger.debug("Deleting zone dev %d" % dev.id)
+            self.logger.debug("Deleting zone dev %d", dev.id)
             del self.zoneDevs[zk]
 
         elif dev.deviceTypeId == 'partition':
             pk = partkey(dev)
             if pk not in self.partDevs:
-                self.logger.warn("Partition device %s - partition %d - is not known, ignoring" % (dev.name, pk))
+                self.logger.warn("Partition device %s - partition %d - is not known, ignoring", dev.name, pk)
                 return
             known_dev = self.partDevs[pk]
             if dev.id != known_dev.id:
-                self.logger.warn("Partition device id %d does not match id %d we already know about for partition %d, ignoring" % (dev.id, known_dev.id, pk))
+                self.logger.warn("Partition device id %d does not match id %d we already know about for partition %d, ignoring", dev.id, known_dev.id, pk)
                 return
-            self.logger.debug("Deleting partition dev %d" % dev.id)
+            self.logger.debug("Deleting partition dev %d", dev.id)
             del self.partDevs[pk]
 
         elif dev.deviceTypeId == 'touchpad':
             pk = partkey(dev)
             if pk not in self.partDevs:
-                self.logger.warn("Touchpad device %s - partition %d - is not known, ignoring" % (dev.name, pk))       
+                self.logger.warn("Touchpad device %s - partition %d - is not known, ignoring", dev.name, pk)       
             if dev.id not in self.touchpadDevs[pk]:
-                self.logger.warn("Touchpad device id %d is not known" % dev.id)
+                self.logger.warn("Touchpad device id %d is not known", dev.id)
             else:
                 del self.touchpadDevs[pk][dev.id]
 
@@ -513,33 +1252,43 @@ v        """
             self.logger.debug("Got StopThread in runConcurrentThread()")
             pass    
 
-    def refreshPanelState(self, reason):
+    def refreshPanelState(self, reason, categories=None):
         """
-        Ask the panel to tell us all about itself.  We do this on
-        startup, and when the panel asks us to (e.g. under various
-        error conditions, or even just periodically).
+        Ask the panel to tell us all about itself, or just about the
+        equipment *categories* (see concord_refresh), along with the
+        dynamic data.  We do this on startup, and when the panel asks
+        us to (e.g. under various error conditions, or even just
+        periodically).  A refresh already in progress is not repeated.
         """
-        self.logger.info("Querying panel for state (%s)" % reason)
-        if self.panelDev is None:
+        if self.panelDev is None or self.refresher is None:
             self.logger.error("No Indigo panel device configured")
             return
 
-        self.panelDev.updateStateOnServer("panelState", "exploring")
-        self.panel.request_all_equipment()
-        self.panel.request_dynamic_data_refresh()
-        self.panelInitialQueryDone = False
+        requested = self.refresher.request(categories, reason=reason)
+        if categories is None and len(requested) > 0:
+            self.devStates.update(self.panelDev, [("panelState", "exploring")])
+            self.panelInitialQueryDone = False
         
 
-    def isReadyToArm(self, partition_num):
+    def isReadyToArm(self, partition_num, bypass=False):
         """ 
         Returns pair: first element is True if it's ok to arm;
         otherwise the first element is False and the second element is
-        the (string) reason why it is not possible to arm.
+        the (string) reason why it is not possible to arm.  If
+        *bypass* is True, open zones will be bypassed when arming so
+        don't count against it.
         """
         if self.panel is None:
             return False, "The panel is not active"
-
-        # TODO: check all the zones, etc.
+        snap = self.state.snapshot()
+        if partition_num not in snap.parts:
+            return False, "Partition %d is not known" % partition_num
+
+        if snap.alarm_state(partition_num) == 'alarm':
+            return False, "Partition %d has zones in alarm" % partition_num
+        not_ready = snap.not_ready_zones(partition_num)
+        if len(not_ready) > 0 and not bypass:
+            return False, "Zones not ready: %s" % ', '.join(self.zoneName(zk, { }) for zk in not_ready)
         return True, "Partition ready to arm"
 
     def checkPartition(self, valuesDict, errorsDict):
@@ -554,7 +1303,7 @@ v        """
     # MenuItems.xml commands:
     # 
     def menuArmDisarm(self, valuesDict, itemId):
-        self.logger.debug("Menu item: Arm/Disarm: %s" % str(valuesDict))
+        self.logger.debug("Menu item: Arm/Disarm: %s", str(valuesDict))
 
         errors = indigo.Dict()
 
@@ -566,7 +1315,7 @@ v        """
 
         part = self.checkPartition(valuesDict, errors)
         if part > 0:
-            can_arm, reason = self.isReadyToArm(part)
+            can_arm, reason = self.isReadyToArm(part, bypass)
             if not can_arm:
                 errors['partition'] = reason
 
@@ -593,8 +1342,8 @@ v        """
         try:
             self.panel.send_keypress(keys, part)
         except Exception, ex:
-            self.logger.error("Problem trying to arm action=%r, silent=%r, bypass=%r" % \
-                                  (action, arm_silent, bypass))
+            self.logger.error("Problem trying to arm action=%r, silent=%r, bypass=%r",
+                                  action, arm_silent, bypass)
             self.logger.error(str(ex))
             errors['partition'] = str(ex)
             return False, valuesDict, errors
@@ -614,7 +1363,7 @@ v        """
         return v
 
     def menuSetVolume(self, valuesDict, itemId):
-        self.logger.debug("Menu item: Set volume: %s" % str(valuesDict))
+        self.logger.debug("Menu item: Set volume: %s", str(valuesDict))
         errors = indigo.Dict()
 
         part = self.checkPartition(valuesDict, errors)
@@ -653,21 +1402,21 @@ v        """
         if not self.panel:
             self.logger.warn("No panel to refresh")
         else:
-            self.panel.request_dynamic_data_refresh()
+            self.refresher.request([ ], reason="Menu refresh dynamic state")
 
     def menuRefreshAllEquipment(self):
         self.logger.debug("Menu item: Refresh Full Equipment List")
         if not self.panel:
             self.logger.warn("No panel to refresh")
         else:
-            self.panel.request_all_equipment()
+            self.refresher.request(dynamic=False, reason="Menu refresh all equipment")
 
     def menuRefreshZones(self):
         self.logger.debug("Menu item: Refresh Zones")
         if not self.panel:
             self.logger.warn("No panel to refresh")
         else:
-            self.panel.request_zones()
+            self.refresher.request(['zones'], dynamic=False, reason="Menu refresh zones")
 
 
     def menuCreateZoneDevices(self, valuesDict, itemId):
@@ -681,14 +1430,14 @@ v        """
         use_title_case = valuesDict["useTitleCase"]
         prefix = valuesDict["prefix"]
         suffix = valuesDict["suffix"]
-        self.logger.debug("   useTitleCase: %r" % use_title_case)
-        self.logger.debug("   prefix: %r" % prefix)
-        self.logger.debug("   suffix: %r" % suffix)
+        self.logger.debug("   useTitleCase: %r", use_title_case)
+        self.logger.debug("   prefix: %r", prefix)
+        self.logger.debug("   suffix: %r", suffix)
 
         self.logger.debug("Getting list of existing Indigo device names")
         device_names = set([d.name for d in indigo.devices])
 
-        for zk, zone_data in self.zones.iteritems():
+        for zk, zone_data in self.state.snapshot().zones.iteritems():
             part_num, zone_num = zk
             zone_name = zone_data.get('zone_text', '')
             if use_title_case:
@@ -720,7 +1469,7 @@ v        """
                 counter += 1
             
             if zk not in self.zoneDevs:
-                self.logger.info("Creating Zone %d, partition %d - %s" % (zone_num, part_num, unique_zone_name))
+                self.logger.info("Creating Zone %d, partition %d - %s", zone_num, part_num, unique_zone_name)
                 zone_dev = indigo.device.create(protocol=indigo.kProtocol.Plugin, 
                                                 address="%d/%d" % (zone_num, part_num),
                                                 name=unique_zone_name,
@@ -735,8 +1484,8 @@ v        """
                 # indigo.device.displayInRemoteUI(zone_dev.id, value=True)
             else:
                 zone_dev = self.zoneDevs[zk]
-                self.logger.info("Device %d already exists for Zone %d, partition %d - %s" % \
-                                     (zone_dev.id, zone_num, part_num, zone_dev.name))
+                self.logger.info("Device %d already exists for Zone %d, partition %d - %s",
+                                     zone_dev.id, zone_num, part_num, zone_dev.name)
         errors = indigo.Dict()
         return (True, valuesDict, errors)
 
@@ -746,7 +1495,8 @@ v        """
         Print to log our internal zone state information; cross-check
         Indigo devices against this state.
         """
-        for zk, zone_data in sorted(self.zones.iteritems()):
+        snap = self.state.snapshot()
+        for zk, zone_data in sorted(snap.zones.iteritems()):
             part_num, zone_num = zk
             zone_name = zone_data.get('zone_text', 'Unknown')
             zone_type = zone_data.get('zone_type', 'Unknown')
@@ -754,18 +1504,107 @@ v        """
                 indigo_id = self.zoneDevs[zk].id
             else:
                 indigo_id = None
-            self.logger.log_always("Zone %d, %s, Indigo device %r, state=%r, partition=%d, type=%s" % \
-                                       (zone_num, zone_name,  indigo_id, zone_data['zone_state'],
-                                        part_num, zone_type))
+            self.logger.log_always("Zone %d, %s, Indigo device %r, state=%r, partition=%d, type=%s",
+                                       zone_num, zone_name,  indigo_id, zone_data['zone_state'],
+                                       part_num, zone_type)
 
         for zk, dev in self.zoneDevs.iteritems():
             part_num, zone_num = zk
-            if zk in self.zones:
+            if zk in snap.zones:
                 # We already know about this stone in our official
                 # internal state.
                 continue
-            self.logger.log_always("No zone info for Indigo device %r, id=%d, state=%s, zone %d/%d" % \
-                                       (dev.name, dev.id, dev.states['zoneState'], zone_num, part_num))
+            self.logger.log_always("No zone info for Indigo device %r, id=%d, state=%s, zone %d/%d",
+                                       dev.name, dev.id, dev.states['zoneState'], zone_num, part_num)
+
+
+    def menuListOpenZones(self):
+        """
+        Print to log the zones which are open, or otherwise keeping
+        their partition from being ready to arm.
+        """
+        snap = self.state.snapshot()
+        for part_num in sorted(snap.parts):
+            open_zones = snap.open_zones(part_num)
+            not_ready = [zk for zk in snap.not_ready_zones(part_num) if zk not in open_zones]
+            self.logger.log_always("Partition %d: %s, alarm state %s",
+                                       part_num, self.getPartitionState(part_num, snap),
+                                       snap.alarm_state(part_num))
+            self.logger.log_always("    Open zones: %s",
+                                       ', '.join(self.zoneName(zk, { }) for zk in open_zones) or 'None')
+            if len(not_ready) > 0:
+                self.logger.log_always("    Other zones not ready: %s",
+                                           ', '.join(self.zoneName(zk, { }) for zk in not_ready))
+
+    def menuZoneActivityReport(self):
+        """
+        Print to log each zone's activity statistics, flagging zones
+        which haven't changed for a long time (dead battery?) or have
+        been open for a long time (stuck sensor?).
+        """
+        now = time.time()
+        # A copy, as the message thread goes on updating the counts.
+        zones = self.zoneStats.snapshot()
+        if len(zones) == 0:
+            self.logger.log_always("No zone activity recorded yet")
+            return
+        for zk, stats in sorted(zones.iteritems()):
+            if stats.last_activity is None:
+                last = "never"
+            else:
+                last = datetime.fromtimestamp(stats.last_activity).isoformat(' ')[:16]
+            notes = [ ]
+            if stats.idle_secs(now) >= ZONE_IDLE_WARN_DAYS * 24 * 3600:
+                notes.append("no activity for %d days" % (stats.idle_secs(now) / (24 * 3600)))
+            if stats.open_since is not None and now - stats.open_since >= ZONE_OPEN_WARN_HOURS * 3600:
+                notes.append("open for %.1f hours" % ((now - stats.open_since) / 3600))
+            self.logger.log_always("Zone %s (partition %d): %d trips, open %.1f hours in all, longest %.1f hours; "
+                                   "%d troubles, %d bypasses, %d alarms; last activity %s; since %s%s",
+                                   self.zoneName(zk, { }), zk[0], stats.trips,
+                                   stats.total_open_secs(now) / 3600, stats.longest_open(now) / 3600,
+                                   stats.troubles, stats.bypasses, stats.alarms, last,
+                                   datetime.fromtimestamp(stats.since).isoformat(' ')[:10],
+                                   ''.join(" -- CHECK: %s" % n for n in notes))
+
+    def menuResetZoneActivity(self):
+        n = self.zoneStats.reset()
+        self.saveZoneStats(force=True)
+        self.refreshZoneStatsStates()
+        self.logger.log_always("Zone activity statistics reset for %d zones", n)
+
+    def menuDumpStats(self):
+        """
+        Print to log internal statistics about how the plugin is
+        coping with the panel's message traffic.
+        """
+        self.logger.log_always("Text token cache: %s", concord_tokens.TOKEN_CACHE.stats_str())
+        self.logger.log_always("Alarm trigger latency: %s", self.alarmLatency.stats_str())
+        self.logger.log_always("Device state updates: %s", self.devStates.stats_str())
+        self.logger.log_always("Email notifications: %s", self.notifier.stats_str())
+        self.logger.log_always("Log messages: %s; %s", self.logger.shipper.stats_str(),
+                               self.logger.repeats.stats_str())
+        self.logger.log_always("Event log: %s", self.eventLog.stats_str())
+        self.logger.log_always("Error log: %s", self.errLog.stats_str())
+        if self.history is not None:
+            self.logger.log_always("History: %s", self.history.stats_str())
+        self.logger.log_always("State events: %d events, %d handler calls, %d subscriptions",
+                                   self.state.num_events, self.state.num_dispatched,
+                                   len(self.state.subscriptions))
+        if self.savedState is not None:
+            self.logger.log_always("Saved panel state: %d saves, %d changes not yet saved, %d zones and %d partitions still stale",
+                                       self.savedState.num_saves, self.savedState.num_changes,
+                                       len(self.staleZones), len(self.staleParts))
+        if self.panel is not None:
+            self.logger.log_always("Clock-only touchpad messages: %d", self.panel.touchpad_clock_only_count)
+            self.logger.log_always("Refreshes: %s", self.refresher.stats_str())
+            self.logger.log_always("Last refreshed: %s", self.refresher.freshness_str())
+            for lane, stats in sorted(self.panel.dispatch_latency.iteritems()):
+                self.logger.log_always("Message dispatch latency, %s: %s", lane, stats.stats_str())
+            coalescer = self.panel.zone_coalescer
+            if coalescer is not None:
+                self.logger.log_always("Zone status: %d messages coalesced, %d suppressed while flapping, %d zones flapping now",
+                                           coalescer.num_coalesced, coalescer.num_flap_suppressed,
+                                           coalescer.num_flapping())
 
 
     def menuSendTestAlarm(self, valuesDict, itemId):
@@ -825,13 +1664,171 @@ v        """
         else:
             log = None
 
-        self.logger.log_always("Displaying %s" % name)
+        self.logger.log_always("Displaying %s", name)
         
         if log is not None:
-            for t, entry in log:
-                self.logger.log_always("%s: %r" % (t.isoformat(' '), entry))
+            for rec in log.records():
+                self.logger.log_always(formatLogEntry(rec))
         
         return True, valuesDict
+
+    def menuQueryLog(self, valuesDict, itemId):
+        """
+        Find the event log entries matching the query in *valuesDict*,
+        and write them to a file, or a page of them to the log.
+        Entries are read from memory and disk as they are written out,
+        so a long result never has to be held in memory.
+        """
+        errors = indigo.Dict()
+        q_args = { }
+        for key, arg in (('startTime', 'start'), ('endTime', 'end')):
+            try:
+                q_args[arg] = parseQueryTime(valuesDict.get(key, ''))
+            except ValueError, ex:
+                errors[key] = str(ex)
+        part = valuesDict.get('partition', 'any')
+        if part != 'any':
+            q_args['part_num'] = int(part)
+        zone = valuesDict.get('zone', '').strip()
+        if zone != '':
+            try:
+                q_args['zone_num'] = int(zone)
+                if part == 'any':
+                    errors['partition'] = "Choose the zone's partition"
+            except ValueError:
+                errors['zone'] = "Zone must be blank or a zone number"
+        commands = [c.strip().upper() for c in valuesDict.get('commands', '').split(',')]
+        commands = [c for c in commands if c != '']
+        if len(commands) > 0:
+            q_args['command_ids'] = commands
+        try:
+            page = int(valuesDict.get('page', '1'))
+            if page < 1:
+                raise ValueError()
+        except ValueError:
+            errors['page'] = "Page must be a number, 1 or more"
+        if len(errors) > 0:
+            return (False, valuesDict, errors)
+
+        q = EventQuery(**q_args)
+        if valuesDict.get('errorsOnly', False):
+            log, name = self.errLog, 'Error log'
+        else:
+            log, name = self.eventLog, 'Event log'
+        results = log.query(q)
+
+        if valuesDict.get('output', 'log') == 'file':
+            path = os.path.join(self.dataDir(), QUERY_FILE)
+            n = 0
+            with open(path, 'w') as f:
+                f.write("%s: %s\n" % (name, q.describe()))
+                for rec in results:
+                    f.write(formatLogEntry(rec))
+                    f.write('\n')
+                    n += 1
+            self.logger.log_always("%s query (%s): %d entries written to %s",
+                                       name, q.describe(), n, path)
+            return True, valuesDict
+
+        first = (page - 1) * QUERY_PAGE_SIZE
+        self.logger.log_always("%s query (%s), page %d:", name, q.describe(), page)
+        n = 0
+        for rec in results:
+            if n >= first + QUERY_PAGE_SIZE:
+                self.logger.log_always("More entries follow; see page %d", page + 1)
+                break
+            if n >= first:
+                self.logger.log_always(formatLogEntry(rec))
+            n += 1
+        else:
+            self.logger.log_always("%d entries on this page, no more follow", max(0, n - first))
+        return True, valuesDict
+
+    def menuStateAtTime(self, valuesDict, itemId):
+        """
+        Print to log the zone and partition state as the plugin had
+        it at the time in *valuesDict*, rebuilt from the newest
+        checkpoint before then and the messages journalled since.
+        """
+        if self.journal is None:
+            self.logger.error("No message journal; has the plugin started?")
+            return True, valuesDict
+        errors = indigo.Dict()
+        try:
+            t = parseQueryTime(valuesDict.get('stateTime', ''))
+            if t is None:
+                raise ValueError("Enter the time to show the state at")
+        except ValueError, ex:
+            errors['stateTime'] = str(ex)
+            return (False, valuesDict, errors)
+
+        # Make sure the journal on disk is up to date.
+        self.journal.flush()
+        started_at = time.time()
+        try:
+            state, checkpoint_at, n = reconstruct(self.checkpoints, self.journal, t, self.logger)
+        except ValueError, ex:
+            errors['stateTime'] = str(ex)
+            return (False, valuesDict, errors)
+        snap = state.snapshot()
+        self.logger.log_always("State at %s, from the checkpoint at %s and %d messages (%.1f ms):",
+                               datetime.fromtimestamp(t).isoformat(' ')[:19],
+                               datetime.fromtimestamp(checkpoint_at).isoformat(' ')[:19],
+                               n, 1000 * (time.time() - started_at))
+        for part_num in sorted(snap.parts):
+            info = snap.parts[part_num]
+            self.logger.log_always("Partition %d: %s, alarm state %s, arming level %s",
+                                   part_num, self.getPartitionState(part_num, snap),
+                                   snap.alarm_state(part_num),
+                                   info.get('arming_level', 'unknown'))
+        for zk in sorted(snap.zones):
+            info = snap.zones[zk]
+            self.logger.log_always("Zone %d, partition %d, %s: %s", zk[1], zk[0],
+                                   info.get('zone_text', ''), ZONE_DEV_STATE[info['zone_state']])
+        return True, valuesDict
+
+    def menuExportHistory(self, valuesDict, itemId):
+        """
+        Write the zone and partition history for the period in
+        *valuesDict* to a CSV file, one row per series per step: the
+        state at the end of the step, all the state flags seen
+        during it, and the number of changes.
+        """
+        if self.history is None:
+            self.logger.error("No zone and partition history; has the plugin started?")
+            return True, valuesDict
+        errors = indigo.Dict()
+        times = { }
+        for key in ('startTime', 'endTime'):
+            try:
+                times[key] = parseQueryTime(valuesDict.get(key, ''))
+            except ValueError, ex:
+                errors[key] = str(ex)
+        try:
+            step_mins = int(valuesDict.get('stepMins', DEF_HISTORY_STEP_MINS))
+            if step_mins < 1:
+                raise ValueError()
+        except ValueError:
+            errors['stepMins'] = "Step must be a whole number of minutes, 1 or more"
+        if len(errors) > 0:
+            return (False, valuesDict, errors)
+
+        end = times['endTime'] or time.time()
+        start = times['startTime']
+        if start is None:
+            # From the start of the step with the oldest transition.
+            start = self.history.first_time() or end
+            start -= start % (step_mins * 60)
+        what = valuesDict.get('series', 'all')
+        names = [name for name in self.history.names()
+                 if what == 'all' or name.startswith(what + '-')]
+        path = os.path.join(self.dataDir(), HISTORY_EXPORT_FILE)
+        with open(path, 'w') as f:
+            n = self.history.export_csv(f, start, end, step_mins * 60, names)
+        self.logger.log_always("History from %s to %s: %d rows written to %s",
+                               datetime.fromtimestamp(start).isoformat(' ')[:16],
+                               datetime.fromtimestamp(end).isoformat(' ')[:16], n, path)
+        return True, valuesDict
         
     #
     # Plugin Actions object callbacks 
@@ -850,8 +1847,8 @@ v        """
         sendEmail = action.props.get("sendEmail", False)
         self.zoneMonitorEnabled = config.lower().strip() == 'enabled'
         self.zoneMonitorSendEmail = sendEmail
-        self.panelDev.updateStateOnServer('panelZoneMonitorEnabled', self.zoneMonitorEnabled)
-        self.panelDev.updateStateOnServer('panelZoneMonitorSendEmail', self.zoneMonitorSendEmail)
+        self.devStates.update(self.panelDev, [('panelZoneMonitorEnabled', self.zoneMonitorEnabled),
+                                              ('panelZoneMonitorSendEmail', self.zoneMonitorSendEmail)])
 
 
     #
@@ -874,47 +1871,71 @@ v        """
                       in sorted(concord_alarm_codes.ALARM_CODES.iteritems())]
         return [('any', 'Any')] + gen_codes
 
-    def getPartitionState(self, part_key):
-        assert part_key in self.parts
-        part_data = self.parts[part_key]
-        arm_level = part_data.get('arming_level_code', -1)
-        part_state = PART_ARM_STATE_MAP.get(arm_level, 'unknown')
+    def getPartitionArmState(self, part_key, snap=None):
+        """
+        The partition state from its arming level alone, so never
+        'unready'.  *snap* is the PanelSnapshot to use, default the
+        latest; the message thread may pass the live PanelState
+        instead.
+        """
+        if snap is None:
+            snap = self.state.snapshot()
+        assert part_key in snap.parts
+        arm_level = snap.parts[part_key].get('arming_level_code', -1)
+        return PART_ARM_STATE_MAP.get(arm_level, 'unknown')
+
+    def getPartitionState(self, part_key, snap=None):
+        """
+        As getPartitionArmState(), but 'unready' for a disarmed
+        partition with zones that aren't ready.
+        """
+        if snap is None:
+            snap = self.state.snapshot()
+        part_state = self.getPartitionArmState(part_key, snap)
+        if part_state == 'ready' and snap.count(NOT_READY, part_key) > 0:
+            part_state = 'unready'
         return part_state
     
     def updateTouchpadDeviceState(self, touchpad_dev, part_key):
-        if part_key not in self.parts:
-            self.logger.debug("Unable to update Indigo touchpad device %s - partition %d; no knowledge of that partition" % (touchpad_dev.name, part_key))
-            touchpad_dev.updateStateOnServer('partitionState', 'unknown')
-            touchpad_dev.updateStateOnServer('lcdLine1', NO_DATA)
-            touchpad_dev.updateStateOnServer('lcdLine2', NO_DATA)
+        snap = self.state.snapshot()
+        if part_key not in snap.parts:
+            self.logger.debug("Unable to update Indigo touchpad device %s - partition %d; no knowledge of that partition", touchpad_dev.name, part_key)
+            self.devStates.update(touchpad_dev, [('partitionState', 'unknown'),
+                                                 ('lcdLine1', NO_DATA),
+                                                 ('lcdLine2', NO_DATA)])
             return
 
-        part_data = self.parts[part_key]
-        lcd_data = part_data.get('display_text', '%s\n%s' % (NO_DATA, NO_DATA))
-        # Throw out the blink information.  Not sure how to handle it.
-        lcd_data = lcd_data.replace('<blink>', '')
-        lines = lcd_data.split('\n')
-        if len(lines) > 0:
-            touchpad_dev.updateStateOnServer('lcdLine1', lines[0].strip())
-        else:
-            touchpad_dev.updateStateOnServer('lcdLine1', NO_DATA)
-        if len(lines) > 1:
-            touchpad_dev.updateStateOnServer('lcdLine2', lines[1].strip())
-        else:
-            touchpad_dev.updateStateOnServer('lcdLine2', NO_DATA)
-        touchpad_dev.updateStateOnServer('partitionState', self.getPartitionState(part_key))
+        part_data = snap.parts[part_key]
+        line1, line2 = lcdLines(part_data.get('display_text'))
+        self.devStates.update(touchpad_dev, [('lcdLine1', line1),
+                                             ('lcdLine2', line2),
+                                             ('partitionState', self.getPartitionState(part_key, snap))])
+
+    def updateTouchpadClock(self, msg):
+        """
+        Handle a TOUCHPAD message which only changes the clock on the
+        display: just update the LCD lines; only the line with the
+        time on it will actually be sent.
+        """
+        part_num = msg['partition_number']
+        self.journalMessage(msg)
+        self.state.update_partition(part_num, { 'display_text': msg['display_text'] })
+        line1, line2 = lcdLines(msg['display_text'])
+        for dev_id, dev in self.touchpadDevs.get(part_num, { }).iteritems():
+            self.devStates.update(dev, [('lcdLine1', line1), ('lcdLine2', line2)])
 
     def updatePartitionDeviceState(self, part_dev, part_key):
-        if part_key not in self.parts:
-            self.logger.debug("Unable to update Indigo partition device %s - partition %d; no knowledge of that partition" % (part_dev.name, part_key))
-            part_dev.updateStateOnServer('partitionState', 'unknown')
-            part_dev.updateStateOnServer('armingUser', '')
-            part_dev.updateStateOnServer('features', 'Unknown')
-            part_dev.updateStateOnServer('delay', 'Unknown')
+        snap = self.state.snapshot()
+        if part_key not in snap.parts:
+            self.logger.debug("Unable to update Indigo partition device %s - partition %d; no knowledge of that partition", part_dev.name, part_key)
+            self.devStates.update(part_dev, [('partitionState', 'unknown'),
+                                             ('armingUser', ''),
+                                             ('features', 'Unknown'),
+                                             ('delay', 'Unknown')])
             return
 
-        part_state = self.getPartitionState(part_key)
-        part_data = self.parts[part_key]
+        part_state = self.getPartitionState(part_key, snap)
+        part_data = snap.parts[part_key]
         arm_user  = part_data.get('user_info', 'Unknown User')
         features  = part_data.get('feature_state', ['Unknown'])
 
@@ -924,55 +1945,390 @@ v        """
         else:
             delay_str = "%s, %d seconds" % (', '.join(delay_flags), part_data.get('delay_seconds', -1))
 
-        # TODO: How would we determine 'unready'?  Check that no zones are tripped?
-        part_dev.updateStateOnServer('partitionState', part_state)
-        part_dev.updateStateOnServer('armingUser', arm_user)
-        part_dev.updateStateOnServer('features', ', '.join(features))
-        part_dev.updateStateOnServer('delay', delay_str)
+        self.devStates.update(part_dev, [('partitionState', part_state),
+                                         ('armingUser', arm_user),
+                                         ('features', ', '.join(features)),
+                                         ('delay', delay_str),
+                                         ('alarmState', snap.alarm_state(part_key)),
+                                         ('openZones', snap.count(ZONE_TRIPPED, part_key)),
+                                         ('isStale', part_key in self.staleParts)])
 
 
     def updateZoneDeviceState(self, zone_dev, zone_key):
-        if zone_key not in self.zones:
-            self.logger.debug("Unable to update Indigo zone device %s - zone %d partition %d; no knowledge of that zone" % (zone_dev.name, zone_key[1], zone_key[0]))
-            zone_dev.updateStateOnServer('zoneState', 'unavailable')
+        data = self.state.snapshot().zones.get(zone_key)
+        if data is None:
+            self.logger.debug("Unable to update Indigo zone device %s - zone %d partition %d; no knowledge of that zone", zone_dev.name, zone_key[1], zone_key[0])
+            self.devStates.update(zone_dev, [('zoneState', 'unavailable')])
             return
-        data = self.zones[zone_key]
+        states = [ ]
         if 'zone_type' in data:
-            zone_dev.updateStateOnServer('zoneType', data['zone_type'])
+            states.append(('zoneType', data['zone_type']))
         if 'zone_text' in data:
-            zone_dev.updateStateOnServer('zoneText', data['zone_text'])
+            states.append(('zoneText', data['zone_text']))
         zone_state = data['zone_state']
-        zone_dev.updateStateOnServer('isNormal', len(zone_state) == 0)
-        zone_dev.updateStateOnServer('isTripped', TRIPPED in zone_state)
-        zone_dev.updateStateOnServer('isFaulted', FAULTED in zone_state)
-        zone_dev.updateStateOnServer('isAlarm', ALARM in zone_state)
-        zone_dev.updateStateOnServer('isTrouble', TROUBLE in zone_state)
-        zone_dev.updateStateOnServer('isBypassed', BYPASSED in zone_state)
-
-        # Update the summary zoneState.  See Devices.xml to understand
-        # how we map multiple state flags into a single state that
-        # Indigo understands.
-        bypassed = BYPASSED in zone_state
-        if len(zone_state) == 0:
-            zs = 'enabled'
-        elif FAULTED in zone_state or TROUBLE in zone_state:
-            zs = 'faulted'
-        elif ALARM in zone_state:
-            zs = 'alarm'
-        elif TRIPPED in zone_state:
-            zs = 'tripped'
-        elif BYPASSED in zone_state:
-            zs = 'disabled'
+        states.append(('isNormal', zone_state == 0))
+        states.append(('isTripped', zone_state & ZONE_TRIPPED != 0))
+        states.append(('isFaulted', zone_state & ZONE_FAULTED != 0))
+        states.append(('isAlarm', zone_state & ZONE_ALARM != 0))
+        states.append(('isTrouble', zone_state & ZONE_TROUBLE != 0))
+        states.append(('isBypassed', zone_state & ZONE_BYPASSED != 0))
+        states.append(('isStale', zone_key in self.staleZones))
+
+        states.extend(self.zoneStatsStates(zone_key))
+
+        # Update the summary zoneState.
+        zs = ZONE_DEV_STATE[zone_state]
+        states.append(('zoneState', zs))
+        num_sent = self.devStates.update(zone_dev, states)
+        if num_sent > 0 and zs in ('faulted', 'alarm'):
+            zone_dev.setErrorStateOnServer(', '.join(zone_state))
+
+
+    def zoneStatsStates(self, zone_key, now=None):
+        """ Device states for the zone's activity statistics. """
+        now = now or time.time()
+        stats = self.zoneStats.stats(zone_key)
+        if stats is None:
+            return [ ]
+        if stats.last_activity is None:
+            last_activity = ''
         else:
-            zs = 'unavailable'
-            
-        # if bypassed and zs in ('normal', 'tripped'):
-        #     zs += '_bypassed'
+            last_activity = datetime.fromtimestamp(stats.last_activity).isoformat(' ')[:19]
+        return [('tripCount', stats.trips),
+                ('openSecsTotal', int(stats.total_open_secs(now))),
+                ('longestOpenSecs', int(stats.longest_open(now))),
+                ('lastActivity', last_activity),
+                ('daysSinceActivity', int(stats.idle_secs(now) / (24 * 3600))),
+                ('troubleCount', stats.troubles),
+                ('bypassCount', stats.bypasses)]
+
+    def refreshZoneStatsStates(self):
+        """
+        Bring the statistics states which change with time alone, such
+        as days since activity, up to date on all zone devices.
+        """
+        now = time.time()
+        self.zoneStatsRefreshedAt = now
+        for zk, dev in self.zoneDevs.items():
+            self.devStates.update(dev, self.zoneStatsStates(zk, now))
+
+    def zoneName(self, zk, msg):
+        zone_num = zk[1]
+        zone_info = self.state.snapshot().zones.get(zk, { })
+        if msg.get('zone_text', '') != '':
+            return '%s - %r' % (zone_num, msg['zone_text'])
+        elif zone_info.get('zone_text', '') != '':
+            return '%s - %r' % (zone_num, zone_info['zone_text'])
+        else:
+            return '%d' % zone_num
 
-        zone_dev.updateStateOnServer('zoneState', zs)
-        if zs in ('faulted', 'alarm'):
-            zone_dev.setErrorStateOnServer(', '.join(zone_state))
+    def updateZoneInfo(self, msg):
+        """
+        Merge ZONE_DATA or ZONE_STATUS *msg* into our internal zone
+        state.  Returns (zone key, zone name, previous zone state);
+        the previous zone state is None if the zone wasn't known.
+        """
+        cmd_id = msg['command_id']
+        zk = (msg['partition_number'], msg['zone_number'])
+        zone_name = self.zoneName(zk, msg)
+        old_zone_state = None # Not known
+
+        if zk in self.state.zones:
+            self.logger.info("Updating zone %s with %s message, zone state=%r",
+                                 zone_name, cmd_id, msg['zone_state'])
+            old_zone_state = self.state.zones[zk]['zone_state']
+        else:
+            self.logger.info("Learning new zone %s from %s message, zone_state=%r",
+                                 zone_name, cmd_id, msg['zone_state'])
+        self.journalMessage(msg)
+        self.state.apply_message(msg)
+        self.staleZones.discard(zk)
+        if self.history is not None:
+            self.history.record_zone(zk, msg.get('received_at') or time.time(),
+                                     msg['zone_state'])
+        if self.savedState is not None:
+            self.savedState.mark_dirty()
+        return zk, zone_name, old_zone_state
+
+    def logZoneChange(self, zone_name, old_zone_state, msg):
+        """
+        Log to internal event log.  If the zone is changed to or from
+        one of the 'error' states, we will use the error log as well.
+        We don't normally have to check for change per se, since we
+        know it was a zone change that prompted this message.
+        However, if a zone is in an error state, we don't want to log
+        an error every time it is change between tripped/not-tripped.
+        """
+        new_zone_state = msg['zone_state']
+        use_err_log = (isZoneErrState(old_zone_state) or isZoneErrState(new_zone_state)) \
+            and zoneStateChangedExceptTripped(old_zone_state, new_zone_state)
+        self.logEventZone(zone_name, new_zone_state, old_zone_state,
+                          "Zone update message", msg['command_id'], msg, use_err_log)
+
+    def zoneMonitorChange(self, zone_name, part_num, old_zone_state, msg):
+        """
+        If zone monitor is enabled, log any zone changes to the error
+        log.  Optionally send an email if the user asked for that,
+        and fire Indigo triggers.
+        """
+        if not self.zoneMonitorEnabled:
+            return
+        cmd_id = msg['command_id']
+        new_zone_state = msg['zone_state']
+
+        # Activate any zone monitor triggers
+        for trigger in self.triggerIndex.match('zoneMonitorTriggered', part_num):
+            indigo.trigger.execute(trigger)
+
+        self.logEventZone(zone_name, new_zone_state, old_zone_state,
+                          "Zone monitor / Zone update message", cmd_id, msg, True)
+        if self.zoneMonitorSendEmail:
+            date_str = datetime.now().isoformat(' ')[:19]
+            if isZoneErrState(new_zone_state):
+                change_str = 'ERROR'
+            else:
+                changed = (old_zone_state or 0) ^ new_zone_state
+                if changed & new_zone_state & ZONE_TRIPPED:
+                    change_str = 'OPENED'
+                elif changed & ZONE_TRIPPED:
+                    change_str = 'CLOSED'
+                else:
+                    change_str = 'UNKNOWN'
+            subject = "Zone Monitor: %s %s at %s" % (zone_name, change_str, date_str)
+            body = """
+When: %s
+Zone: %s
+Command: %s
+Old State: %r
+New State: %r
+Message: %r
+""" % (date_str, zone_name, cmd_id, old_zone_state, new_zone_state, msg)
+            self.sendEmail(subject, body, digest="Zone Monitor")
+
+    def updatePartitionInfo(self, msg):
+        """
+        Merge a partition-related *msg* into our internal partition
+        state.  Returns (partition number, previous partition state
+        from getPartitionArmState()).
+        """
+        cmd_id = msg['command_id']
+        part_num = msg['partition_number']
+        old_part_state = "Unknown"
+        if part_num in self.state.parts:
+            # The live state: inside a batch the snapshot may not
+            # have this partition yet.
+            old_part_state = self.getPartitionArmState(part_num, self.state)
+            # Log informational message about updating the
+            # partition with message info.  However, for touchpad
+            # messages this could be quite frequent (every minute)
+            # so log at a higher level.
+            if cmd_id == 'TOUCHPAD':
+                log_fn = self.logger.debug_verbose
+            else:
+                log_fn = self.logger.info
+            log_fn("Updating partition %d with %s message", part_num, cmd_id)
+        else:
+            self.logger.info("Learning new partition %d from %s message", part_num, cmd_id)
+        self.journalMessage(msg)
+        self.state.apply_message(msg)
+        self.staleParts.discard(part_num)
+        if self.history is not None and cmd_id == 'ARM_LEVEL':
+            self.history.record_partition(part_num, msg.get('received_at') or time.time(),
+                                          msg['arming_level_code'])
+        if self.savedState is not None and cmd_id != 'TOUCHPAD':
+            self.savedState.mark_dirty()
+        return part_num, old_part_state
+
+    def updatePartitionDevices(self, part_num, cmd_id):
+        if part_num in self.partDevs:
+            self.updatePartitionDeviceState(self.partDevs[part_num], part_num)
+        else:
+            # The panel seems to send touchpad date/time messages
+            # for all partitions it supports.  User may not wish
+            # to see warnings if they haven't setup the Partition
+            # device in Indigo, so log this at a higher level.
+            if cmd_id == 'TOUCHPAD':
+                log_fn = self.logger.debug_verbose
+            else:
+                log_fn = self.logger.warn
+            log_fn("No Indigo partition device for partition %d", part_num, command_id=cmd_id)
+
+        # We update the touchpad even when it's not a TOUCHPAD
+        # message so that the touchpad device can track the
+        # underlying partition state.  Later on we may also add
+        # other features to mirror the LEDs on an actual touchpad
+        # as well.
+        if part_num in self.touchpadDevs:
+            for dev_id, dev in self.touchpadDevs[part_num].iteritems():
+                self.updateTouchpadDeviceState(dev, part_num)
+
+    # Will be run in the concurrent thread.
+    def panelBatchHandler(self, msgs):
+        """
+        *msgs* is a list of equipment list messages from the panel, in
+        the order received, usually ending with EQPT_LIST_DONE.  All
+        the internal state is updated first, then each Indigo device
+        touched by the batch is updated once.
+
+        Zones and partitions the batch tells us nothing new about,
+        as is usual for a refresh, are skipped apart from being
+        counted in the summary.
+        """
+        assert self.panelDev is not None
+        self.logger.debug("Handling batch of %d panel messages", len(msgs))
+
+        counts = { }
+        zone_changes = { } # zone key -> (zone name, first old state, last message)
+        part_changes = { } # partition number -> first old state
+        zones_same = set() # zone keys
+        parts_same = set() # partition numbers
+        confirmed = [ ] # (zone key or None, partition number or None) no longer stale
+        # Devices are updated from a snapshot of the state once the
+        # whole batch is merged.
+        with self.state.batch():
+            for msg in msgs:
+                cmd_id = msg['command_id']
+                counts[cmd_id] = counts.get(cmd_id, 0) + 1
+                if cmd_id in ('ZONE_DATA', 'ZONE_STATUS'):
+                    zk = (msg['partition_number'], msg['zone_number'])
+                    if infoUnchanged(self.state.zones.get(zk), msg):
+                        zones_same.add(zk)
+                        if zk in self.staleZones:
+                            self.staleZones.discard(zk)
+                            confirmed.append((zk, None))
+                        continue
+                    zk, zone_name, old_zone_state = self.updateZoneInfo(msg)
+                    if zk in zone_changes:
+                        old_zone_state = zone_changes[zk][1]
+                    zone_changes[zk] = (zone_name, old_zone_state, msg)
+                elif cmd_id == 'PART_DATA':
+                    if infoUnchanged(self.state.parts.get(msg['partition_number']), msg):
+                        parts_same.add(msg['partition_number'])
+                        if msg['partition_number'] in self.staleParts:
+                            self.staleParts.discard(msg['partition_number'])
+                            confirmed.append((None, msg['partition_number']))
+                        continue
+                    part_num, old_part_state = self.updatePartitionInfo(msg)
+                    part_changes.setdefault(part_num, old_part_state)
+                elif cmd_id == 'EQPT_LIST_DONE':
+                    if not self.panelInitialQueryDone:
+                        self.devStates.update(self.panelDev, [('panelState', 'active')])
+                        self.panelInitialQueryDone = True
+                        if len(self.staleZones) > 0:
+                            self.logger.warn("Saved zones not reported by the panel: %s",
+                                                 ', '.join(self.zoneName(zk, { }) for zk in sorted(self.staleZones)))
+                else:
+                    self.logger.debug_verbose("Plugin: unhandled panel message %s", cmd_id,
+                                              command_id=cmd_id)
+
+        for zk, (zone_name, old_zone_state, msg) in sorted(zone_changes.iteritems()):
+            if zk in self.zoneDevs:
+                self.updateZoneDeviceState(self.zoneDevs[zk], zk)
+            else:
+                self.logger.warn("No Indigo zone device for zone %s", zone_name,
+                                 command_id=msg['command_id'])
+            # Only the zones going to or from error states get their
+            # own entries, in the error log; the rest are covered by
+            # the summary entry below.
+            if isZoneErrState(old_zone_state) or isZoneErrState(msg['zone_state']):
+                self.logZoneChange(zone_name, old_zone_state, msg)
+            self.zoneMonitorChange(zone_name, zk[0], old_zone_state, msg)
+
+        # Partition readiness and alarm state follow their zones.
+        for part_num in set(zk[0] for zk in zone_changes) - set(part_changes):
+            if part_num in self.partDevs or part_num in self.touchpadDevs:
+                self.updatePartitionDevices(part_num, 'ZONE_DATA')
+
+        for part_num, old_part_state in sorted(part_changes.iteritems()):
+            self.updatePartitionDevices(part_num, 'PART_DATA')
+            part_state = self.getPartitionArmState(part_num)
+            if old_part_state != part_state or part_state != 'ready':
+                self.logEvent(self.state.parts[part_num].copy(), True)
+
+        # Unchanged, but the devices need to know the saved state was
+        # right.
+        for zk, part_num in confirmed:
+            if zk is not None and zk in self.zoneDevs:
+                self.updateZoneDeviceState(self.zoneDevs[zk], zk)
+            elif part_num is not None and part_num in self.partDevs:
+                self.updatePartitionDeviceState(self.partDevs[part_num], part_num)
+
+        if self.refresher is not None:
+            self.refresher.batch_done(counts.keys())
+
+        zones_same -= set(zone_changes)
+        parts_same -= set(part_changes)
+        self.logger.info("Equipment list: %d zones changed, %d unchanged; %d partitions changed, %d unchanged",
+                             len(zone_changes), len(zones_same), len(part_changes), len(parts_same))
+        self.logEvent({ 'command': 'EQPT_LIST',
+                        'message': "Equipment list batch",
+                        'counts': counts,
+                        'zones': sorted(zone_changes.keys()),
+                        'partitions': sorted(part_changes),
+                        'zones_unchanged': len(zones_same),
+                        'partitions_unchanged': len(parts_same) })
+
+    def handleAlarm(self, msg):
+        """
+        Handle an ALARM message.  The panel interface hands these to
+        us ahead of routine messages; we fire the Indigo triggers
+        first, then update devices, and log last.
+        """
+        part_num = msg['partition_number']
+        source_type = msg['source_type']
+        source_num = msg['source_number']
+        alarm_code_str ="%d.%d" % (msg['alarm_general_type_code'], msg['alarm_specific_type_code'])
+        alarm_desc = "%s / %s" % (msg['alarm_general_type'], msg['alarm_specific_type'])
+        event_data = msg['event_specific_data']
+
+        alarm_gen_code = msg['alarm_general_type_code']
+        for trigger in self.triggerIndex.match('alarm', part_num, alarm_gen_code):
+            indigo.trigger.execute(trigger)
+
+        # Time from the message arriving on the serial port to our
+        # triggers being fired.
+        latency = time.time() - msg['received_at']
+        self.alarmLatency.add(latency)
+
+        # Update partition alarm states.
+        #
+        # XXX Set partitionState to 'alarm'?  Then need to track
+        # state as it changes...  How to determine partition alarm
+        # state when we first start up?  I know this will be a
+        # rare case, but... Probably can say partition is in alarm
+        # if any of its zones are in alarm.
+
+        # Try to get a better name for the alarm source if it is a zone.
+        zk = (part_num, source_num)
+        zone_info = self.state.zones.get(zk)
+        if source_type == 'Zone' and zone_info is not None:
+            zone_name = zone_info.get('zone_text', 'Unknown')
+            if zk in self.zoneDevs:
+                source_desc = "Zone %d - Indigo zone %s, alarm zone %s" % \
+                    (source_num, self.zoneDevs[zk].name, zone_name)
+            else:
+                source_desc = "Zone %d - alarm zone %s" % (source_num, zone_name)
+        else:
+            source_desc = "%s, number %d" % (source_type, source_num)
+
+        if part_num in self.partDevs:
+            partDev = self.partDevs[part_num]
+            self.logger.debug("Updating Indigo partition device %d", partDev.id)
+            self.devStates.update(partDev, [('alarmSource', source_desc),
+                                            ('alarmCode', alarm_code_str),
+                                            ('alarmDescription', alarm_desc),
+                                            ('alarmEventData', event_data)])
+            self.logger.debug(" .... Done")
+        else:
+            self.logger.warn("No Indigo partition device for partition %d", part_num)
+
+        self.logger.error("ALARM or TROUBLE on partition %d: Source is %s/%d; Alarm/Trouble is %s: %s; event data = %s", part_num, source_type, source_num, alarm_code_str, alarm_desc, event_data)
+        self.logger.error("ALARM or TROUBLE on partition %d: Source details: %s", part_num, source_desc)
+        self.logger.info("Alarm triggers fired %.1f ms after message arrived", 1000 * latency)
+        self.devStates.update(self.panelDev, [('alarmLatency', "%.1f ms" % (1000 * latency))])
 
+        msg['source_desc'] = source_desc
+        self._logEvent(encode_message_event(msg, { 'source_desc': source_desc }), True)
 
     # Will be run in the concurrent thread.
     def panelMessageHandler(self, msg):
@@ -980,6 +2336,13 @@ v        """
         assert self.panelDev is not None
         cmd_id = msg['command_id']
 
+        # The panel sends a TOUCHPAD message for each partition every
+        # minute, usually just to update the clock; don't do
+        # anything more than needed for those.
+        if msg.get('clock_only') and msg['partition_number'] in self.state.parts:
+            self.updateTouchpadClock(msg)
+            return
+
         # Log about the message, but not for the ones we hear all the
         # time.  Chatterbox!
         if cmd_id in ('TOUCHPAD', 'SIREN_SYNC'):
@@ -988,211 +2351,77 @@ v        """
             log_fn = self.logger.debug_verbose
         else:
             log_fn = self.logger.debug
-        log_fn("Handling panel message %s, %s" % \
-                   (cmd_id, self.panel_command_names.get(cmd_id, 'Unknown')))
+        log_fn("Handling panel message %s, %s",
+                   cmd_id, lazy(self.panel_command_names.get, cmd_id, 'Unknown'))
 
         #
         # First set of cases by message to update plugin and device state.
         #
         if cmd_id == 'PANEL_TYPE':
-            self.panelDev.updateStateOnServer('panelType', msg['panel_type'])
-            self.panelDev.updateStateOnServer('panelIsConcord', msg['is_concord'])
-            self.panelDev.updateStateOnServer('panelSerialNumber', msg['serial_number'])
-            self.panelDev.updateStateOnServer('panelHwRev', msg['hardware_revision'])
-            self.panelDev.updateStateOnServer('panelSwRev', msg['software_revision'])
-            self.panelDev.updateStateOnServer('panelZoneMonitorEnabled', self.zoneMonitorEnabled)
-            self.panelDev.updateStateOnServer('panelZoneMonitorSendEmail', self.zoneMonitorSendEmail)
+            self.devStates.update(self.panelDev, [
+                    ('panelType', msg['panel_type']),
+                    ('panelIsConcord', msg['is_concord']),
+                    ('panelSerialNumber', msg['serial_number']),
+                    ('panelHwRev', msg['hardware_revision']),
+                    ('panelSwRev', msg['software_revision']),
+                    ('panelZoneMonitorEnabled', self.zoneMonitorEnabled),
+                    ('panelZoneMonitorSendEmail', self.zoneMonitorSendEmail)])
 
         elif cmd_id in ('ZONE_DATA', 'ZONE_STATUS'):
-            # First update our internal state about the zone
-            zone_num = msg['zone_number']
-            part_num = msg['partition_number']
-            zk = (part_num, zone_num)
-            if 'zone_text' in msg and msg['zone_text'] != '':
-                zone_name = '%s - %r' % (zone_num, msg['zone_text'])
-            elif zk in self.zones and self.zones[zk].get('zone_text', '') != '':
-                zone_name = '%s - %r' % (zone_num, self.zones[zk]['zone_text'])
-            else:
-                zone_name = '%d' % zone_num
-
-            old_zone_state = "Not known"
-            new_zone_state = msg['zone_state']
-
-            if zk in self.zones:
-                self.logger.info("Updating zone %s with %s message, zone state=%r" % \
-                                     (zone_name, cmd_id, msg['zone_state']))
-                zone_info = self.zones[zk]
-                old_zone_state = zone_info['zone_state']
-                zone_info.update(msg)
-                del zone_info['command_id']
-            else:
-                self.logger.info("Learning new zone %s from %s message, zone_state=%r" % \
-                                     (zone_name, cmd_id, msg['zone_state']))
-                zone_info = msg.copy()
-                del zone_info['command_id']
-                self.zones[zk] = zone_info
+            zk, zone_name, old_zone_state = self.updateZoneInfo(msg)
+
+            # The panel interface tells us when a zone starts and
+            # stops flapping; in between we only hear a summary.
+            flapping = msg.get('flapping')
+            if flapping == 'start':
+                self.logger.warn("Zone %s is flapping; reporting only a summary until it settles",
+                                     zone_name)
+            elif flapping == 'end':
+                self.logger.warn("Zone %s has settled after %d suppressed changes",
+                                     zone_name, msg['flap_transitions'])
 
             # Next sync up any Indigo devices that might be for this
             # zone.
             if zk in self.zoneDevs:
                 self.updateZoneDeviceState(self.zoneDevs[zk], zk)
             else:
-                self.logger.warn("No Indigo zone device for zone %s" % zone_name)
-
-            # Log to internal event log.  If the zone is changed to or
-            # from one of the 'error' states, we will use the error
-            # log as well.  We don't normally have to check for change
-            # per se, since we know it was a zone change that prompted
-            # this message.  However, if a zone is in an error state,
-            # we don't want to log an error every time it is change
-            # between tripped/not-tripped.
-            use_err_log = (isZoneErrState(old_zone_state) or isZoneErrState(new_zone_state)) \
-                and zoneStateChangedExceptTripped(old_zone_state, new_zone_state)
-            
-            self.logEventZone(zone_name, new_zone_state, old_zone_state,
-                              "Zone update message", cmd_id, msg, use_err_log)
-
-            # If zone monitor is enabled, log any zone changes to the
-            # error log.  Optionally send an email if the user asked
-            # for that, and fire Indigo triggers.
-            if self.zoneMonitorEnabled:
-
-                # Activate any zone monitor triggers
-                for trigger in self.getTriggersForType(['zoneMonitorTriggered']):
-                    trig_part = any_if_blank(trigger.pluginProps['address'])
-                    if trig_part == 'any' or int(trig_part) == part_num:
-                        indigo.trigger.execute(trigger)
-
-                self.logEventZone(zone_name, new_zone_state, old_zone_state,
-                                  "Zone monitor / Zone update message", cmd_id, msg, True)
-                if self.zoneMonitorSendEmail:
-                    date_str = datetime.now().isoformat(' ')[:19]
-                    if isZoneErrState(new_zone_state):
-                        change_str = 'ERROR'
-                    elif TRIPPED in new_zone_state and TRIPPED not in old_zone_state:
-                        change_str = 'OPENED'
-                    elif TRIPPED in old_zone_state and TRIPPED not in new_zone_state:
-                        change_str = 'CLOSED'
-                    else:
-                        change_Str = 'UNKNOWN'
-                    subject = "Zone Monitor: %s %s at %s" % (zone_name, change_str, date_str)
-                    body = """
-When: %s
-Zone: %s
-Command: %s
-Old State: %r
-New State: %r
-Message: %r
-""" % (date_str, zone_name, cmd_id, old_zone_state, new_zone_state, msg)
-                    self.sendEmail(subject, body)
+                self.logger.warn("No Indigo zone device for zone %s", zone_name,
+                                 command_id=cmd_id)
+            # Partition readiness and alarm state follow their zones.
+            if zk[0] in self.partDevs or zk[0] in self.touchpadDevs:
+                self.updatePartitionDevices(zk[0], cmd_id)
 
+            self.logZoneChange(zone_name, old_zone_state, msg)
+            self.zoneMonitorChange(zone_name, zk[0], old_zone_state, msg)
 
         elif cmd_id in ('PART_DATA', 'ARM_LEVEL', 'FEAT_STATE', 'DELAY', 'TOUCHPAD'):
-            part_num = msg['partition_number']
-            old_part_state = "Unknown"
-            if part_num in self.parts:
-                old_part_state = self.getPartitionState(part_num)
-                # Log informational message about updating the
-                # partition with message info.  However, for touchpad
-                # messages this could be quite frequent (every minute)
-                # so log at a higher level.
-                if cmd_id == 'TOUCHPAD':
-                    log_fn = self.logger.debug_verbose
-                else:
-                    log_fn = self.logger.info
-                log_fn("Updating partition %d with %s message" % (part_num, cmd_id))
-                part_info = self.parts[part_num]
-                part_info.update(msg)
-                del part_info['command_id']
-            else:
-                self.logger.info("Learning new partition %d from %s message" % (part_num, cmd_id))
-                part_info = msg.copy()
-                del part_info['command_id']
-                self.parts[part_num] = part_info
-
-            if part_num in self.partDevs:
-                self.updatePartitionDeviceState(self.partDevs[part_num], part_num)
-            else:
-                # The panel seems to send touchpad date/time messages
-                # for all partitions it supports.  User may not wish
-                # to see warnings if they haven't setup the Partition
-                # device in Indigo, so log this at a higher level.
-                if cmd_id == 'TOUCHPAD':
-                    log_fn = self.logger.debug_verbose
-                else:
-                    log_fn = self.logger.warn
-                log_fn("No Indigo partition device for partition %d" % part_num)
-
-            # We update the touchpad even when it's not a TOUCHPAD
-            # message so that the touchpad device can track the
-            # underlying partition state.  Later on we may also add
-            # other features to mirror the LEDs on an actual touchpad
-            # as well.
-            if part_num in self.touchpadDevs:
-                for dev_id, dev in self.touchpadDevs[part_num].iteritems():
-                    self.updateTouchpadDeviceState(dev, part_num)
+            part_num, old_part_state = self.updatePartitionInfo(msg)
+            self.updatePartitionDevices(part_num, cmd_id)
 
             # Write message to internal log
             if cmd_id in ('PART_DATA', 'ARM_LEVEL', 'DELAY'):
-                part_state = self.getPartitionState(part_num)
+                part_state = self.getPartitionArmState(part_num)
                 use_err_log = cmd_id != 'PART_DATA' or old_part_state != part_state or part_state != 'ready'
                 self.logEvent(msg, use_err_log)
 
-
-        elif cmd_id == 'EQPT_LIST_DONE':
-            if not self.panelInitialQueryDone:
-                self.panelDev.updateStateOnServer('panelState', 'active')
-                self.panelInitialQueryDone = True
-
         elif cmd_id == 'ALARM':
-            # Update partition alarm states.
-            #
-            # XXX Set partitionState to 'alarm'?  Then need to track
-            # state as it changes...  How to determine partition alarm
-            # state when we first start up?  I know this will be a
-            # rare case, but... Probably can say partition is in alarm
-            # if any of its zones are in alarm.
-            part_num = msg['partition_number']
-            source_type = msg['source_type']
-            source_num = msg['source_number']
-            alarm_code_str ="%d.%d" % (msg['alarm_general_type_code'], msg['alarm_specific_type_code'])
-            alarm_desc = "%s / %s" % (msg['alarm_general_type'], msg['alarm_specific_type'])
-            event_data = msg['event_specific_data']
-
-            self.logger.error("ALARM or TROUBLE on partition %d: Source is %s/%d; Alarm/Trouble is %s: %s; event data = %s" % (part_num, source_type, source_num, alarm_code_str, alarm_desc, event_data))
-
-            # Try to get a better name for the alarm source if it is a zone.
-            zk = (part_num, source_num)
-            if source_type == 'Zone' and zk in self.zones:
-                zone_name = self.zones[zk].get('zone_text', 'Unknown')
-                if zk in self.zoneDevs:
-                    source_desc = "Zone %d - Indigo zone %s, alarm zone %s" % \
-                        (source_num, self.zoneDevs[zk].name, zone_name)
-                else:
-                    source_desc = "Zone %d - alarm zone %s" % (source_num, zone_name)
-            else:
-                source_desc = "%s, number %d" % (source_type, source_num)
-            self.logger.error("ALARM or TROUBLE on partition %d: Source details: %s" % (part_num, source_desc))
-
-            if part_num in self.partDevs:
-                partDev = self.partDevs[part_num]
-                self.logger.debug("Updating Indigo partition device %d" % partDev.id)
-                partDev.updateStateOnServer('alarmSource', source_desc)
-                partDev.updateStateOnServer('alarmCode', alarm_code_str)
-                partDev.updateStateOnServer('alarmDescription', alarm_desc)
-                partDev.updateStateOnServer('alarmEventData', event_data)
-                self.logger.debug(" .... Done")
-            else:
-                self.logger.warn("No Indigo partition device for partition %d" % part_num)
-            
-            msg['source_desc'] = source_desc
-            self.logEvent(msg, True)
+            self.handleAlarm(msg)
 
-        elif cmd_id in ('CLEAR_IMAGE', 'EVENT_LOST'):
+        elif cmd_id == 'CLEAR_IMAGE':
+            # Sent on panel power up, and on leaving programming mode,
+            # when any of the equipment may have changed.
             self.refreshPanelState("Reacting to %s message" % cmd_id)
 
+        elif cmd_id == 'EVENT_LOST':
+            # Only zone and partition changes are reported as events;
+            # the rest of the equipment only changes in programming
+            # mode, which ends with CLEAR_IMAGE.
+            self.refreshPanelState("Reacting to %s message" % cmd_id,
+                                   ['zones', 'partitions'])
+
         else:
-            self.logger.debug_verbose("Plugin: unhandled panel message %s" % cmd_id)
+            self.logger.debug_verbose("Plugin: unhandled panel message %s", cmd_id,
+                                      command_id=cmd_id)
 
         #
         # Second set of cases for trigger handling
@@ -1200,33 +2429,7 @@ Message: %r
         if cmd_id == 'ARM_LEVEL':
             # Execute all arming level triggers that match this
             # message's partition and arming level.
-            for trigger in self.getTriggersForType(['armingLevel']):
-                part_num = msg['partition_number']
-                arm_level = PART_ARM_STATE_MAP.get(msg['arming_level_code'], 'unknown')
-
-                trig_part = any_if_blank(trigger.pluginProps['address'])
-                trig_level = any_if_blank(trigger.pluginProps['partitionState'])
-
-                part_match = (trig_part == 'any') or (int(trig_part) == part_num)
-                level_match = (trig_level == 'any') or (trig_level == arm_level)
-                
-                if part_match and level_match:
-                    indigo.trigger.execute(trigger)
-
-        elif cmd_id == 'ALARM':
-            for trigger in self.getTriggersForType(['alarm']):
-                part_num = msg['partition_number']
-                alarm_gen_code = msg['alarm_general_type_code']
-
-                trig_part = any_if_blank(trigger.pluginProps['address'])
-                trig_gen_code = any_if_blank(trigger.pluginProps['alarmGeneralType'])
-
-                part_match = (trig_part == 'any') or (int(trig_part) == part_num)
-                code_match = (trig_gen_code == 'any') or (int(trig_gen_code) == alarm_gen_code)
-                
-                if part_match and code_match:
-                    indigo.trigger.execute(trigger)
-
-        elif cmd_id == 'ZONE_STATUS':
-            for trigger in self.getTriggersForType('zoneStateChanged'):
-                pass
+            part_num = msg['partition_number']
+            arm_level = PART_ARM_STATE_MAP.get(msg['arming_level_code'], 'unknown')
+            for trigger in self.triggerIndex.match('armingLevel', part_num, arm_level):
+                indigo.trigger.execute(trigger)